@@ -18,6 +18,8 @@ component="submit-code-embeddings-job"
 numWorkers=5
 # default dataflow worker machine type
 workerMachineType=n1-highcpu-32
+# default previous function embeddings BQ table, empty to embed all functions
+previousFunctionEmbeddingsBQTable=""
 
 usage() {
 	echo "Usage: submit_code_embeddings_job.sh
@@ -28,6 +30,7 @@ usage() {
 	--modelDir=<directory contains the model>
 	--namespace=<kubernetes namespace>
 	--numWorkers=<num of workers>
+	--previousFunctionEmbeddingsBQTable=<function embedding BQ table of a previous run to reuse unchanged embeddings from>
 	--project=<project>
 	--timeout=<timeout>
 	--workerMachineType=<worker machine type>
@@ -48,6 +51,7 @@ ks param set ${component} functionEmbeddingsDir ${functionEmbeddingsDir} --env $
 ks param set ${component} jobNameSuffix ${workflowId} --env ${ksEnvName}
 ks param set ${component} modelDir ${modelDir} --env ${ksEnvName}
 ks param set ${component} numWorkers ${numWorkers} --env ${ksEnvName}
+ks param set ${component} previousFunctionEmbeddingsBQTable "${previousFunctionEmbeddingsBQTable}" --env ${ksEnvName}
 ks param set ${component} project ${project} --env ${ksEnvName}
 ks param set ${component} workerMachineType ${workerMachineType} --env ${ksEnvName}
 ks param set ${component} workingDir ${workingDir} --env ${ksEnvName}
@@ -122,6 +122,9 @@
       dataDir: self.workingDir + "/data",
       functionEmbeddingsDir: self.workingDir + "/code_embeddings",
       functionEmbeddingsBQTable: "",
+      // Function embeddings BQ table of a previous run. Functions whose tokens are
+      // unchanged keep their embedding from this table instead of being re-embedded.
+      previousFunctionEmbeddingsBQTable: "",
     },
 
     tensorboard: {
@@ -44,6 +44,9 @@
 	              "--worker_machine_type=" + params.workerMachineType,
 	              "--num_workers=" + params.numWorkers,
 	              "--requirements_file=requirements.txt",
+                  if (params.previousFunctionEmbeddingsBQTable != "") then
+                      "--previous_function_embeddings_table=" + params.previousFunctionEmbeddingsBQTable
+                  else [],
                   if (params.waitUntilFinish == "true") then
                       "--wait_until_finished"
                   else [],
@@ -20,7 +20,8 @@ def dataflow_function_embedding_op(
         saved_model_dir: 'GcsUri',
         worker_machine_type: str,
         workflow_id: str,
-        working_dir: str,):
+        working_dir: str,
+        previous_function_embeddings_bq_table: str = '',):
   return dsl.ContainerOp(
     name='dataflow_function_embedding',
     image='gcr.io/kubeflow-examples/code-search/ks:v20181210-d7487dd-dirty-eb371e',
@@ -33,6 +34,7 @@ def dataflow_function_embedding_op(
       "--modelDir=%s" % saved_model_dir,
       "--namespace=%s" % namespace,
       "--numWorkers=%s" % num_workers,
+      "--previousFunctionEmbeddingsBQTable=%s" % previous_function_embeddings_bq_table,
       "--project=%s" % project,
       "--workerMachineType=%s" % worker_machine_type,
       "--workflowId=%s" % workflow_id,
@@ -135,7 +137,10 @@ def github_code_index_update(
     # workflow name is assigned at runtime. Pipeline might need to support
     # replacing characters in workflow name.
     # For recurrent pipeline, pass in '[[Index]]' instead, for unique naming.
-    bq_suffix=uuid.uuid4().hex[:6].upper()):
+    bq_suffix=uuid.uuid4().hex[:6].upper(),
+    # Function embeddings table of a previous run to carry unchanged embeddings
+    # forward from. Leave empty to embed all the functions.
+    previous_function_embeddings_bq_table=''):
   workflow_name = '{{workflow.name}}'
   working_dir = '%s/%s' % (working_dir, workflow_name)
   lookup_file = '%s/code-embeddings-index/embedding-to-info.csv' % working_dir
@@ -154,7 +159,8 @@ def github_code_index_update(
     saved_model_dir,
     worker_machine_type,
     workflow_name,
-    working_dir)
+    working_dir,
+    previous_function_embeddings_bq_table)
 
   search_index_creator = search_index_creator_op(
     cluster_name,
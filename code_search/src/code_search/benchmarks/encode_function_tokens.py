@@ -0,0 +1,124 @@
+"""Microbenchmark of `EncodeFunctionTokens`.
+
+This compares elements per second of encoding function tokens
+by loading the encoder for every element, as `EncodeFunctionTokens`
+used to do, with the per-worker cached and batched DoFn.
+
+  python -m code_search.benchmarks.encode_function_tokens
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+from apache_beam.transforms.window import GlobalWindow
+from apache_beam.utils.timestamp import MIN_TIMESTAMP
+
+# We need to import function_docstring to ensure the problem is registered
+from code_search.t2t import function_docstring # pylint: disable=unused-import
+from code_search.t2t.query import get_encoder, encode_query
+from code_search.dataflow.do_fns.function_embeddings import EncodeFunctionTokens
+
+PACKAGE_DIR = os.path.abspath(os.path.join(__file__, '../..'))
+
+
+def parse_arguments(argv=None):
+  parser = argparse.ArgumentParser(prog='EncodeFunctionTokens Benchmark')
+
+  parser.add_argument('--problem', type=str, metavar='',
+                      default='kf_github_function_docstring',
+                      help='Name of the T2T problem')
+  parser.add_argument('--data_dir', type=str, metavar='',
+                      default=os.path.join(PACKAGE_DIR, 't2t/test_data'),
+                      help='Path to directory of the T2T problem data with the vocabulary')
+  parser.add_argument('--github_file', type=str, metavar='',
+                      default=os.path.join(PACKAGE_DIR, 'dataflow/cli/test_data/sample.json'),
+                      help='Path to a file of GitHub dataset json records to take tokens from')
+  parser.add_argument('--num_elements', type=int, metavar='', default=2000,
+                      help='Number of elements to encode')
+  parser.add_argument('--tokens_per_element', type=int, metavar='', default=64,
+                      help='Number of tokens in the function tokens of each element')
+  parser.add_argument('--batch_size', type=int, metavar='', default=1000,
+                      help='Batch size of the batched DoFn')
+
+  return parser.parse_args(argv)
+
+
+def make_elements(github_file, num_elements, tokens_per_element):
+  """Build elements like the ones of the transformed GitHub dataset."""
+  tokens = []
+  with open(github_file) as json_file:
+    for line in json_file:
+      tokens.extend(json.loads(line)['content'].split())
+
+  elements = []
+  for i in range(num_elements):
+    start = (i * tokens_per_element) % max(len(tokens) - tokens_per_element, 1)
+    elements.append({
+      u'nwo': u'owner/repo',
+      u'path': u'file.py',
+      u'function_name': u'function_{}'.format(i),
+      u'lineno': u'1',
+      u'original_function': u'',
+      u'function_tokens': u' '.join(tokens[start:start + tokens_per_element]),
+      u'docstring_tokens': u'',
+    })
+  return elements
+
+
+def encode_per_element(problem, data_dir, elements):
+  """Encode elements the way `EncodeFunctionTokens` used to, one at a time."""
+  for element in elements:
+    encoder = get_encoder(problem, data_dir)
+    encoded_function = encode_query(encoder, True, element.get(u'function_tokens'))
+    element[u'instances'] = [{'input': {'b64': encoded_function}}]
+  return elements
+
+
+def encode_batched(problem, data_dir, elements, batch_size):
+  """Run elements through the lifecycle of one bundle of the DoFn."""
+  do_fn = EncodeFunctionTokens(problem, data_dir, batch_size=batch_size)
+  do_fn.start_bundle()
+  outputs = []
+  for element in elements:
+    outputs.extend(do_fn.process(element, timestamp=MIN_TIMESTAMP, window=GlobalWindow()))
+  outputs.extend(do_fn.finish_bundle())
+  return outputs
+
+
+def run(name, fn, num_elements):
+  start = time.time()
+  fn()
+  seconds = time.time() - start
+  logging.info("%s: %d elements in %.2fs, %.1f elements/s", name, num_elements, seconds,
+               num_elements / seconds)
+  return num_elements / seconds
+
+
+def benchmark_encode_function_tokens(argv=None):
+  args = parse_arguments(argv)
+
+  # Load the vocabulary once so that both runs read it from the page cache.
+  get_encoder(args.problem, args.data_dir)
+
+  before_elements = make_elements(args.github_file, args.num_elements, args.tokens_per_element)
+  after_elements = make_elements(args.github_file, args.num_elements, args.tokens_per_element)
+
+  before = run('Per element encoder', lambda: encode_per_element(
+    args.problem, args.data_dir, before_elements), args.num_elements)
+  after = run('Cached batched encoder', lambda: encode_batched(
+    args.problem, args.data_dir, after_elements, args.batch_size), args.num_elements)
+  logging.info("Speedup: %.1fx", after / before)
+
+  return {'before_elements_per_second': before, 'after_elements_per_second': after}
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO,
+                      format=('%(levelname)s|%(asctime)s'
+                              '|%(pathname)s|%(lineno)d| %(message)s'),
+                      datefmt='%Y-%m-%dT%H:%M:%S',
+                      )
+  logging.getLogger().setLevel(logging.INFO)
+  benchmark_encode_function_tokens()
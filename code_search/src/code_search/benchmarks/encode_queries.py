@@ -0,0 +1,99 @@
+"""Microbenchmark of `encode_queries`.
+
+This compares strings per second of encoding queries one at
+a time with `encode_query` against the bulk `encode_queries`,
+which memoizes the subword ids of repeated tokens, returning
+base64 strings or raw serialized TF Examples.
+
+  python -m code_search.benchmarks.encode_queries
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+# We need to import function_docstring to ensure the problem is registered
+from code_search.t2t import function_docstring # pylint: disable=unused-import
+from code_search.t2t.query import get_encoder, encode_query, encode_queries
+
+PACKAGE_DIR = os.path.abspath(os.path.join(__file__, '../..'))
+
+
+def parse_arguments(argv=None):
+  parser = argparse.ArgumentParser(prog='encode_queries Benchmark')
+
+  parser.add_argument('--problem', type=str, metavar='',
+                      default='kf_github_function_docstring',
+                      help='Name of the T2T problem')
+  parser.add_argument('--data_dir', type=str, metavar='',
+                      default=os.path.join(PACKAGE_DIR, 't2t/test_data'),
+                      help='Path to directory of the T2T problem data with the vocabulary')
+  parser.add_argument('--github_file', type=str, metavar='',
+                      default=os.path.join(PACKAGE_DIR, 'dataflow/cli/test_data/sample.json'),
+                      help='Path to a file of GitHub dataset json records to take tokens from')
+  parser.add_argument('--num_queries', type=int, metavar='', default=5000,
+                      help='Number of strings to encode')
+  parser.add_argument('--tokens_per_query', type=int, metavar='', default=64,
+                      help='Number of tokens of each string')
+
+  return parser.parse_args(argv)
+
+
+def make_queries(github_file, num_queries, tokens_per_query):
+  """Build strings of function tokens taken from GitHub dataset records."""
+  tokens = []
+  with open(github_file) as json_file:
+    for line in json_file:
+      tokens.extend(json.loads(line)['content'].split())
+
+  queries = []
+  for i in range(num_queries):
+    start = (i * tokens_per_query) % max(len(tokens) - tokens_per_query, 1)
+    queries.append(u' '.join(tokens[start:start + tokens_per_query]))
+  return queries
+
+
+def run(name, fn, num_queries):
+  start = time.time()
+  fn()
+  seconds = time.time() - start
+  logging.info("%s: %d strings in %.2fs, %.1f strings/s", name, num_queries, seconds,
+               num_queries / seconds)
+  return num_queries / seconds
+
+
+def benchmark_encode_queries(argv=None):
+  args = parse_arguments(argv)
+
+  encoder = get_encoder(args.problem, args.data_dir)
+  queries = make_queries(args.github_file, args.num_queries, args.tokens_per_query)
+
+  # The bulk encoding matches the single-call one.
+  expected = [encode_query(encoder, True, query_str) for query_str in queries[:100]]
+  if encode_queries(encoder, True, queries[:100]) != expected:
+    raise ValueError('encode_queries and encode_query disagree')
+
+  single = run('encode_query', lambda: [encode_query(encoder, True, query_str)
+                                        for query_str in queries], args.num_queries)
+  bulk = run('encode_queries', lambda: encode_queries(encoder, True, queries),
+             args.num_queries)
+  bulk_raw = run('encode_queries raw', lambda: encode_queries(encoder, True, queries, raw=True),
+                 args.num_queries)
+  logging.info("Speedup: %.1fx, %.1fx raw", bulk / single, bulk_raw / single)
+
+  return {
+    'single_queries_per_second': single,
+    'bulk_queries_per_second': bulk,
+    'bulk_raw_queries_per_second': bulk_raw,
+  }
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO,
+                      format=('%(levelname)s|%(asctime)s'
+                              '|%(pathname)s|%(lineno)d| %(message)s'),
+                      datefmt='%Y-%m-%dT%H:%M:%S',
+                      )
+  logging.getLogger().setLevel(logging.INFO)
+  benchmark_encode_queries()
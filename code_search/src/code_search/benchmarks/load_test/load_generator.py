@@ -0,0 +1,148 @@
+"""Closed-loop and open-loop load generators of HTTP GET requests.
+
+In a closed loop, a fixed number of clients each send their next
+request as soon as the previous one returns, which measures the
+maximum throughput at that concurrency. In an open loop, requests
+are sent at a fixed average rate with Poisson arrivals whatever the
+server's latency. Latencies are then measured from the scheduled
+send time, so that a saturated server shows up as growing latency
+rather than as a lower request rate (coordinated omission).
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+
+def summarize(latencies, errors, seconds):
+  """Summarize the requests of a load test run.
+
+  Args:
+    latencies: A list of latencies in seconds of the successful requests.
+    errors: Number of failed requests.
+    seconds: Duration of the run.
+
+  Returns:
+    A dict of the number of requests, QPS, error rate and latency
+    percentiles in milliseconds.
+  """
+  num_requests = len(latencies) + errors
+  latencies_ms = np.asarray(latencies, dtype=np.float64) * 1000.
+  summary = {
+    'requests': num_requests,
+    'errors': errors,
+    'error_rate': float(errors) / num_requests if num_requests else 0.,
+    'seconds': seconds,
+    'qps': len(latencies) / seconds if seconds > 0 else 0.,
+  }
+  for name, percentile in [('p50_ms', 50), ('p95_ms', 95), ('p99_ms', 99)]:
+    summary[name] = float(np.percentile(latencies_ms, percentile)) if len(latencies) else None
+  summary['mean_ms'] = float(latencies_ms.mean()) if len(latencies) else None
+  summary['max_ms'] = float(latencies_ms.max()) if len(latencies) else None
+  return summary
+
+
+class LoadGenerator:
+  """Send requests for queries to a search server.
+
+  Args:
+    url: URL of the route to load, e.g. `http://localhost:8008/query`.
+    queries: A list of query strings, sent in turn.
+    params: A dict of other query parameters, e.g. `{'n': 10}`.
+    timeout: Timeout in seconds of each request. Timeouts count as errors.
+  """
+
+  def __init__(self, url, queries, params=None, timeout=10):
+    self.url = url
+    self.queries = queries
+    self.params = params or {}
+    self.timeout = timeout
+
+    self._lock = threading.Lock()
+    self._next_query = 0
+    self._local = threading.local()
+
+  def next_query(self):
+    with self._lock:
+      query_str = self.queries[self._next_query % len(self.queries)]
+      self._next_query += 1
+    return query_str
+
+  def send(self):
+    """Send one request and return whether it succeeded."""
+    # Every thread keeps its own keep-alive connections.
+    session = getattr(self._local, 'session', None)
+    if session is None:
+      session = self._local.session = requests.Session()
+
+    params = dict(self.params, q=self.next_query())
+    try:
+      response = session.get(self.url, params=params, timeout=self.timeout)
+    except requests.RequestException as e:
+      logging.debug("Request failed: %s", e)
+      return False
+    if not response.ok:
+      logging.debug("Request failed; status: %s", response.status_code)
+    return response.ok
+
+  def closed_loop(self, concurrency, duration_seconds):
+    """Run `concurrency` clients sending requests back to back."""
+    results = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    deadline = time.time() + duration_seconds
+
+    def client(i):
+      while time.time() < deadline:
+        start = time.time()
+        if self.send():
+          results[i].append(time.time() - start)
+        else:
+          errors[i] += 1
+
+    start = time.time()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    seconds = time.time() - start
+
+    return summarize([latency for latencies in results for latency in latencies],
+                     sum(errors), seconds)
+
+  def open_loop(self, rate, duration_seconds, max_concurrency=256, seed=0):
+    """Send requests at `rate` per second on average for `duration_seconds`.
+
+    At most `max_concurrency` requests are in flight; later ones wait
+    for a free thread, and that wait counts towards their latency.
+    """
+    rng = np.random.RandomState(seed)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def request(scheduled):
+      ok = self.send()
+      with lock:
+        if ok:
+          latencies.append(time.time() - scheduled)
+        else:
+          errors[0] += 1
+
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    start = time.time()
+    scheduled = start
+    while True:
+      scheduled += rng.exponential(1. / rate)
+      if scheduled >= start + duration_seconds:
+        break
+      delay = scheduled - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      executor.submit(request, scheduled)
+    executor.shutdown(wait=True)
+    seconds = max(time.time() - start, duration_seconds)
+
+    return summarize(latencies, errors[0], seconds)
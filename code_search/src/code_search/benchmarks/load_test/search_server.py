@@ -0,0 +1,236 @@
+"""Load test of the `/query` route of the search server.
+
+For every combination of index size, number of results `k` and
+concurrency (or request rate with `--mode open`), this serves a
+synthetic index with `CodeSearchServer`, embedding queries with a
+stub of TF Serving, and reports QPS, latency percentiles and error
+rates of the `/query` route, see `LoadGenerator`. The server and
+the stub each run in a subprocess, so that they do not share the
+GIL of the load generator. With `--server_url`, an already running
+server is loaded instead.
+
+  python -m code_search.benchmarks.load_test.search_server \
+      --index_sizes=10000,100000 --ks=2,10 --concurrency=1,8,32 \
+      --output_file=/tmp/load_test.json
+"""
+import argparse
+import contextlib
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+import time
+import requests
+from werkzeug.serving import make_server
+
+from code_search.benchmarks.load_test.load_generator import LoadGenerator
+from code_search.benchmarks.load_test.stub_serving import StubServing, embed_query
+from code_search.benchmarks.load_test.synthetic_index import make_queries, \
+  write_synthetic_index
+from code_search.nmslib.search_engine import CodeSearchEngine
+from code_search.nmslib.search_server import CodeSearchServer
+
+
+def int_list(value):
+  return [int(item) for item in value.split(',') if item]
+
+
+def float_list(value):
+  return [float(item) for item in value.split(',') if item]
+
+
+def parse_arguments(argv=None):
+  parser = argparse.ArgumentParser(prog='Search Server Load Test')
+
+  parser.add_argument('--server_url', type=str, metavar='', default='',
+                      help='Base URL of a running search server to load instead of serving '
+                           'synthetic indexes. --index_sizes is then ignored')
+  parser.add_argument('--index_sizes', type=int_list, metavar='', default='10000,100000',
+                      help='Comma-separated numbers of items of the synthetic indexes')
+  parser.add_argument('--ks', type=int_list, metavar='', default='2,10',
+                      help='Comma-separated numbers of results per query')
+  parser.add_argument('--mode', type=str, metavar='', default='closed',
+                      choices=['closed', 'open'],
+                      help='closed sends requests back to back from --concurrency clients, '
+                           'open sends --rates requests per second whatever the latency')
+  parser.add_argument('--concurrency', type=int_list, metavar='', default='1,8,32',
+                      help='Comma-separated numbers of concurrent clients of a closed loop')
+  parser.add_argument('--rates', type=float_list, metavar='', default='50,200',
+                      help='Comma-separated requests per second of an open loop')
+  parser.add_argument('--duration_seconds', type=float, metavar='', default=10,
+                      help='Duration of each configuration')
+  parser.add_argument('--warmup_requests', type=int, metavar='', default=20,
+                      help='Number of requests sent before measuring each configuration')
+  parser.add_argument('--num_queries', type=int, metavar='', default=1000,
+                      help='Number of distinct synthetic queries')
+  parser.add_argument('--embedding_dim', type=int, metavar='', default=128,
+                      help='Dimension of the synthetic embeddings')
+  parser.add_argument('--serving_latency_ms', type=int, metavar='', default=0,
+                      help='Time in milliseconds the stub TF Serving takes per request')
+  parser.add_argument('--max_batch_size', type=int, metavar='', default=1,
+                      help='Maximum number of concurrent queries coalesced by the engine')
+  parser.add_argument('--tmp_dir', type=str, metavar='', default='',
+                      help='Directory to write the synthetic indexes to. Defaults to a '
+                           'temporary directory removed at the end')
+  parser.add_argument('--output_file', type=str, metavar='', default='',
+                      help='Path to write the JSON results to')
+
+  return parser.parse_args(argv)
+
+
+class ServerProcess:
+  """Run a server in a subprocess.
+
+  Args:
+    target: A function which takes `args` and a connection, starts a
+            server, sends its URL over the connection and serves forever.
+    args: A tuple of the arguments of `target`.
+  """
+
+  def __init__(self, target, args=()):
+    url_reader, url_writer = multiprocessing.Pipe(duplex=False)
+    self._process = multiprocessing.Process(target=target, args=tuple(args) + (url_writer,),
+                                            name=target.__name__)
+    self._process.daemon = True
+    self._process.start()
+    url_writer.close()
+
+    try:
+      self.url = url_reader.recv()
+    except EOFError:
+      self.stop()
+      raise RuntimeError('{} exited before serving'.format(target.__name__))
+    finally:
+      url_reader.close()
+
+  def stop(self):
+    self._process.terminate()
+    self._process.join()
+
+
+def serve_stub(dim, latency_ms, url_writer):
+  """Serve a `StubServing` in this process, see `ServerProcess`."""
+  stub = StubServing(dim=dim, latency_ms=latency_ms)
+  url_writer.send(stub.url)
+  url_writer.close()
+  stub.httpd.serve_forever()
+
+
+def serve_synthetic_index(index_file, lookup_data, serving_url, max_batch_size, url_writer):
+  """Serve a synthetic index with `CodeSearchServer` in this process, see `ServerProcess`.
+
+  The engine and the server log every request, which would
+  otherwise add to the measured latencies.
+  """
+  for logger in [logging.getLogger(), logging.getLogger('werkzeug')]:
+    logger.setLevel(logging.WARNING)
+
+  session = requests.Session()
+  engine = CodeSearchEngine(index_file, lookup_data,
+                            functools.partial(embed_query, serving_url, session=session),
+                            max_batch_size=max_batch_size)
+  search_server = CodeSearchServer(engine, ui_dir='')
+  server = make_server('127.0.0.1', 0, search_server.app, threaded=True)
+  url_writer.send('http://127.0.0.1:{}'.format(server.server_port))
+  url_writer.close()
+  server.serve_forever()
+
+
+@contextlib.contextmanager
+def quiet_logging(level=logging.WARNING):
+  """Raise the level of the `werkzeug` and root loggers to `level`.
+
+  Logging every request would otherwise add to the measured
+  latencies.
+  """
+  loggers = [logging.getLogger(), logging.getLogger('werkzeug')]
+  levels = [logger.level for logger in loggers]
+  for logger in loggers:
+    logger.setLevel(level)
+  try:
+    yield
+  finally:
+    for logger, logger_level in zip(loggers, levels):
+      logger.setLevel(logger_level)
+
+
+def load_configurations(args, server_url, queries, index_size):
+  """Load a server with every configuration of `k` and concurrency or rate."""
+  results = []
+  for k in args.ks:
+    generator = LoadGenerator(server_url.rstrip('/') + '/query', queries, params={'n': k})
+    with quiet_logging():
+      for _ in range(args.warmup_requests):
+        generator.send()
+
+    loads = args.concurrency if args.mode == 'closed' else args.rates
+    for load in loads:
+      with quiet_logging():
+        if args.mode == 'closed':
+          summary = generator.closed_loop(load, args.duration_seconds)
+          summary['concurrency'] = load
+        else:
+          summary = generator.open_loop(load, args.duration_seconds)
+          summary['rate'] = load
+      summary.update({'mode': args.mode, 'index_size': index_size, 'k': k})
+
+      logging.info("index_size=%s k=%d %s=%s: %.1f QPS, p50 %.1fms, p99 %.1fms, "
+                   "%.2f%% errors", index_size, k,
+                   'concurrency' if args.mode == 'closed' else 'rate', load, summary['qps'],
+                   summary['p50_ms'] or 0., summary['p99_ms'] or 0., summary['error_rate'] * 100)
+      results.append(summary)
+  return results
+
+
+def benchmark_search_server(argv=None):
+  args = parse_arguments(argv)
+  queries = make_queries(args.num_queries)
+
+  results = []
+  if args.server_url:
+    results.extend(load_configurations(args, args.server_url, queries, None))
+  else:
+    tmp_dir = args.tmp_dir or tempfile.mkdtemp()
+    stub = ServerProcess(serve_stub, (args.embedding_dim, args.serving_latency_ms))
+    logging.info("Serving stub embeddings at %s", stub.url)
+    try:
+      for index_size in args.index_sizes:
+        index_file, _, lookup_data = write_synthetic_index(
+          os.path.join(tmp_dir, str(index_size)), index_size, args.embedding_dim)
+        server = ServerProcess(serve_synthetic_index, (index_file, lookup_data, stub.url,
+                                                       args.max_batch_size))
+        try:
+          results.extend(load_configurations(args, server.url, queries, index_size))
+        finally:
+          server.stop()
+    finally:
+      stub.stop()
+      if not args.tmp_dir:
+        shutil.rmtree(tmp_dir)
+
+  report = {
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'platform': platform.platform(),
+    'python_version': platform.python_version(),
+    'arguments': vars(args),
+    'results': results,
+  }
+  if args.output_file:
+    with open(args.output_file, 'w') as output_file:
+      json.dump(report, output_file, indent=2, sort_keys=True)
+
+  return report
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO,
+                      format=('%(levelname)s|%(asctime)s'
+                              '|%(pathname)s|%(lineno)d| %(message)s'),
+                      datefmt='%Y-%m-%dT%H:%M:%S',
+                      )
+  logging.getLogger().setLevel(logging.INFO)
+  benchmark_search_server()
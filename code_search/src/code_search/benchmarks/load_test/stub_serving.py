@@ -0,0 +1,139 @@
+"""A stub of the TF Serving REST predict endpoint.
+
+It answers every instance with a random embedding which only
+depends on the instance, optionally after a fixed delay, so
+that the search server can be load tested without a model.
+
+  python -m code_search.benchmarks.load_test.stub_serving --port 8501
+
+Then pass `http://localhost:8501/v1/models/t2t-code-search:predict`
+as `--serving_url` of `start_search_server`.
+"""
+import argparse
+import base64
+import json
+import logging
+import threading
+import time
+import zlib
+import numpy as np
+import requests
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  # Connections beyond the default backlog of 5 would be reset under load.
+  request_queue_size = 1024
+
+
+class StubServing:
+  """Serve random embeddings like TF Serving serves the query model.
+
+  Args:
+    dim: Dimension of the embeddings.
+    latency_ms: Time in milliseconds to wait before answering a request.
+    host: A string host in IPv4 format.
+    port: An integer for port binding. 0 picks a free port.
+  """
+
+  def __init__(self, dim=128, latency_ms=0, host='127.0.0.1', port=0):
+    self.dim = dim
+    self.latency_ms = latency_ms
+    self.httpd = ThreadingHTTPServer((host, port), self.make_handler())
+    self._thread = None
+
+  @property
+  def url(self):
+    host, port = self.httpd.server_address[:2]
+    return 'http://{}:{}/v1/models/t2t-code-search:predict'.format(host, port)
+
+  def embed(self, instance):
+    """Return the embedding of an instance, seeded by its contents."""
+    seed = zlib.crc32(json.dumps(instance, sort_keys=True).encode('utf-8')) & 0xffffffff
+    return np.random.RandomState(seed).randn(self.dim).tolist()
+
+  def make_handler(self):
+    stub = self
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        try:
+          instances = json.loads(body.decode('utf-8'))['instances']
+        except (ValueError, KeyError) as e:
+          self.respond(400, {'error': str(e)})
+          return
+
+        if stub.latency_ms:
+          time.sleep(stub.latency_ms / 1000.)
+        self.respond(200, {'predictions': [{'outputs': stub.embed(instance)}
+                                           for instance in instances]})
+
+      def respond(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self, *_args):  # pylint: disable=arguments-differ
+        pass
+
+    return Handler
+
+  def start(self):
+    """Serve requests in a background thread."""
+    self._thread = threading.Thread(target=self.httpd.serve_forever, name='stub-serving')
+    self._thread.daemon = True
+    self._thread.start()
+    logging.info("Serving stub embeddings at %s", self.url)
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+
+def embed_query(serving_url, query_str, session=None, timeout=None):
+  """Embed a query string with the TF Serving REST API.
+
+  The query is sent as its UTF-8 bytes, in place of the TF
+  Example encoded by the T2T problem, which a stub ignores.
+  """
+  data = {"instances": [{"input": {"b64": base64.b64encode(
+    query_str.encode('utf-8')).decode('utf-8')}}]}
+  response = (session or requests).post(url=serving_url, json=data, timeout=timeout)
+  response.raise_for_status()
+  return response.json()['predictions'][0]['outputs']
+
+
+def parse_arguments(argv=None):
+  parser = argparse.ArgumentParser(prog='Stub TF Serving')
+
+  parser.add_argument('--host', type=str, metavar='', default='0.0.0.0',
+                      help='Host to bind the server to')
+  parser.add_argument('--port', type=int, metavar='', default=8501,
+                      help='Port to bind the server to')
+  parser.add_argument('--embedding_dim', type=int, metavar='', default=128,
+                      help='Dimension of the embeddings, which must match the index')
+  parser.add_argument('--latency_ms', type=int, metavar='', default=0,
+                      help='Time in milliseconds to wait before answering a request, '
+                           'e.g. the inference time of the real model')
+
+  return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO,
+                      format=('%(levelname)s|%(asctime)s'
+                              '|%(pathname)s|%(lineno)d| %(message)s'),
+                      datefmt='%Y-%m-%dT%H:%M:%S',
+                      )
+  logging.getLogger().setLevel(logging.INFO)
+  stub_args = parse_arguments()
+  stub_serving = StubServing(dim=stub_args.embedding_dim, latency_ms=stub_args.latency_ms,
+                             host=stub_args.host, port=stub_args.port)
+  logging.info("Serving stub embeddings at %s", stub_serving.url)
+  stub_serving.httpd.serve_forever()
@@ -0,0 +1,78 @@
+"""Synthetic nmslib indexes and lookup data of any size."""
+import csv
+import logging
+import os
+import numpy as np
+
+from code_search.nmslib.search_engine import CodeSearchEngine
+
+# Words which synthetic function names, docstrings and queries are made of.
+WORDS = [
+  'get', 'set', 'read', 'write', 'parse', 'load', 'save', 'user', 'file', 'name', 'json',
+  'config', 'request', 'response', 'index', 'query', 'model', 'data', 'path', 'list',
+  'dict', 'string', 'number', 'server', 'client', 'cache', 'token', 'batch', 'update',
+  'delete', 'create', 'check', 'value', 'key', 'table', 'row', 'column', 'image', 'text',
+]
+
+
+def make_lookup_data(num_items, seed=0):
+  """Build lookup rows of synthetic functions.
+
+  Rows have the labels of `CodeSearchEngine.DICT_LABELS`, spread
+  over a hundred repositories and a few directories each.
+  """
+  rng = np.random.RandomState(seed)
+  rows = []
+  for i in range(num_items):
+    words = [WORDS[j] for j in rng.randint(len(WORDS), size=3)]
+    name = '{}_{}'.format('_'.join(words), i)
+    rows.append(['owner{}/repo{}'.format(i % 10, i % 100),
+                 'src/pkg{}/module{}.py'.format(i % 7, i % 13),
+                 name,
+                 str(i % 500 + 1),
+                 'def {}():\n  """{}."""\n  pass'.format(name, ' '.join(words).capitalize())])
+  return rows
+
+
+def make_embeddings(num_items, dim, seed=0):
+  """Build random embeddings of shape `[num_items, dim]`."""
+  return np.random.RandomState(seed).randn(num_items, dim).astype(np.float32)
+
+
+def make_queries(num_queries, seed=0, words_per_query=3):
+  """Build natural language queries of synthetic words."""
+  rng = np.random.RandomState(seed)
+  return [' '.join(WORDS[j] for j in rng.randint(len(WORDS), size=words_per_query))
+          for _ in range(num_queries)]
+
+
+def write_synthetic_index(output_dir, num_items, dim, index_params=None, seed=0):
+  """Build and save a synthetic index with its lookup CSV file.
+
+  The files can be served with `start_search_server` by passing
+  them as `--index_file` and `--lookup_file`.
+
+  Args:
+    output_dir: Directory to write `code.index` and `code.csv` to.
+    num_items: Number of items in the index.
+    dim: Dimension of the embeddings.
+    index_params: An optional dict of nmslib index time parameters.
+    seed: Seed of the random lookup data and embeddings.
+
+  Returns:
+    A tuple of the index file path, lookup file path and lookup rows.
+  """
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+  index_file = os.path.join(output_dir, 'code.index')
+  lookup_file = os.path.join(output_dir, 'code.csv')
+
+  rows = make_lookup_data(num_items, seed=seed)
+  with open(lookup_file, 'w') as lookup_csv_file:
+    csv.writer(lookup_csv_file).writerows(rows)
+
+  logging.info("Building a synthetic index of %d items of dimension %d", num_items, dim)
+  CodeSearchEngine.create_index(make_embeddings(num_items, dim, seed=seed), index_file,
+                                index_params=index_params, print_progress=False)
+  return index_file, lookup_file, rows
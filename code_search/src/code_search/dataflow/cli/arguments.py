@@ -46,6 +46,36 @@ def add_parser_arguments(parser):
                                    help='The BigQuery table containing the '
                                         'failed tokenize entry. This should be '
                                         'of the form PROJECT:DATASET.TABLE.')
+  additional_args_parser.add_argument('--fast_extraction', action='store_true',
+                      help=('Extract functions by slicing the original source '
+                            'and tokenize docstrings with the spaCy tokenizer alone. '
+                            'This also extracts async functions and methods of nested '
+                            'classes, and keeps comments in the function tokens.'))
+
+  additional_args_parser.add_argument('--dedupe_near_duplicates', action='store_true',
+                      help=('Keep only one function of each cluster of near-duplicate '
+                            'functions, found by MinHash LSH over the function tokens'))
+  additional_args_parser.add_argument('--near_duplicates_table', metavar='', type=str,
+                                   default='',
+                                   help='The BigQuery table mapping dropped near-duplicate '
+                                        'functions to the function kept for them. This should '
+                                        'be of the form PROJECT:DATASET.TABLE.')
+  additional_args_parser.add_argument('--pairs_format', metavar='', type=str, default='csv',
+                      choices=['csv', 'parquet'],
+                      help=('Format of the func-doc-pairs files written to --data_dir. '
+                            'Parquet needs pyarrow.'))
+  additional_args_parser.add_argument('--parquet_row_group_size', metavar='', type=int,
+                      default=10000,
+                      help='Number of rows of each row group of the Parquet files')
+  additional_args_parser.add_argument('--local_mode', action='store_true',
+                      help=('Tokenize --github_files with a local process pool instead '
+                            'of a Beam pipeline. Only the CSV files are written'))
+  additional_args_parser.add_argument('--local_processes', metavar='', type=int, default=0,
+                      help='Number of processes of --local_mode. 0 uses all cores')
+  additional_args_parser.add_argument('--local_chunk_size', metavar='', type=int,
+                      default=1000,
+                      help='Number of json records tokenized at once by each process '
+                           'of --local_mode')
 
   predict_args_parser = parser.add_argument_group('Batch Prediction Arguments')
   predict_args_parser.add_argument('--token_pairs_table', metavar='', type=str,
@@ -56,6 +86,14 @@ def add_parser_arguments(parser):
                                    help='The BigQuery table to write the '
                                         'function embeddings too. This should be '
                                         'of the form PROJECT:DATASET.TABLE.')
+  predict_args_parser.add_argument('--previous_function_embeddings_table', metavar='',
+                                   type=str, default='',
+                                   help='The function embeddings table of a previous run, '
+                                        'of the form PROJECT:DATASET.TABLE. If set, only '
+                                        'new or changed functions are embedded and the '
+                                        'embeddings of the others are carried forward. '
+                                        'Embeddings of another --saved_model_dir are '
+                                        'never reused.')
   predict_args_parser.add_argument('--problem', metavar='', type=str,
                                    help='Name of the T2T problem')
   predict_args_parser.add_argument('--data_dir', metavar='', type=str,
@@ -65,6 +103,25 @@ def add_parser_arguments(parser):
   predict_args_parser.add_argument('--output_dir', metavar='', type=str,
                                    help='Path to directory where the output '
                                         'should should be written.')
+  predict_args_parser.add_argument('--min_prediction_batch_size', metavar='', type=int,
+                                   default=1,
+                                   help='Minimum number of functions predicted at once')
+  predict_args_parser.add_argument('--max_prediction_batch_size', metavar='', type=int,
+                                   default=1000,
+                                   help='Maximum number of functions predicted at once')
+  predict_args_parser.add_argument('--target_prediction_batch_secs', metavar='', type=float,
+                                   default=1,
+                                   help='Target time in seconds to predict a batch of '
+                                        'functions. Batch sizes adapt to it within the '
+                                        'minimum and maximum batch sizes.')
+  predict_args_parser.add_argument('--embeddings_format', metavar='', type=str, default='csv',
+                                   choices=['csv', 'npy', 'parquet'],
+                                   help='Format of the embeddings written to --output_dir. '
+                                        '"csv" writes the embedding as text in the last '
+                                        'column, "npy" writes float32 .npy shards with '
+                                        'a metadata CSV file next to each shard and '
+                                        '"parquet" writes Parquet files with a float32 '
+                                        'list column. Parquet needs pyarrow.')
 
 def prepare_pipeline_opts(argv=None):
   """Prepare pipeline options from CLI arguments.
@@ -4,11 +4,15 @@ import logging
 import apache_beam as beam
 
 import code_search.dataflow.cli.arguments as arguments
+from code_search.dataflow import metrics
 from code_search.dataflow.transforms import bigquery
 import code_search.dataflow.transforms.github_bigquery as gh_bq
 import code_search.dataflow.transforms.github_dataset as github_dataset
 import code_search.dataflow.transforms.function_embeddings as func_embed
+import code_search.dataflow.transforms.parquet as parquet
 import code_search.dataflow.do_fns.dict_to_csv as dict_to_csv
+import code_search.dataflow.do_fns.dict_to_parquet as dict_to_parquet
+import code_search.dataflow.do_fns.function_embeddings as func_embeddings
 
 
 def create_function_embeddings(argv=None):
@@ -16,12 +20,20 @@ def create_function_embeddings(argv=None):
 
   At a high level, this pipeline does the following things:
     - Read the Processed Github Dataset from BigQuery
+    - Hash the function tokens with the SavedModel path. With
+      `--previous_function_embeddings_table`, functions whose hash is in
+      that table keep their previous embedding and only new or changed
+      functions, or all of them with another model, are embedded below
     - Encode the functions using T2T problem
     - Get function embeddings using `kubeflow_batch_predict.dataflow.batch_prediction`
     - All results are stored in a BigQuery dataset (`args.function_embeddings_table`)
     - See `transforms.github_dataset.GithubBatchPredict` for details of tables created
     - Additionally, store CSV of docstring, original functions and other metadata for
-      reverse index lookup during search engine queries.
+      reverse index lookup during search engine queries. With `--embeddings_format=npy`
+      the embeddings are instead stored as float32 `.npy` shards, each with a metadata
+      CSV file (see `transforms.function_embeddings.WriteFunctionEmbeddingShards`),
+      and with `--embeddings_format=parquet` as Parquet files with the embedding
+      in a float32 list column (see `transforms.parquet.WriteToParquet`).
 
   NOTE: The number of output file shards have been fixed (at 100) to avoid a large
   number of output files, making it manageable.
@@ -45,22 +57,49 @@ def create_function_embeddings(argv=None):
       | "Transform Github Dataset" >> github_dataset.TransformGithubDataset(None, None)
     )
 
-  embeddings = (token_pairs
-    | "Compute Function Embeddings" >> func_embed.FunctionEmbeddings(args.problem,
-                                                                     args.data_dir,
-                                                                     args.saved_model_dir)
+  token_pairs = (token_pairs
+    | "Hash Function Tokens" >> beam.ParDo(func_embeddings.HashFunctionTokens(
+        args.saved_model_dir))
   )
 
+  function_embeddings = func_embed.FunctionEmbeddings(
+    args.problem, args.data_dir, args.saved_model_dir,
+    min_batch_size=args.min_prediction_batch_size,
+    max_batch_size=args.max_prediction_batch_size,
+    target_batch_duration_secs=args.target_prediction_batch_secs)
+
+  if args.previous_function_embeddings_table:
+    previous_query = gh_bq.ReadPreviousFunctionEmbeddingsQuery(
+      args.previous_function_embeddings_table)
+    previous_source = beam.io.BigQuerySource(
+      query=previous_query.query_string, use_standard_sql=True)
+    previous_embeddings = (pipeline
+      | "Read Previous Function Embeddings" >> beam.io.Read(previous_source)
+    )
+    embeddings = (token_pairs
+      | "Compute Function Embeddings" >> func_embed.IncrementalFunctionEmbeddings(
+          previous_embeddings, function_embeddings)
+    )
+  else:
+    embeddings = (token_pairs
+      | "Compute Function Embeddings" >> function_embeddings
+    )
+
   function_embeddings_schema = bigquery.BigQuerySchema([
       ('nwo', 'STRING'),
       ('path', 'STRING'),
       ('function_name', 'STRING'),
       ('lineno', 'STRING'),
       ('original_function', 'STRING'),
-      ('function_embedding', 'STRING')
+      ('function_embedding', 'STRING'),
+      ('function_tokens_hash', 'STRING'),
     ])
 
-  (embeddings  # pylint: disable=expression-not-assigned
+  formatted_embeddings = (embeddings
+    | "Format Function Embeddings" >> beam.ParDo(func_embeddings.FormatFunctionEmbedding())
+  )
+
+  (formatted_embeddings  # pylint: disable=expression-not-assigned
     | "Save Function Embeddings" >>
        beam.io.WriteToBigQuery(table=args.function_embeddings_table,
                                schema=function_embeddings_schema.table_schema,
@@ -68,19 +107,43 @@ def create_function_embeddings(argv=None):
                                write_disposition=beam.io.BigQueryDisposition.WRITE_EMPTY)
   )
 
-  (embeddings  # pylint: disable=expression-not-assigned
-    | "Format for Embeddings CSV Write" >> beam.ParDo(dict_to_csv.DictToCSVString(
-        ['nwo', 'path', 'function_name', 'lineno', 'original_function', 'function_embedding']))
-    | "Write Embeddings to CSV" >> beam.io.WriteToText('{}/func-index'.format(args.output_dir),
-                                                       file_name_suffix='.csv',
-                                                       num_shards=100)
-  )
+  if args.embeddings_format == 'npy':
+    (embeddings  # pylint: disable=expression-not-assigned
+      | "Write Embeddings Shards" >> func_embed.WriteFunctionEmbeddingShards(
+          '{}/func'.format(args.output_dir),
+          ['nwo', 'path', 'function_name', 'lineno', 'original_function'],
+          num_shards=100)
+    )
+  elif args.embeddings_format == 'parquet':
+    (embeddings  # pylint: disable=expression-not-assigned
+      | "Write Embeddings Parquet" >> parquet.WriteToParquet(
+          '{}/func-index'.format(args.output_dir),
+          [('nwo', dict_to_parquet.STRING),
+           ('path', dict_to_parquet.STRING),
+           ('function_name', dict_to_parquet.STRING),
+           ('lineno', dict_to_parquet.STRING),
+           ('original_function', dict_to_parquet.STRING),
+           ('function_embedding', dict_to_parquet.FLOAT32_LIST)],
+          num_shards=100,
+          row_group_size=args.parquet_row_group_size)
+    )
+  else:
+    (formatted_embeddings  # pylint: disable=expression-not-assigned
+      | "Format for Embeddings CSV Write" >> beam.ParDo(dict_to_csv.DictToCSVString(
+          ['nwo', 'path', 'function_name', 'lineno', 'original_function',
+           'function_embedding']))
+      | "Write Embeddings to CSV" >> beam.io.WriteToText('{}/func-index'.format(args.output_dir),
+                                                         file_name_suffix='.csv',
+                                                         num_shards=100)
+    )
 
   result = pipeline.run()
   logging.info("Submitted Dataflow job: %s", result)
   # TODO(jlewi): Doesn't dataflow define a default option.
   if args.wait_until_finished:
     result.wait_until_finish()
+    logging.info("Stage metrics:\n%s", metrics.format_stage_report(
+      metrics.stage_report(result.metrics().query())))
 
 
 if __name__ == '__main__':
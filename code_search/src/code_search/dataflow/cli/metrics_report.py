@@ -0,0 +1,77 @@
+"""Report the per-stage metrics of a finished code search Dataflow job."""
+import argparse
+import collections
+import json
+import logging
+
+import apache_beam.options.pipeline_options as pipeline_options
+from apache_beam.runners.dataflow.dataflow_metrics import DataflowMetrics
+from apache_beam.runners.dataflow.dataflow_runner import DataflowPipelineResult
+from apache_beam.runners.dataflow.internal import apiclient
+from code_search.dataflow import metrics
+
+# DataflowMetrics translates the internal step names of a job
+# with the `proto.steps` of its job graph.
+JobGraph = collections.namedtuple('JobGraph', ['proto'])
+
+
+def parse_arguments(argv=None):
+  parser = argparse.ArgumentParser(prog='Dataflow Job Metrics Report')
+
+  parser.add_argument('--job_id', type=str, metavar='', required=True,
+                      help='Id of a finished Dataflow job')
+  parser.add_argument('--project', type=str, metavar='', required=True,
+                      help='GCP project of the job')
+  parser.add_argument('--region', type=str, metavar='', default='us-central1',
+                      help='Region of the job')
+  parser.add_argument('--output_file', type=str, metavar='', default='',
+                      help='Path to also write the report to as JSON')
+
+  return parser.parse_args(argv)
+
+
+def get_job_metrics(project, region, job_id):
+  """Query the metrics of a finished Dataflow job.
+
+  Returns:
+    The metrics in the same form as `PipelineResult.metrics().query()`.
+  """
+  options = pipeline_options.PipelineOptions(['--project', project, '--region', region])
+  client = apiclient.DataflowApplicationClient(options)
+
+  # The job is fetched with all its steps, which name the metrics.
+  request = apiclient.dataflow.DataflowProjectsLocationsJobsGetRequest(
+    jobId=job_id, location=region, projectId=project,
+    view=apiclient.dataflow.DataflowProjectsLocationsJobsGetRequest.ViewValueValuesEnum.JOB_VIEW_ALL)
+  job = client._client.projects_locations_jobs.Get(request)  # pylint: disable=protected-access
+
+  result = DataflowPipelineResult(job, None)
+  return DataflowMetrics(client, result, JobGraph(job)).query()
+
+
+def report_job_metrics(argv=None):
+  """Print the per-stage report of a finished job, see `metrics.stage_report`.
+
+  Stages are listed by decreasing share of the time spent on
+  elements, so the first ones are those to scale.
+  """
+  args = parse_arguments(argv)
+
+  report = metrics.stage_report(get_job_metrics(args.project, args.region, args.job_id))
+  print(metrics.format_stage_report(report))
+
+  if args.output_file:
+    with open(args.output_file, 'w') as output_file:
+      json.dump(report, output_file, indent=2, sort_keys=True)
+
+  return report
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO,
+                      format=('%(levelname)s|%(asctime)s'
+                              '|%(pathname)s|%(lineno)d| %(message)s'),
+                      datefmt='%Y-%m-%dT%H:%M:%S',
+                      )
+  logging.getLogger().setLevel(logging.INFO)
+  report_job_metrics()
@@ -1,11 +1,25 @@
+import collections
 import logging
 import json
+import multiprocessing
 
 import apache_beam as beam
+from apache_beam import pvalue
+from apache_beam.io.filesystems import FileSystems
+from apache_beam.metrics.metric import MetricResults
+from apache_beam.runners.runner import PipelineResult, PipelineState
 import code_search.dataflow.cli.arguments as arguments
+from code_search.dataflow import metrics
 import code_search.dataflow.transforms.github_bigquery as gh_bq
 import code_search.dataflow.transforms.github_dataset as github_dataset
+import code_search.dataflow.transforms.parquet as parquet
+from code_search.dataflow.transforms.near_duplicates import NearDuplicateFunctions
 import code_search.dataflow.do_fns.dict_to_csv as dict_to_csv
+import code_search.dataflow.do_fns.dict_to_parquet as dict_to_parquet
+import code_search.dataflow.do_fns.github_dataset as gh_do_fns
+
+NUM_OUTPUT_SHARDS = 100
+PAIRS_CSV_FIELDS = ['docstring_tokens', 'function_tokens']
 
 class JsonCoder(object):
   """A JSON coder interpreting each line as a JSON string."""
@@ -16,6 +30,32 @@ class JsonCoder(object):
   def decode(self, x): # pylint: disable=no-self-use
     return json.loads(x)
 
+class LocalMetricResults(MetricResults):
+  """The metrics of `--local_mode`, which does not report any."""
+
+  def query(self, filter=None):  # pylint: disable=redefined-builtin
+    return {'counters': [], 'distributions': [], 'gauges': []}
+
+
+class LocalPipelineResult(PipelineResult):
+  """The result of `--local_mode`, which is done once it is returned.
+
+  Args:
+    paths: A list of the paths of the CSV shards.
+  """
+
+  def __init__(self, paths):
+    super(LocalPipelineResult, self).__init__(PipelineState.DONE)
+
+    self.paths = paths
+
+  def wait_until_finish(self, duration=None):
+    return self.state
+
+  def metrics(self):
+    return LocalMetricResults()
+
+
 def preprocess_github_dataset(argv=None):
   """Apache Beam pipeline for pre-processing Github dataset.
 
@@ -24,16 +64,27 @@ def preprocess_github_dataset(argv=None):
     - If Github Python files have already been processed, use the
       pre-processed table instead (using flag `--pre-transformed`)
     - Tokenize files into pairs of function definitions and docstrings
+    - Optionally drop near-duplicate functions (using flag `--dedupe_near_duplicates`)
     - See `transforms.github_dataset.TransformGithubDataset` for details of tables created
     - Additionally, store pairs of docstring and function tokens in a CSV file
-      for training
+      for training, or in a Parquet file with `--pairs_format=parquet`
 
   NOTE: The number of output file shards have been fixed (at 100) to avoid a large
   number of output files, making it manageable.
+
+  With `--local_mode`, the `--github_files` are instead tokenized by
+  a local process pool, see `preprocess_github_files_locally`.
+
+  Returns:
+    The PipelineResult of the pipeline, or a `LocalPipelineResult`
+    with `--local_mode`.
   """
   pipeline_opts = arguments.prepare_pipeline_opts(argv)
   args = pipeline_opts._visible_options  # pylint: disable=protected-access
 
+  if args.local_mode:
+    return LocalPipelineResult(preprocess_github_files_locally(args))
+
   pipeline = beam.Pipeline(options=pipeline_opts)
 
   if args.pre_transformed:
@@ -41,6 +92,10 @@ def preprocess_github_dataset(argv=None):
       | "Read Transformed Github Dataset" >> gh_bq.ReadTransformedGithubDataset(
         args.project, dataset=args.target_dataset)
     )
+    if args.dedupe_near_duplicates:
+      token_pairs = (token_pairs
+        | "Dedupe Near Duplicates" >> NearDuplicateFunctions(args.near_duplicates_table)
+      )
   else:
     if args.github_files:
       logging.info("Will read the GitHub data from %s", args.github_files)
@@ -59,24 +114,151 @@ def preprocess_github_dataset(argv=None):
         | "Read Github Dataset" >> gh_bq.ReadGithubDataset(args.project))
     token_pairs = (input_records
       | "Transform Github Dataset" >> github_dataset.TransformGithubDataset(
-                args.token_pairs_table, args.failed_tokenize_table)
+                args.token_pairs_table, args.failed_tokenize_table,
+                fast_extraction=args.fast_extraction,
+                dedupe_near_duplicates=args.dedupe_near_duplicates,
+                near_duplicates_table=args.near_duplicates_table)
     )
 
-  (token_pairs  # pylint: disable=expression-not-assigned
-    | "Format for CSV Write" >> beam.ParDo(dict_to_csv.DictToCSVString(
-      ['docstring_tokens', 'function_tokens']))
-    | "Write CSV" >> beam.io.WriteToText('{}/func-doc-pairs'.format(args.data_dir),
-                                         file_name_suffix='.csv',
-                                         num_shards=100)
-  )
+  if args.pairs_format == 'parquet':
+    (token_pairs  # pylint: disable=expression-not-assigned
+      | "Write Parquet" >> parquet.WriteToParquet(
+        '{}/func-doc-pairs'.format(args.data_dir),
+        [(key, dict_to_parquet.STRING) for key in PAIRS_CSV_FIELDS],
+        num_shards=NUM_OUTPUT_SHARDS,
+        row_group_size=args.parquet_row_group_size)
+    )
+  else:
+    (token_pairs  # pylint: disable=expression-not-assigned
+      | "Format for CSV Write" >> beam.ParDo(dict_to_csv.DictToCSVString(PAIRS_CSV_FIELDS))
+      | "Write CSV" >> beam.io.WriteToText('{}/func-doc-pairs'.format(args.data_dir),
+                                           file_name_suffix='.csv',
+                                           num_shards=NUM_OUTPUT_SHARDS)
+    )
 
   result = pipeline.run()
   logging.info("Submitted Dataflow job: %s", result)
   if args.wait_until_finished:
     result.wait_until_finish()
+    logging.info("Stage metrics:\n%s", metrics.format_stage_report(
+      metrics.stage_report(result.metrics().query())))
 
   return result
 
+
+def read_line_chunks(file_pattern, chunk_size):
+  """Read the lines of the files matching a pattern in lists of `chunk_size`."""
+  chunk = []
+  for match in FileSystems.match([file_pattern])[0].metadata_list:
+    with FileSystems.open(match.path) as input_file:
+      for line in input_file:
+        if not line.strip():
+          continue
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+          yield chunk
+          chunk = []
+  if chunk:
+    yield chunk
+
+
+def tokenize_lines(lines, fast_extraction=False):
+  """Tokenize a chunk of GitHub dataset json records into CSV rows.
+
+  This runs the DoFns of `TransformGithubDataset` on each record,
+  so the rows are the same as the ones of the pipeline.
+
+  Returns:
+    A tuple of the list of CSV rows and the number of records
+    which failed to tokenize.
+  """
+  coder = JsonCoder()
+  split_repo_path = gh_do_fns.SplitRepoPath()
+  tokenize = gh_do_fns.TokenizeFunctionDocstrings(fast_extraction=fast_extraction)
+  to_csv = dict_to_csv.DictToCSVString(PAIRS_CSV_FIELDS)
+
+  csv_rows = []
+  num_errors = 0
+  for line in lines:
+    for element in split_repo_path.process(coder.decode(line)):
+      for result in tokenize.process(element):
+        if isinstance(result, pvalue.TaggedOutput):
+          num_errors += 1
+          continue
+        for row in result:
+          if len(row['docstring_tokens'].split(' ')) > github_dataset.MIN_DOCSTRING_TOKENS:
+            csv_rows.extend(to_csv.process(row))
+  return csv_rows, num_errors
+
+
+def tokenize_chunks(pool, chunks, max_pending, fast_extraction=False):
+  """Yield the results of `tokenize_lines` for each chunk in order.
+
+  At most `max_pending` chunks are submitted to the pool at once.
+  """
+  pending = collections.deque()
+  for chunk in chunks:
+    pending.append(pool.apply_async(tokenize_lines, (chunk, fast_extraction)))
+    if len(pending) >= max_pending:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+
+def preprocess_github_files_locally(args):
+  """Tokenize `--github_files` with a local process pool.
+
+  This writes the same `func-doc-pairs` CSV shards as the pipeline,
+  without starting a Beam runner. Files are read in chunks of
+  `--local_chunk_size` records, which are tokenized by
+  `--local_processes` processes (all cores by default). At most two
+  chunks per process are in flight, which bounds the memory used.
+  Output rows are spread round-robin over the shards. Nothing is
+  written to BigQuery.
+
+  Returns:
+    A list of the paths of the CSV shards.
+  """
+  if not args.github_files:
+    raise ValueError('--local_mode needs --github_files')
+  if args.dedupe_near_duplicates:
+    raise ValueError('--dedupe_near_duplicates is not supported with --local_mode')
+  if args.pairs_format != 'csv':
+    raise ValueError('--local_mode only writes CSV files')
+  for flag in ['token_pairs_table', 'failed_tokenize_table']:
+    if getattr(args, flag):
+      raise ValueError('--{} is not supported with --local_mode'.format(flag))
+
+  num_processes = args.local_processes or multiprocessing.cpu_count()
+  logging.info("Tokenizing %s with %d local processes", args.github_files, num_processes)
+
+  paths = ['{}/func-doc-pairs-{:05d}-of-{:05d}.csv'.format(args.data_dir, shard,
+                                                          NUM_OUTPUT_SHARDS)
+           for shard in range(NUM_OUTPUT_SHARDS)]
+  output_files = [FileSystems.create(path) for path in paths]
+
+  num_rows = 0
+  num_errors = 0
+  pool = multiprocessing.Pool(num_processes)
+  try:
+    chunks = read_line_chunks(args.github_files, args.local_chunk_size)
+    for rows, errors in tokenize_chunks(pool, chunks, 2 * num_processes,
+                                        args.fast_extraction):
+      for row in rows:
+        output_files[num_rows % NUM_OUTPUT_SHARDS].write(row + b'\n')
+        num_rows += 1
+      num_errors += errors
+  finally:
+    pool.close()
+    pool.join()
+    for output_file in output_files:
+      output_file.close()
+
+  logging.info("Wrote %d rows to %s, %d files failed to tokenize", num_rows,
+               args.data_dir, num_errors)
+  return paths
+
+
 if __name__ == '__main__':
   logging.basicConfig(level=logging.INFO,
                       format=('%(levelname)s|%(asctime)s'
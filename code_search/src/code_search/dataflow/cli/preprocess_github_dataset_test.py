@@ -4,6 +4,9 @@ import unittest
 import os
 import tempfile
 
+from apache_beam.runners.runner import PipelineState
+
+from code_search.dataflow import metrics
 from code_search.dataflow.cli import preprocess_github_dataset
 
 class TestPreprocess(unittest.TestCase):
@@ -30,8 +33,57 @@ class TestPreprocess(unittest.TestCase):
 
     self.assertGreater(num_output_shards, 0)
     self.assertGreater(num_output, 0)
+
+    report = {stage['stage']: stage
+              for stage in metrics.stage_report(result.metrics().query())}
+    self.assertEqual(report['SplitRepoPath']['elements_in'],
+                     report['TokenizeFunctionDocstrings']['elements_in'])
+    self.assertGreater(report['TokenizeFunctionDocstrings']['mean_ast_parse_ms'], 0)
+    self.assertEqual(report['DictToCSVString']['elements_out'], num_output)
     logging.info("Done")
 
+  def test_local_mode(self):
+    data_dir = os.path.join(
+      os.path.dirname(__file__), "test_data")
+    data_file = os.path.join(data_dir, "sample.json")
+
+    pipeline_dir = tempfile.mkdtemp()
+    preprocess_github_dataset.preprocess_github_dataset(
+      ["--github_files=" + data_file,
+       "--data_dir=" + pipeline_dir]).wait_until_finish()
+
+    local_dir = tempfile.mkdtemp()
+    logging.info("Using out directory: %s", local_dir)
+    result = preprocess_github_dataset.preprocess_github_dataset(
+      ["--github_files=" + data_file,
+       "--data_dir=" + local_dir,
+       "--local_mode",
+       "--local_processes=2",
+       "--local_chunk_size=3"])
+
+    self.assertEqual(result.wait_until_finish(), PipelineState.DONE)
+    self.assertEqual(len(result.paths), 100)
+    self.assertEqual(metrics.stage_report(result.metrics().query()), [])
+
+    def read_rows(out_dir):
+      rows = []
+      for f in glob.glob(os.path.join(out_dir, "*.csv")):
+        with open(f) as hf:
+          rows.extend(hf.readlines())
+      return sorted(rows)
+
+    local_rows = read_rows(local_dir)
+    self.assertGreater(len(local_rows), 0)
+    self.assertEqual(local_rows, read_rows(pipeline_dir))
+
+    for flag in ["--token_pairs_table", "--failed_tokenize_table"]:
+      with self.assertRaises(ValueError):
+        preprocess_github_dataset.preprocess_github_dataset(
+          ["--github_files=" + data_file,
+           "--data_dir=" + local_dir,
+           "--local_mode",
+           flag + "=project:dataset.table"])
+
 if __name__ == "__main__":
   logging.basicConfig(level=logging.INFO,
                       format=('%(levelname)s|%(asctime)s'
@@ -1,6 +1,8 @@
 import csv
 import io
+import time
 import apache_beam as beam
+from code_search.dataflow import metrics
 
 
 class DictToCSVString(beam.DoFn):
@@ -17,6 +19,8 @@ class DictToCSVString(beam.DoFn):
 
     self.fieldnames = fieldnames
 
+    self.metrics = metrics.StageMetrics(DictToCSVString)
+
   def process(self, element, *_args, **_kwargs):
     """Convert a Python dict instance into CSV string.
 
@@ -36,6 +40,9 @@ class DictToCSVString(beam.DoFn):
     Yields:
       A string representing the row in CSV format.
     """
+    start = time.time()
+    self.metrics.elements_in.inc()
+
     fieldnames = self.fieldnames
     filtered_element = {
       key: value.encode('utf-8')
@@ -47,4 +54,7 @@ class DictToCSVString(beam.DoFn):
       writer.writerow(filtered_element)
       csv_string = stream.getvalue().strip('\r\n')
 
+    self.metrics.update_latency(start)
+    self.metrics.elements_out.inc()
+    self.metrics.bytes_out.inc(len(csv_string))
     yield csv_string
@@ -0,0 +1,128 @@
+"""Beam DoFns to write Python dicts to Parquet files."""
+
+import itertools
+import zlib
+import apache_beam as beam
+from apache_beam.io.filesystems import FileSystems
+import numpy as np
+
+STRING = 'string'
+FLOAT32_LIST = 'float32_list'
+
+
+def to_arrow_table(rows, schema):
+  """Convert a list of dicts into an Arrow table with typed columns.
+
+  Args:
+    rows: A list of dicts with a value for every key of the schema.
+    schema: A list of tuples of a key and its column type. `STRING`
+            columns hold unicode strings and `FLOAT32_LIST` columns
+            hold lists of floats, e.g. a function embedding.
+  """
+  # Imported here as pyarrow is only needed for Parquet output.
+  import pyarrow as pa
+
+  arrays = []
+  for key, column_type in schema:
+    if column_type == FLOAT32_LIST:
+      vectors = [np.asarray(row[key], dtype=np.float32) for row in rows]
+      offsets = np.cumsum([0] + [len(vector) for vector in vectors]).astype(np.int32)
+      values = np.concatenate(vectors) if vectors else np.zeros(0, dtype=np.float32)
+      arrays.append(pa.ListArray.from_arrays(pa.array(offsets), pa.array(values)))
+    else:
+      arrays.append(pa.array([row[key] for row in rows], type=pa.string()))
+  return pa.Table.from_arrays(arrays, names=[key for key, _ in schema])
+
+
+class KeyByEmbeddingShard(beam.DoFn):
+  """Key function embeddings by the output shard they belong to.
+
+  The shard is a hash of the function's location, so that
+  every run assigns a function to the same shard.
+
+  Args:
+    num_shards: Total number of output shards.
+  """
+  def __init__(self, num_shards):
+    super(KeyByEmbeddingShard, self).__init__()
+
+    self.num_shards = num_shards
+
+  @property
+  def location_keys(self):
+    return ['nwo', 'path', 'function_name', 'lineno']
+
+  def process(self, element, *_args, **_kwargs):
+    location = u'/'.join(element[key] for key in self.location_keys)
+    shard = (zlib.crc32(location.encode('utf-8')) & 0xffffffff) % self.num_shards
+    yield shard, element
+
+
+class WriteParquetShard(beam.DoFn):
+  """Write a shard of dicts as a Parquet file.
+
+  Rows are streamed to the file in row groups of `row_group_size`
+  rows, so a worker only holds one row group in memory. Each row
+  group is sorted by its string columns and converted to typed
+  Arrow columns at once. The file name only depends on the shard
+  number, so a retried bundle overwrites the file of its previous
+  attempt.
+
+    <file_path_prefix>-<shard>-of-<num_shards>.parquet
+
+  Args:
+    file_path_prefix: Path prefix of the output files.
+    schema: A list of tuples of a key and its column type, see `to_arrow_table`.
+    num_shards: Total number of output shards.
+    row_group_size: Number of rows of a Parquet row group.
+  """
+  def __init__(self, file_path_prefix, schema, num_shards, row_group_size=10000):
+    super(WriteParquetShard, self).__init__()
+
+    self.file_path_prefix = file_path_prefix
+    self.schema = schema
+    self.num_shards = num_shards
+    self.row_group_size = row_group_size
+
+  def shard_path(self, shard):
+    return '{}-{:05d}-of-{:05d}.parquet'.format(self.file_path_prefix, shard, self.num_shards)
+
+  def row_groups(self, rows):
+    """Yield the sorted row groups of an iterable of dicts."""
+    sort_keys = [key for key, column_type in self.schema if column_type == STRING]
+    rows = iter(rows)
+    while True:
+      row_group = list(itertools.islice(rows, self.row_group_size))
+      if not row_group:
+        return
+      yield sorted(row_group, key=lambda row: [row[key] for key in sort_keys])
+
+  def process(self, element, *_args, **_kwargs):
+    """Write the Parquet file of one shard.
+
+    Args:
+      element: A tuple of the shard number and an iterable of dicts.
+
+    Yields:
+      The path of the Parquet file.
+    """
+    # Imported here as pyarrow is only needed for Parquet output.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    shard, rows = element
+    path = self.shard_path(shard)
+    parquet_file = FileSystems.create(path)
+    writer = None
+    try:
+      for row_group in self.row_groups(rows):
+        table = to_arrow_table(row_group, self.schema)
+        if writer is None:
+          writer = pq.ParquetWriter(pa.PythonFile(parquet_file, mode='w'), table.schema)
+        writer.write_table(table)
+    finally:
+      if writer is not None:
+        writer.close()
+      parquet_file.close()
+
+    yield path
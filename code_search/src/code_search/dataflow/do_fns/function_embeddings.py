@@ -1,8 +1,29 @@
 """Beam DoFns specific to `code_search.dataflow.transforms.function_embeddings`."""
 
+import csv
+import hashlib
+import io
+import logging
+import time
 import apache_beam as beam
+from apache_beam.io.filesystems import FileSystems
+from apache_beam.utils.windowed_value import WindowedValue
+import numpy as np
 
-from code_search.t2t.query import get_encoder, encode_query
+from code_search.dataflow import metrics
+from code_search.t2t.query import get_encoder, encode_queries
+
+
+# Encoders loaded by this worker process, keyed by problem and data directory.
+_ENCODERS = {}
+
+
+def get_cached_encoder(problem, data_dir):
+  """Load the encoder of a T2T problem once per worker process."""
+  key = (problem, data_dir)
+  if key not in _ENCODERS:
+    _ENCODERS[key] = get_encoder(problem, data_dir)
+  return _ENCODERS[key]
 
 
 class EncodeFunctionTokens(beam.DoFn):
@@ -11,15 +32,29 @@ class EncodeFunctionTokens(beam.DoFn):
   This DoFn prepares the function tokens for
   inference by a SavedModel estimator downstream.
 
+  The encoder is loaded once per worker process and
+  elements are buffered and encoded `batch_size` at a
+  time, with the rest of the buffer encoded at the end
+  of the bundle. Subword ids of tokens are memoized
+  across bundles, see `encode_queries`.
+
   Args:
     problem: A string representing the registered Tensor2Tensor Problem.
     data_dir: A string representing the path to data directory.
+    batch_size: Maximum number of elements encoded at once.
   """
-  def __init__(self, problem, data_dir):
+  def __init__(self, problem, data_dir, batch_size=1000):
     super(EncodeFunctionTokens, self).__init__()
 
     self.problem = problem
     self.data_dir = data_dir
+    self.batch_size = batch_size
+
+    self.encoder = None
+    self.subword_cache = {}
+    self.buffer = []
+
+    self.metrics = metrics.StageMetrics(EncodeFunctionTokens)
 
   @property
   def function_tokens_key(self):
@@ -29,7 +64,12 @@ class EncodeFunctionTokens(beam.DoFn):
   def instances_key(self):
     return u'instances'
 
-  def process(self, element, *_args, **_kwargs):
+  def start_bundle(self):
+    self.encoder = get_cached_encoder(self.problem, self.data_dir)
+    self.buffer = []
+
+  def process(self, element, timestamp=beam.DoFn.TimestampParam,
+              window=beam.DoFn.WindowParam, *_args, **_kwargs):
     """Encode the function instance.
 
     This DoFn takes a tokenized function string and
@@ -70,15 +110,273 @@ class EncodeFunctionTokens(beam.DoFn):
             }
           ]
         }
+      for every element of the buffer once it is full.
     """
-    encoder = get_encoder(self.problem, self.data_dir)
-    encoded_function = encode_query(encoder, True,
-                                    element.get(self.function_tokens_key))
+    self.metrics.elements_in.inc()
+    self.buffer.append(WindowedValue(element, timestamp, [window]))
+    if len(self.buffer) >= self.batch_size:
+      for windowed_value in self.flush():
+        yield windowed_value
+
+  def finish_bundle(self):
+    for windowed_value in self.flush():
+      yield windowed_value
+
+  def flush(self):
+    """Encode the buffered elements and return them."""
+    buffer, self.buffer = self.buffer, []
+    if not buffer:
+      return buffer
 
-    element[self.instances_key] = [{'input': {'b64': encoded_function}}]
+    start = time.time()
+    function_tokens = [windowed_value.value.get(self.function_tokens_key)
+                       for windowed_value in buffer]
+    encoded_functions = encode_queries(self.encoder, True, function_tokens,
+                                       cache=self.subword_cache)
+    for windowed_value, encoded_function in zip(buffer, encoded_functions):
+      windowed_value.value[self.instances_key] = [{'input': {'b64': encoded_function}}]
+
+    self.metrics.update_latency(start, len(buffer))
+    self.metrics.elements_out.inc(len(buffer))
+    self.metrics.bytes_in.inc(sum(metrics.utf8_size(tokens or u'') for tokens in function_tokens))
+    self.metrics.bytes_out.inc(sum(len(encoded) for encoded in encoded_functions))
+    return buffer
+
+
+class HashFunctionTokens(beam.DoFn):
+  """Add a stable hash of the function tokens and the model to each element.
+
+  Functions whose tokens did not change between two runs with
+  the same model have the same hash, so their embeddings can be
+  carried forward. The embeddings of a run with another model
+  never match.
+
+  Args:
+    model_key: A string identifying the model which embeds the
+      functions, e.g. the path of its SavedModel.
+  """
+  def __init__(self, model_key):
+    super(HashFunctionTokens, self).__init__()
+
+    self.model_key = model_key
+
+  @property
+  def function_tokens_key(self):
+    return u'function_tokens'
+
+  @property
+  def function_tokens_hash_key(self):
+    return u'function_tokens_hash'
+
+  def process(self, element, *_args, **_kwargs):
+    """Hash the function tokens.
+
+    Args:
+      element: A Python dict with a "function_tokens" string.
+
+    Yields:
+      The Python dict with a "function_tokens_hash" key set to the
+      hex SHA-1 digest of the UTF-8 model key and function tokens.
+    """
+    function_tokens = element.get(self.function_tokens_key) or u''
+    digest = hashlib.sha1(self.model_key.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(function_tokens.encode('utf-8'))
+    element[self.function_tokens_hash_key] = digest.hexdigest().decode('utf-8')
     yield element
 
 
+class CarryForwardEmbeddings(beam.DoFn):
+  """Reuse the embeddings of a previous run for unchanged functions.
+
+  This processes the result of a `beam.CoGroupByKey` on the
+  function tokens hash of the current elements and of the
+  embeddings of a previous run. Elements with a previous
+  embedding are output to the `unchanged` tag in the same
+  form as `ProcessFunctionEmbedding` outputs, the comma-separated
+  previous embedding parsed into a list of floats. The others
+  are output to the main output to be embedded.
+  """
+
+  UNCHANGED_TAG = 'unchanged'
+
+  @property
+  def function_embedding_key(self):
+    return 'function_embedding'
+
+  @property
+  def pop_keys(self):
+    return [
+      'docstring_tokens',
+      'function_tokens',
+    ]
+
+  def process(self, element, *_args, **_kwargs):
+    """Split elements by whether they have a previous embedding.
+
+    Args:
+      element: A tuple of the function tokens hash and a dict of the form,
+        {
+          "current": [DICT, DICT, ...],
+          "previous": [
+            {
+              "function_tokens_hash": "STRING",
+              "function_embedding": "STRING",
+            },
+            ...
+          ],
+        }
+
+    Yields:
+      The current elements, to the `unchanged` tag with the previous
+      embedding if there is one and to the main output otherwise.
+    """
+    _, grouped = element
+    previous = list(grouped['previous'])
+
+    for current in grouped['current']:
+      if not previous:
+        yield current
+        continue
+
+      current[self.function_embedding_key] = [
+        float(val) for val in previous[0][self.function_embedding_key].split(',')
+      ]
+      current['lineno'] = str(current['lineno']).decode('utf-8')
+      for key in self.pop_keys:
+        current.pop(key, None)
+      yield beam.pvalue.TaggedOutput(self.UNCHANGED_TAG, current)
+
+
+class CombineInstances(beam.DoFn):
+  """Combine a batch of encoded elements into one prediction request.
+
+  The instances of all elements of a batch from `beam.BatchElements`
+  are concatenated into a single "instances" list, so that
+  `PredictionDoFn` runs the model once per batch. The elements
+  themselves are kept under the "elements" key to be split back
+  by `SplitPredictions`.
+  """
+
+  @property
+  def instances_key(self):
+    return u'instances'
+
+  @property
+  def elements_key(self):
+    return u'elements'
+
+  def process(self, element, *_args, **_kwargs):
+    """Combine a list of elements.
+
+    Args:
+      element: A list of Python dicts as output by `EncodeFunctionTokens`.
+
+    Yields:
+      A Python dict of the form,
+        {
+          "instances": [INSTANCE, INSTANCE, ...],
+          "elements": [DICT, DICT, ...],
+        }
+      with one instance per element, the element dicts
+      without their "instances" key.
+    """
+    instances = []
+    for batch_element in element:
+      instances.extend(batch_element.pop(self.instances_key))
+    yield {self.instances_key: instances, self.elements_key: element}
+
+
+class SplitPredictions(beam.DoFn):
+  """Fan out the predictions of a batch to the elements of the batch.
+
+  This is the inverse of `CombineInstances` applied after
+  `PredictionDoFn`. Every element gets back its own instance and
+  prediction, as if it had been predicted on its own.
+  """
+
+  @property
+  def instances_key(self):
+    return u'instances'
+
+  @property
+  def elements_key(self):
+    return u'elements'
+
+  @property
+  def predictions_key(self):
+    return 'predictions'
+
+  def process(self, element, *_args, **_kwargs):
+    """Split a batch of predictions.
+
+    Args:
+      element: A Python dict of the form,
+        {
+          "instances": [INSTANCE, INSTANCE, ...],
+          "elements": [DICT, DICT, ...],
+          "predictions": [PREDICTION, PREDICTION, ...],
+        }
+
+    Yields:
+      Each dict in "elements" updated with its instance
+      and prediction, in the same form as elements predicted
+      one at a time by `PredictionDoFn`.
+    """
+    for batch_element, instance, prediction in zip(element[self.elements_key],
+                                                   element[self.instances_key],
+                                                   element[self.predictions_key]):
+      batch_element[self.instances_key] = [instance]
+      batch_element[self.predictions_key] = [prediction]
+      yield batch_element
+
+
+class RetryFailedBatch(beam.DoFn):
+  """Split a batch whose prediction failed to retry its elements one by one.
+
+  `PredictionDoFn` outputs a failed request to its "errors" tag,
+  so one bad element would drop its whole batch. The elements of
+  a failed batch are output as batches of one, in the same form
+  as `CombineInstances` outputs, to be predicted again. A failed
+  batch of one element is dropped and counted in the
+  `failed_predictions` metric.
+  """
+  def __init__(self):
+    super(RetryFailedBatch, self).__init__()
+
+    self.failed_predictions = beam.metrics.Metrics.counter(
+      RetryFailedBatch, metrics.FAILED_PREDICTIONS)
+
+  @property
+  def instances_key(self):
+    return u'instances'
+
+  @property
+  def elements_key(self):
+    return u'elements'
+
+  def process(self, element, *_args, **_kwargs):
+    """Split a failed batch.
+
+    Args:
+      element: A tuple of the error detail and the failed request
+        as output by `CombineInstances`.
+
+    Yields:
+      A request for each element of the batch if it has more than one.
+    """
+    error_detail, batch = element
+    elements = batch[self.elements_key]
+    if len(elements) == 1:
+      logging.warning("Dropping the function %s after a failed prediction: %s",
+                      elements[0].get('function_name'), error_detail)
+      self.failed_predictions.inc()
+      return
+
+    for batch_element, instance in zip(elements, batch[self.instances_key]):
+      yield {self.instances_key: [instance], self.elements_key: [batch_element]}
+
+
 class ProcessFunctionEmbedding(beam.DoFn):
   """Process results from PredictionDoFn.
 
@@ -87,6 +385,11 @@ class ProcessFunctionEmbedding(beam.DoFn):
   returned by the PredictionDoFn.
   """
 
+  def __init__(self):
+    super(ProcessFunctionEmbedding, self).__init__()
+
+    self.metrics = metrics.StageMetrics(ProcessFunctionEmbedding)
+
   @property
   def function_embedding_key(self):
     return 'function_embedding'
@@ -107,11 +410,12 @@ class ProcessFunctionEmbedding(beam.DoFn):
   def process(self, element, *_args, **_kwargs):
     """Post-Process Function embedding.
 
-    This converts the incoming function instance
-    embedding into a serializable string for downstream
-    tasks. It also pops any extraneous keys which are
-    no more required. The "lineno" key is also converted
-    to a string for serializability downstream.
+    This takes the incoming function instance embedding
+    as a list of floats, which `FormatFunctionEmbedding`
+    turns into a string for text outputs. It also pops any
+    extraneous keys which are no more required. The "lineno"
+    key is also converted to a string for serializability
+    downstream.
 
     Args:
       element: A Python dict of the form,
@@ -149,17 +453,107 @@ class ProcessFunctionEmbedding(beam.DoFn):
           "function_name": "STRING",
           "lineno": "STRING",
           "original_function": "STRING",
-          "function_embedding": "STRING",
+          "function_embedding": [FLOAT, FLOAT, ...],
         }
     """
+    start = time.time()
+    self.metrics.elements_in.inc()
+
     prediction = element.get(self.predictions_key)[0]['outputs']
-    element[self.function_embedding_key] = ','.join([
-      str(val).decode('utf-8') for val in prediction
-    ])
+    element[self.function_embedding_key] = [float(val) for val in prediction]
 
     element['lineno'] = str(element['lineno']).decode('utf-8')
 
     for key in self.pop_keys:
       element.pop(key)
 
+    self.metrics.update_latency(start)
+    self.metrics.elements_out.inc()
+    self.metrics.bytes_out.inc(4 * len(element[self.function_embedding_key]))
     yield element
+
+
+class FormatFunctionEmbedding(beam.DoFn):
+  """Format the embedding of a function as comma-separated floats.
+
+  This is applied to the output of `ProcessFunctionEmbedding`
+  for the BigQuery table and the CSV files, while the binary
+  outputs take the list of floats as is.
+  """
+
+  @property
+  def function_embedding_key(self):
+    return 'function_embedding'
+
+  def process(self, element, *_args, **_kwargs):
+    element = dict(element)
+    element[self.function_embedding_key] = u','.join([
+      str(val).decode('utf-8') for val in element[self.function_embedding_key]
+    ])
+    yield element
+
+
+class WriteEmbeddingShard(beam.DoFn):
+  """Write a shard of function embeddings in binary format.
+
+  The embeddings are written as a float32 `.npy` matrix and the
+  remaining fields as a metadata CSV file with the same rows in
+  the same order. File names only depend on the shard number, so
+  a retried bundle overwrites the files of its previous attempt.
+
+    <file_path_prefix>-embeddings-<shard>-of-<num_shards>.npy
+    <file_path_prefix>-metadata-<shard>-of-<num_shards>.csv
+
+  Args:
+    file_path_prefix: Path prefix of the output files.
+    fieldnames: A list of metadata keys written to the CSV file.
+    num_shards: Total number of output shards.
+  """
+  def __init__(self, file_path_prefix, fieldnames, num_shards):
+    super(WriteEmbeddingShard, self).__init__()
+
+    self.file_path_prefix = file_path_prefix
+    self.fieldnames = fieldnames
+    self.num_shards = num_shards
+
+  @property
+  def function_embedding_key(self):
+    return 'function_embedding'
+
+  def shard_path(self, kind, shard, suffix):
+    return '{}-{}-{:05d}-of-{:05d}{}'.format(self.file_path_prefix, kind, shard,
+                                             self.num_shards, suffix)
+
+  def process(self, element, *_args, **_kwargs):
+    """Write the embeddings and metadata files of one shard.
+
+    Args:
+      element: A tuple of the shard number and an iterable of dicts
+               as output by `ProcessFunctionEmbedding`.
+
+    Yields:
+      The paths of the embeddings and metadata files.
+    """
+    shard, rows = element
+    rows = sorted(rows, key=lambda row: [row[key] for key in self.fieldnames])
+
+    embeddings = np.array([row[self.function_embedding_key] for row in rows], dtype=np.float32)
+
+    with io.BytesIO() as stream:
+      writer = csv.writer(stream)
+      for row in rows:
+        writer.writerow([row[key].encode('utf-8') for key in self.fieldnames])
+      metadata = stream.getvalue()
+
+    metadata_path = self.shard_path('metadata', shard, '.csv')
+    metadata_file = FileSystems.create(metadata_path)
+    metadata_file.write(metadata)
+    metadata_file.close()
+
+    embeddings_path = self.shard_path('embeddings', shard, '.npy')
+    embeddings_file = FileSystems.create(embeddings_path)
+    np.save(embeddings_file, embeddings)
+    embeddings_file.close()
+
+    yield embeddings_path
+    yield metadata_path
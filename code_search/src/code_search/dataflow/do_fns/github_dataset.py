@@ -1,8 +1,10 @@
 """Beam DoFns specific to `code_search.dataflow.transforms.github_dataset`."""
 
 import logging
+import time
 import apache_beam as beam
 from apache_beam import pvalue
+from code_search.dataflow import metrics
 import code_search.dataflow.utils as utils
 
 class SplitRepoPath(beam.DoFn):
@@ -13,6 +15,11 @@ class SplitRepoPath(beam.DoFn):
   to split the source dictionary key into two target keys.
   """
 
+  def __init__(self):
+    super(SplitRepoPath, self).__init__()
+
+    self.metrics = metrics.StageMetrics(SplitRepoPath)
+
   @property
   def source_key(self):
     return u'repo_path'
@@ -21,6 +28,10 @@ class SplitRepoPath(beam.DoFn):
   def target_keys(self):
     return [u'nwo', u'path']
 
+  @property
+  def content_key(self):
+    return u'content'
+
   def process(self, element, *_args, **_kwargs):
     """Process Python file attributes.
 
@@ -45,11 +56,17 @@ class SplitRepoPath(beam.DoFn):
           "content": "STRING",
         }
     """
+    start = time.time()
+    self.metrics.elements_in.inc()
+    self.metrics.bytes_in.inc(metrics.utf8_size(element.get(self.content_key) or u''))
+
     values = element.pop(self.source_key).split(' ', 1)
 
     for key, value in zip(self.target_keys, values):
       element[key] = value
 
+    self.metrics.update_latency(start)
+    self.metrics.elements_out.inc()
     yield element
 
 
@@ -60,8 +77,24 @@ class TokenizeFunctionDocstrings(beam.DoFn):
   the file content present in the content key. This
   yields an updated dictionary with the new tokenized
   data in the pairs key.
+
+  Args:
+    fast_extraction: Whether to extract pairs with
+      `utils.extract_function_docstring_pairs` instead of
+      `utils.get_function_docstring_pairs`.
   """
 
+  def __init__(self, fast_extraction=False):
+    super(TokenizeFunctionDocstrings, self).__init__()
+
+    self.fast_extraction = fast_extraction
+
+    self.metrics = metrics.StageMetrics(TokenizeFunctionDocstrings)
+    self.tokenization_failures = beam.metrics.Metrics.counter(
+      TokenizeFunctionDocstrings, metrics.TOKENIZATION_FAILURES)
+    self.ast_parse_us = beam.metrics.Metrics.distribution(
+      TokenizeFunctionDocstrings, metrics.AST_PARSE_US)
+
   @property
   def content_key(self):
     return 'content'
@@ -109,19 +142,36 @@ class TokenizeFunctionDocstrings(beam.DoFn):
         ...
       ]
     """
+    start = time.time()
+    self.metrics.elements_in.inc()
     try:
       content_blob = element.pop(self.content_key)
-      pairs = utils.get_function_docstring_pairs(content_blob)
+      self.metrics.bytes_in.inc(metrics.utf8_size(content_blob))
+
+      timings = {}
+      if self.fast_extraction:
+        pairs = utils.extract_function_docstring_pairs(content_blob, timings=timings)
+      else:
+        pairs = utils.get_function_docstring_pairs(content_blob, timings=timings)
+      if 'ast_parse_seconds' in timings:
+        self.ast_parse_us.update(int(timings['ast_parse_seconds'] * 1e6))
 
       result = [
         dict(zip(self.info_keys, pair_tuple), **element)
         for pair_tuple in pairs
       ]
 
+      self.metrics.update_latency(start)
+      self.metrics.elements_out.inc(len(result))
+      self.metrics.bytes_out.inc(sum(
+        metrics.utf8_size(pair[u'function_tokens']) + metrics.utf8_size(pair[u'docstring_tokens'])
+        for pair in result))
       yield result
     # TODO(jlewi): Can we narrow down the scope covered by swallowing
     # errors? It should really only be the AST parsing code so can
     # we move try/catch into get_function_docstring_pairs?
     except Exception as e:  # pylint: disable=broad-except
       logging.warning('Tokenization failed, %s', e.message)
+      self.tokenization_failures.inc()
+      self.metrics.update_latency(start)
       yield pvalue.TaggedOutput('err', element)
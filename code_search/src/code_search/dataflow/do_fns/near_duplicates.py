@@ -0,0 +1,368 @@
+"""Beam DoFns specific to `code_search.dataflow.transforms.near_duplicates`."""
+
+import hashlib
+import zlib
+import apache_beam as beam
+import numpy as np
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def function_id(element):
+  """Return the key identifying a function in the transformed dataset."""
+  return (element['nwo'], element['path'], element['function_name'], element['lineno'])
+
+
+def estimate_jaccard(signature, other_signature):
+  """Estimate the Jaccard similarity of two sets from their MinHash signatures."""
+  return np.mean(signature == other_signature)
+
+
+def shingles(tokens, shingle_size):
+  """Return the set of `shingle_size` consecutive tokens of a list of tokens."""
+  if len(tokens) <= shingle_size:
+    return {u' '.join(tokens)}
+  return {u' '.join(tokens[i:i + shingle_size])
+          for i in range(len(tokens) - shingle_size + 1)}
+
+
+class MinHashBands(beam.DoFn):
+  """Bucket functions by the bands of their MinHash signature.
+
+  The signature of a function has `num_perm` MinHash values over
+  the shingles of its function tokens, computed with random
+  universal hash functions drawn from `seed`. It is split into
+  `num_bands` bands, and functions sharing any band are candidate
+  near-duplicates. Pairs with a Jaccard similarity above about
+  `(1 / num_bands) ** (num_bands / num_perm)` share a band with
+  high probability, but less similar pairs still share a band
+  sometimes, so candidates are verified by `SimilarPairs`.
+
+  Args:
+    num_perm: Number of MinHash values of a signature.
+    num_bands: Number of bands the signature is split into.
+    shingle_size: Number of consecutive tokens of a shingle.
+    seed: Seed of the hash functions, which must be the same on all workers.
+  """
+
+  def __init__(self, num_perm=128, num_bands=16, shingle_size=3, seed=1):
+    super(MinHashBands, self).__init__()
+
+    if num_perm % num_bands:
+      raise ValueError('num_perm must be a multiple of num_bands')
+
+    self.num_perm = num_perm
+    self.num_bands = num_bands
+    self.shingle_size = shingle_size
+    self.seed = seed
+
+    self.permutations = None
+
+  @property
+  def function_tokens_key(self):
+    return u'function_tokens'
+
+  def start_bundle(self):
+    if self.permutations is None:
+      rng = np.random.RandomState(self.seed)
+      self.permutations = (
+        rng.randint(1, MERSENNE_PRIME, self.num_perm, dtype=np.uint64),
+        rng.randint(0, MERSENNE_PRIME, self.num_perm, dtype=np.uint64),
+      )
+
+  def signature(self, function_tokens):
+    """Return the MinHash signature of function tokens."""
+    hashes = np.array([zlib.crc32(shingle.encode('utf-8')) & MAX_HASH
+                       for shingle in shingles(function_tokens.split(), self.shingle_size)],
+                      dtype=np.uint64)
+    a, b = self.permutations
+    # Products overflow and wrap around, which is fine for hashing.
+    with np.errstate(over='ignore'):
+      values = (np.outer(hashes, a) + b) % MERSENNE_PRIME & MAX_HASH
+    return values.min(axis=0)
+
+  def process(self, element, *_args, **_kwargs):
+    """Compute the LSH buckets of a function.
+
+    Args:
+      element: A Python dict with the "function_tokens" of a function.
+
+    Yields:
+      A tuple of a band bucket and a tuple of the function id and its
+      signature for each band. Functions without tokens are in no bucket.
+    """
+    function_tokens = element.get(self.function_tokens_key)
+    if not function_tokens:
+      return
+
+    signature = self.signature(function_tokens)
+    rows = self.num_perm // self.num_bands
+    for band in range(self.num_bands):
+      band_hash = hashlib.sha1(signature[band * rows:(band + 1) * rows].tobytes()).hexdigest()
+      yield (band, band_hash[:16]), (function_id(element), signature)
+
+
+class SimilarPairs(beam.DoFn):
+  """Connect the functions of a bucket which are near-duplicates.
+
+  Functions sharing a band are only candidates: their Jaccard
+  similarity, estimated from their MinHash signatures, must be at
+  least `threshold`. Functions with the same signature are connected
+  to the smallest id among them, so the signatures compared pairwise
+  are distinct, which keeps buckets of boilerplate functions cheap.
+
+  Args:
+    threshold: The smallest estimated Jaccard similarity of near-duplicates.
+  """
+
+  def __init__(self, threshold=0.8):
+    super(SimilarPairs, self).__init__()
+
+    self.threshold = threshold
+
+  def process(self, element, *_args, **_kwargs):
+    """Compute the edges between near-duplicate functions of a bucket.
+
+    Args:
+      element: A tuple of a bucket and a list of tuples of a function id
+               and its signature, as output by `MinHashBands`.
+
+    Yields:
+      A tuple of two function ids for each pair of near-duplicates.
+    """
+    _, members = element
+    members = sorted(members, key=lambda member: member[0])
+    if len(members) < 2:
+      return
+
+    first_ids = {}
+    signatures = []
+    for idx, signature in members:
+      key = signature.tobytes()
+      if key in first_ids:
+        yield idx, first_ids[key]
+      else:
+        first_ids[key] = idx
+        signatures.append((idx, signature))
+
+    matrix = np.array([signature for _, signature in signatures])
+    for i in range(1, len(signatures)):
+      similarities = (matrix[:i] == matrix[i]).mean(axis=1)
+      for j in np.flatnonzero(similarities >= self.threshold):
+        yield signatures[i][0], signatures[j][0]
+
+
+class SendLabel(beam.DoFn):
+  """Send the label of a function to itself and to its near-duplicates."""
+
+  def process(self, element, *_args, **_kwargs):
+    """Propagate a label over the edges of a function.
+
+    Args:
+      element: A tuple of a function id and a dict of the form,
+        {
+          "labels": [LABEL, ...],
+          "neighbours": [ID, ...],
+        }
+
+    Yields:
+      A tuple of a function id and a label, for the function and
+      each of its neighbours.
+    """
+    idx, grouped = element
+    labels = list(grouped['labels'])
+    if not labels:
+      return
+
+    label = min(labels)
+    yield idx, label
+    for neighbour in grouped['neighbours']:
+      yield neighbour, label
+
+
+class LabelEdges(beam.DoFn):
+  """Connect the distinct labels sent to a function to the smallest one."""
+
+  def process(self, element, *_args, **_kwargs):
+    """Compute the edges of the graph of labels around a function.
+
+    Args:
+      element: A tuple of a function id and the list of labels sent to
+               it by `SendLabel`, including its own.
+
+    Yields:
+      A tuple of a label and the smallest label for each other label.
+    """
+    _, labels = element
+    labels = set(labels)
+    min_label = min(labels)
+    for label in labels:
+      if label != min_label:
+        yield label, min_label
+
+
+class HookLabels(LabelEdges):
+  """Relabel a function and the labels sent to it with the smallest one.
+
+  Hooking the labels themselves, and not only the function, merges
+  whole groups of functions sharing a label at once, which together
+  with pointer jumping (see `ApplyRootLabel`) takes a number of rounds
+  logarithmic rather than linear in the diameter of a cluster.
+  """
+
+  def process(self, element, *_args, **_kwargs):
+    """Compute the new labels of a function and of the labels sent to it.
+
+    Args:
+      element: A tuple of a function id and the list of labels sent to
+               it by `SendLabel`, including its own.
+
+    Yields:
+      A tuple of the function id and the smallest label, and a tuple of
+      a label and the smallest label for each other label.
+    """
+    idx, labels = element
+    labels = list(labels)
+    yield idx, min(labels)
+    for edge in super(HookLabels, self).process((idx, labels)):
+      yield edge
+
+
+class ResolveRootLabels(beam.DoFn):
+  """Map every label to the smallest label connected to it.
+
+  Labels of the same cluster are connected by the edges of
+  `LabelEdges`, so the smallest label connected to a label is
+  the smallest function id of its cluster. The components are
+  found by union-find over all the edges at once, which only
+  scales to the few edges left once label propagation has
+  nearly converged.
+
+  Args:
+    max_edges: The largest number of edges to resolve, or None.
+  """
+
+  def __init__(self, max_edges=None):
+    super(ResolveRootLabels, self).__init__()
+
+    self.max_edges = max_edges
+
+  def process(self, element, *_args, **_kwargs):
+    """Resolve the root label of each label.
+
+    Args:
+      element: A list of tuples of two connected labels.
+
+    Yields:
+      A tuple of a label and its root label, for each label which
+      is not its own root.
+
+    Raises:
+      ValueError: If there are more than `max_edges` edges.
+    """
+    if self.max_edges is not None and len(element) > self.max_edges:
+      raise ValueError('More than {} label edges are left after label propagation, '
+                       'which needs more iterations'.format(self.max_edges))
+
+    parents = {}
+
+    def find(label):
+      root = label
+      while parents.get(root, root) != root:
+        root = parents[root]
+      while label != root:
+        parents[label], label = root, parents[label]
+      return root
+
+    for label, other_label in element:
+      root, other_root = find(label), find(other_label)
+      if root != other_root:
+        parents[max(root, other_root)] = min(root, other_root)
+
+    for label in list(parents):
+      root = find(label)
+      if root != label:
+        yield label, root
+
+
+class ApplyRootLabel(beam.DoFn):
+  """Relabel the functions of a label with its root label.
+
+  With the current labels as root labels, this is a step of
+  pointer jumping: every function takes the label of its label.
+  """
+
+  def process(self, element, *_args, **_kwargs):
+    """Relabel functions.
+
+    Args:
+      element: A tuple of a label and a dict of the form,
+        {
+          "ids": [ID, ...],
+          "roots": [LABEL],
+        }
+
+    Yields:
+      A tuple of a function id and its root label for each function.
+    """
+    label, grouped = element
+    roots = list(grouped['roots'])
+    root = roots[0] if roots else label
+    for idx in grouped['ids']:
+      yield idx, root
+
+
+class SplitNearDuplicates(beam.DoFn):
+  """Keep the representative of each cluster of near-duplicates.
+
+  Functions labelled with their own id are representatives and go
+  to the main output. The others are output to the `duplicates`
+  tag as a mapping to their representative.
+  """
+
+  DUPLICATES_TAG = 'duplicates'
+
+  @property
+  def id_keys(self):
+    return [u'nwo', u'path', u'function_name', u'lineno']
+
+  def process(self, element, *_args, **_kwargs):
+    """Split functions by whether they represent their cluster.
+
+    Args:
+      element: A tuple of a function id and a dict of the form,
+        {
+          "elements": [DICT],
+          "labels": [LABEL],
+        }
+
+    Yields:
+      The function dict if it is a representative, else a dict
+      of the form,
+        {
+          "representative_nwo": "STRING",
+          "representative_path": "STRING",
+          "representative_function_name": "STRING",
+          "representative_lineno": "STRING",
+          "nwo": "STRING",
+          "path": "STRING",
+          "function_name": "STRING",
+          "lineno": "STRING",
+        }
+    """
+    idx, grouped = element
+    elements = list(grouped['elements'])
+    labels = list(grouped['labels'])
+    if not elements:
+      return
+
+    label = labels[0] if labels else idx
+    if label == idx:
+      yield elements[0]
+      return
+
+    mapping = dict(zip(self.id_keys, idx))
+    mapping.update({u'representative_' + key: value
+                    for key, value in zip(self.id_keys, label)})
+    yield beam.pvalue.TaggedOutput(self.DUPLICATES_TAG, mapping)
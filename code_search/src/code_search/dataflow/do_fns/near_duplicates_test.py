@@ -0,0 +1,142 @@
+import logging
+import unittest
+
+import apache_beam as beam
+import numpy as np
+
+import code_search.dataflow.do_fns.near_duplicates as nd_do_fns
+
+
+def make_function(name, function_tokens):
+  return {
+    u'nwo': u'owner/repo',
+    u'path': u'src/mod.py',
+    u'function_name': name,
+    u'lineno': u'1',
+    u'function_tokens': function_tokens,
+  }
+
+
+class TestMinHashBands(unittest.TestCase):
+  def setUp(self):
+    self.do_fn = nd_do_fns.MinHashBands(num_perm=32, num_bands=8)
+    self.do_fn.start_bundle()
+
+  def buckets(self, element):
+    return {bucket for bucket, _ in self.do_fn.process(element)}
+
+  def test_identical_tokens(self):
+    tokens = u'def add a b return a b plus one'
+    buckets = self.buckets(make_function(u'f', tokens))
+    self.assertEqual(len(buckets), 8)
+    self.assertEqual(self.buckets(make_function(u'g', tokens)), buckets)
+
+    _, (idx, signature) = next(self.do_fn.process(make_function(u'g', tokens)))
+    self.assertEqual(idx, (u'owner/repo', u'src/mod.py', u'g', u'1'))
+    self.assertEqual(len(signature), 32)
+
+  def test_different_tokens(self):
+    self.assertFalse(self.buckets(make_function(u'f', u'def add a b return a b')) &
+                     self.buckets(make_function(u'g', u'class Parser parse tokens into trees')))
+
+  def test_empty_tokens(self):
+    self.assertEqual(self.buckets(make_function(u'f', u'')), set())
+
+  def test_num_bands(self):
+    with self.assertRaises(ValueError):
+      nd_do_fns.MinHashBands(num_perm=30, num_bands=8)
+
+
+class TestSimilarPairs(unittest.TestCase):
+  def setUp(self):
+    self.do_fn = nd_do_fns.SimilarPairs(threshold=0.75)
+
+  def test_estimate_jaccard(self):
+    self.assertEqual(nd_do_fns.estimate_jaccard(np.array([1, 2, 3, 4]), np.array([1, 2, 0, 4])),
+                     0.75)
+
+  def test_similar_pairs(self):
+    members = [('c', np.array([1, 2, 3, 4])), ('a', np.array([1, 2, 3, 0])),
+               ('b', np.array([9, 9, 9, 4])), ('d', np.array([1, 2, 3, 4]))]
+    # d has the signature of c, and b is below the threshold with everyone.
+    self.assertEqual(sorted(self.do_fn.process(('bucket', members))),
+                     [('c', 'a'), ('d', 'c')])
+
+  def test_single_function(self):
+    self.assertEqual(list(self.do_fn.process(('bucket', [('a', np.array([1, 2]))]))), [])
+
+
+class TestLabelPropagation(unittest.TestCase):
+  def test_send_label(self):
+    element = ('x', {'labels': ['c', 'b'], 'neighbours': ['y', 'z']})
+    self.assertEqual(list(nd_do_fns.SendLabel().process(element)),
+                     [('x', 'b'), ('y', 'b'), ('z', 'b')])
+    self.assertEqual(list(nd_do_fns.SendLabel().process(('x', {'labels': [],
+                                                               'neighbours': ['y']}))), [])
+
+  def test_label_edges(self):
+    element = ('x', ['c', 'a', 'c', 'b'])
+    self.assertEqual(sorted(nd_do_fns.LabelEdges().process(element)), [('b', 'a'), ('c', 'a')])
+    self.assertEqual(list(nd_do_fns.LabelEdges().process(('x', ['a', 'a']))), [])
+
+  def test_hook_labels(self):
+    element = ('x', ['c', 'a', 'c', 'b'])
+    self.assertEqual(sorted(nd_do_fns.HookLabels().process(element)),
+                     [('b', 'a'), ('c', 'a'), ('x', 'a')])
+
+  def test_resolve_root_labels(self):
+    # A chain longer than any number of propagation rounds, and a separate cluster.
+    edges = [('e', 'd'), ('d', 'c'), ('c', 'b'), ('b', 'a'), ('z', 'y')]
+    self.assertEqual(sorted(nd_do_fns.ResolveRootLabels().process(edges)),
+                     [('b', 'a'), ('c', 'a'), ('d', 'a'), ('e', 'a'), ('z', 'y')])
+
+  def test_resolve_too_many_edges(self):
+    with self.assertRaises(ValueError):
+      list(nd_do_fns.ResolveRootLabels(max_edges=2).process([('c', 'b'), ('b', 'a'),
+                                                              ('z', 'y')]))
+
+  def test_apply_root_label(self):
+    do_fn = nd_do_fns.ApplyRootLabel()
+    self.assertEqual(list(do_fn.process(('c', {'ids': ['c', 'd'], 'roots': ['a']}))),
+                     [('c', 'a'), ('d', 'a')])
+    self.assertEqual(list(do_fn.process(('a', {'ids': ['a', 'b'], 'roots': []}))),
+                     [('a', 'a'), ('b', 'a')])
+
+
+class TestSplitNearDuplicates(unittest.TestCase):
+  def setUp(self):
+    self.representative = make_function(u'f', u'def f')
+    self.duplicate = make_function(u'g', u'def g')
+    self.representative_id = nd_do_fns.function_id(self.representative)
+    self.duplicate_id = nd_do_fns.function_id(self.duplicate)
+
+  def test_representative(self):
+    element = (self.representative_id, {'elements': [self.representative],
+                                        'labels': [self.representative_id]})
+    self.assertEqual(list(nd_do_fns.SplitNearDuplicates().process(element)),
+                     [self.representative])
+
+  def test_unlabelled(self):
+    element = (self.representative_id, {'elements': [self.representative], 'labels': []})
+    self.assertEqual(list(nd_do_fns.SplitNearDuplicates().process(element)),
+                     [self.representative])
+
+  def test_duplicate(self):
+    element = (self.duplicate_id, {'elements': [self.duplicate],
+                                   'labels': [self.representative_id]})
+    outputs = list(nd_do_fns.SplitNearDuplicates().process(element))
+    self.assertEqual(len(outputs), 1)
+    self.assertIsInstance(outputs[0], beam.pvalue.TaggedOutput)
+    self.assertEqual(outputs[0].tag, nd_do_fns.SplitNearDuplicates.DUPLICATES_TAG)
+    self.assertEqual(outputs[0].value[u'function_name'], u'g')
+    self.assertEqual(outputs[0].value[u'representative_function_name'], u'f')
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO,
+                      format=('%(levelname)s|%(asctime)s'
+                              '|%(pathname)s|%(lineno)d| %(message)s'),
+                      datefmt='%Y-%m-%dT%H:%M:%S',
+                      )
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -0,0 +1,151 @@
+"""Throughput and latency metrics of the code search pipeline stages.
+
+Each instrumented DoFn reports Beam metrics in a namespace named
+after its class, e.g.
+`code_search.dataflow.do_fns.github_dataset.SplitRepoPath`. The
+metrics of a finished pipeline are summarized per stage by
+`stage_report`.
+"""
+import time
+
+import apache_beam as beam
+
+NAMESPACE_PREFIX = 'code_search.dataflow.'
+
+ELEMENTS_IN = 'elements_in'
+ELEMENTS_OUT = 'elements_out'
+BYTES_IN = 'bytes_in'
+BYTES_OUT = 'bytes_out'
+ELEMENT_LATENCY_US = 'element_latency_us'
+TOKENIZATION_FAILURES = 'tokenization_failures'
+FAILED_PREDICTIONS = 'failed_predictions'
+AST_PARSE_US = 'ast_parse_us'
+
+
+def utf8_size(value):
+  """Return the size in bytes of a string once encoded as UTF-8."""
+  if isinstance(value, bytes):
+    return len(value)
+  return len(value.encode('utf-8'))
+
+
+class StageMetrics(object):
+  """Counters and distributions of a pipeline stage.
+
+  Args:
+    stage: The DoFn class of the stage, which namespaces its metrics.
+  """
+  def __init__(self, stage):
+    self.elements_in = beam.metrics.Metrics.counter(stage, ELEMENTS_IN)
+    self.elements_out = beam.metrics.Metrics.counter(stage, ELEMENTS_OUT)
+    self.bytes_in = beam.metrics.Metrics.counter(stage, BYTES_IN)
+    self.bytes_out = beam.metrics.Metrics.counter(stage, BYTES_OUT)
+    self.element_latency_us = beam.metrics.Metrics.distribution(stage, ELEMENT_LATENCY_US)
+
+  def update_latency(self, start, num_elements=1):
+    """Record the time since `start` spread evenly over `num_elements` elements."""
+    latency_us = int((time.time() - start) * 1e6 / num_elements)
+    for _ in range(num_elements):
+      self.element_latency_us.update(latency_us)
+
+
+def _metric_value(metric_result):
+  """Return the committed value of a metric, or the attempted one if the runner has none."""
+  if metric_result.committed is not None:
+    return metric_result.committed
+  return metric_result.attempted
+
+
+def stage_report(query_result):
+  """Summarize the stage metrics of a pipeline result.
+
+  Args:
+    query_result: The result of `PipelineResult.metrics().query()`.
+
+  Returns:
+    A list of dicts, one per step running an instrumented DoFn, in
+    decreasing order of the total time spent on elements, of the form,
+      {
+        "step": "STRING",
+        "stage": "STRING",
+        "elements_in": INTEGER,
+        "elements_out": INTEGER,
+        "bytes_in": INTEGER,
+        "bytes_out": INTEGER,
+        "tokenization_failures": INTEGER,
+        "failed_predictions": INTEGER,
+        "busy_seconds": FLOAT,
+        "mean_latency_ms": FLOAT,
+        "max_latency_ms": FLOAT,
+        "elements_per_busy_second": FLOAT,
+        "mean_ast_parse_ms": FLOAT,
+        "busy_share": FLOAT,
+      }
+  """
+  stages = {}
+
+  def get_stage(metric_result):
+    namespace = metric_result.key.metric.namespace
+    if not namespace.startswith(NAMESPACE_PREFIX):
+      return None
+    key = (metric_result.key.step, namespace)
+    if key not in stages:
+      stages[key] = {
+        'step': metric_result.key.step,
+        'stage': namespace.rsplit('.', 1)[-1],
+        ELEMENTS_IN: 0,
+        ELEMENTS_OUT: 0,
+        BYTES_IN: 0,
+        BYTES_OUT: 0,
+        TOKENIZATION_FAILURES: 0,
+        FAILED_PREDICTIONS: 0,
+        'busy_seconds': 0.,
+        'mean_latency_ms': 0.,
+        'max_latency_ms': 0.,
+        'elements_per_busy_second': 0.,
+        'mean_ast_parse_ms': 0.,
+      }
+    return stages[key]
+
+  for counter in query_result.get('counters', []):
+    stage = get_stage(counter)
+    if stage is not None and counter.key.metric.name in stage:
+      stage[counter.key.metric.name] += _metric_value(counter)
+
+  for distribution in query_result.get('distributions', []):
+    stage = get_stage(distribution)
+    value = _metric_value(distribution)
+    if stage is None or value is None or not value.count:
+      continue
+    if distribution.key.metric.name == ELEMENT_LATENCY_US:
+      stage['busy_seconds'] = value.sum / 1e6
+      stage['mean_latency_ms'] = value.sum / 1e3 / value.count
+      stage['max_latency_ms'] = value.max / 1e3
+      if value.sum:
+        stage['elements_per_busy_second'] = value.count * 1e6 / value.sum
+    elif distribution.key.metric.name == AST_PARSE_US:
+      stage['mean_ast_parse_ms'] = value.sum / 1e3 / value.count
+
+  total_busy_seconds = sum(stage['busy_seconds'] for stage in stages.values())
+  for stage in stages.values():
+    stage['busy_share'] = stage['busy_seconds'] / total_busy_seconds if total_busy_seconds else 0.
+
+  return sorted(stages.values(), key=lambda stage: (-stage['busy_seconds'], stage['step']))
+
+
+def format_stage_report(report):
+  """Format the result of `stage_report` as a table, one line per stage."""
+  header = ('{:<40} {:>12} {:>12} {:>14} {:>14} {:>10} {:>10} {:>12} {:>10} {:>7} {:>9}'.format(
+    'STEP (STAGE)', 'IN', 'OUT', 'BYTES IN', 'BYTES OUT', 'MEAN MS', 'MAX MS', 'ELEMENTS/S',
+    'PARSE MS', 'BUSY', 'FAILURES'))
+  lines = [header]
+  for stage in report:
+    lines.append(
+      '{:<40} {:>12} {:>12} {:>14} {:>14} {:>10.3f} {:>10.1f} {:>12.1f} {:>10.3f} {:>6.1f}% {:>9}'
+      .format('{} ({})'.format(stage['step'], stage['stage'])[:40],
+              stage[ELEMENTS_IN], stage[ELEMENTS_OUT], stage[BYTES_IN], stage[BYTES_OUT],
+              stage['mean_latency_ms'], stage['max_latency_ms'],
+              stage['elements_per_busy_second'], stage['mean_ast_parse_ms'],
+              stage['busy_share'] * 100,
+              stage[TOKENIZATION_FAILURES] + stage[FAILED_PREDICTIONS]))
+  return '\n'.join(lines)
@@ -1,5 +1,6 @@
 import apache_beam as beam
 
+import code_search.dataflow.do_fns.dict_to_parquet as dict_to_parquet
 import code_search.dataflow.do_fns.prediction_do_fn as pred
 import code_search.dataflow.do_fns.function_embeddings as func_embeddings # pylint: disable=no-name-in-module
 
@@ -12,32 +13,141 @@ class FunctionEmbeddings(beam.PTransform):
   by encoding it into base64 format and returns an updated
   dictionary element with the embedding for further processing.
 
+  Encoded elements are grouped by `beam.BatchElements`, which
+  adapts the batch size between `min_batch_size` and
+  `max_batch_size` to take about `target_batch_duration_secs`,
+  and each batch is predicted with a single model call. The
+  elements of a batch whose prediction failed are predicted again
+  one at a time, so that only the failing ones are dropped, see
+  `code_search.dataflow.do_fns.function_embeddings.RetryFailedBatch`.
+
   Args:
-    project: The project
-    target_table: The table to write to. Should be of the form
-      "project:dataset.table"
+    problem: A string representing the registered Tensor2Tensor Problem.
+    data_dir: A string representing the path to data directory.
+    saved_model_dir: Path to directory containing Tensorflow SavedModel.
+    min_batch_size: Minimum number of elements predicted at once.
+    max_batch_size: Maximum number of elements predicted at once.
+    target_batch_duration_secs: Target time in seconds to predict a batch.
   """
 
-  def __init__(self, problem, data_dir, saved_model_dir):
+  def __init__(self, problem, data_dir, saved_model_dir, min_batch_size=1,
+               max_batch_size=pred.DEFAULT_BATCH_SIZE, target_batch_duration_secs=1):
     super(FunctionEmbeddings, self).__init__()
 
     self.problem = problem
     self.data_dir = data_dir
     self.saved_model_dir = saved_model_dir
+    self.min_batch_size = min_batch_size
+    self.max_batch_size = max_batch_size
+    self.target_batch_duration_secs = target_batch_duration_secs
 
   def expand(self, input_or_inputs):
     batch_predict = (input_or_inputs
       | "Encoded Function Tokens" >> beam.ParDo(func_embeddings.EncodeFunctionTokens(
         self.problem, self.data_dir))
+      | "Batch Encoded Functions" >> beam.BatchElements(
+        min_batch_size=self.min_batch_size,
+        max_batch_size=self.max_batch_size,
+        target_batch_duration_secs=self.target_batch_duration_secs)
+      | "Combine Instances" >> beam.ParDo(func_embeddings.CombineInstances())
       | "Compute Function Embeddings" >> beam.ParDo(pred.PredictionDoFn(),
-                                                    self.saved_model_dir).with_outputs('err',
+                                                    self.saved_model_dir).with_outputs('errors',
                                                                                        main='main')
     )
 
-    predictions = batch_predict.main
+    retry_predict = (batch_predict.errors
+      | "Split Failed Batches" >> beam.ParDo(func_embeddings.RetryFailedBatch())
+      | "Retry Function Embeddings" >> beam.ParDo(pred.PredictionDoFn(),
+                                                  self.saved_model_dir).with_outputs('errors',
+                                                                                     main='main')
+    )
+
+    _ = (retry_predict.errors
+      | "Count Failed Predictions" >> beam.ParDo(func_embeddings.RetryFailedBatch())
+    )
+
+    predictions = ((batch_predict.main, retry_predict.main)
+      | "Merge Predictions" >> beam.Flatten()
+    )
 
     formatted_predictions = (predictions
+      | "Split Predictions" >> beam.ParDo(func_embeddings.SplitPredictions())
       | "Process Function Embeddings" >> beam.ParDo(func_embeddings.ProcessFunctionEmbedding())
     )
 
     return formatted_predictions
+
+
+class WriteFunctionEmbeddingShards(beam.PTransform):
+  """Write function embeddings as float32 `.npy` shards with metadata sidecars.
+
+  This is a binary alternative to writing the embeddings
+  as text in the last column of CSV files. See
+  `code_search.dataflow.do_fns.function_embeddings.WriteEmbeddingShard`
+  for the output layout.
+
+  Args:
+    file_path_prefix: Path prefix of the output files.
+    fieldnames: A list of metadata keys written to the sidecar CSV files.
+    num_shards: Number of output shards.
+  """
+
+  def __init__(self, file_path_prefix, fieldnames, num_shards):
+    super(WriteFunctionEmbeddingShards, self).__init__()
+
+    self.file_path_prefix = file_path_prefix
+    self.fieldnames = fieldnames
+    self.num_shards = num_shards
+
+  def expand(self, input_or_inputs):
+    return (input_or_inputs
+      | "Key By Shard" >> beam.ParDo(dict_to_parquet.KeyByEmbeddingShard(self.num_shards))
+      | "Group By Shard" >> beam.GroupByKey()
+      | "Write Shards" >> beam.ParDo(func_embeddings.WriteEmbeddingShard(
+        self.file_path_prefix, self.fieldnames, self.num_shards))
+    )
+
+
+class IncrementalFunctionEmbeddings(beam.PTransform):
+  """Only compute the embeddings of new or changed functions.
+
+  The input elements must have been hashed with
+  `code_search.dataflow.do_fns.function_embeddings.HashFunctionTokens`.
+  They are joined on the function tokens hash with the embeddings of
+  a previous run. Unchanged functions carry their previous embedding
+  forward and only the others go through `FunctionEmbeddings`.
+
+  Args:
+    previous_embeddings: A PCollection of dicts with the "function_tokens_hash"
+      and "function_embedding" of a previous run.
+    function_embeddings: A `FunctionEmbeddings` transform for the rest.
+  """
+
+  def __init__(self, previous_embeddings, function_embeddings):
+    super(IncrementalFunctionEmbeddings, self).__init__()
+
+    self.previous_embeddings = previous_embeddings
+    self.function_embeddings = function_embeddings
+
+  def expand(self, input_or_inputs):
+    current = (input_or_inputs
+      | "Key Current By Hash" >> beam.Map(lambda e: (e['function_tokens_hash'], e))
+    )
+    previous = (self.previous_embeddings
+      | "Key Previous By Hash" >> beam.Map(lambda e: (e['function_tokens_hash'], e))
+    )
+
+    split = ({'current': current, 'previous': previous}
+      | "Join Previous Embeddings" >> beam.CoGroupByKey()
+      | "Carry Forward Embeddings" >> beam.ParDo(
+        func_embeddings.CarryForwardEmbeddings()).with_outputs(
+          func_embeddings.CarryForwardEmbeddings.UNCHANGED_TAG, main='changed')
+    )
+
+    computed = (split.changed
+      | "Compute Changed Function Embeddings" >> self.function_embeddings
+    )
+
+    return ((computed, split[func_embeddings.CarryForwardEmbeddings.UNCHANGED_TAG])
+      | "Merge Function Embeddings" >> beam.Flatten()
+    )
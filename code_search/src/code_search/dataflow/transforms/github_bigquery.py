@@ -102,3 +102,31 @@ class ReadTransformedGithubDatasetQuery(object):
     if self.limit:
       query += '\nLIMIT {}'.format(self.limit)
     return query
+
+
+class ReadPreviousFunctionEmbeddingsQuery(object):
+
+  def __init__(self, table):
+    """Query to select the embeddings of a previous run by function tokens hash.
+
+    Args:
+      table: The function embeddings table of a previous run. It must
+        have the `function_tokens_hash` column.
+    """
+    self.table = table
+
+  @property
+  def query_string(self):
+    # In SQL queries table format uses period not :.
+    table = self.table.replace(":", ".")
+    query = """
+      SELECT
+        function_tokens_hash, ANY_VALUE(function_embedding) AS function_embedding
+      FROM
+        `{0}`
+      WHERE
+        function_tokens_hash IS NOT NULL
+      GROUP BY
+        function_tokens_hash
+    """.format(table)
+    return query
@@ -3,8 +3,12 @@ import logging
 import apache_beam as beam
 
 from code_search.dataflow.transforms import bigquery
+from code_search.dataflow.transforms.near_duplicates import NearDuplicateFunctions
 import code_search.dataflow.do_fns.github_dataset as gh_do_fns
 
+# Docstrings with at most this many tokens are filtered out.
+MIN_DOCSTRING_TOKENS = 5
+
 
 class TransformGithubDataset(beam.PTransform):
   """Transform the BigQuery Github Dataset.
@@ -19,23 +23,34 @@ class TransformGithubDataset(beam.PTransform):
   which are defined as properties for easy modification.
     - `self.failed_tokenize_table`
     - `self.pairs_table`
+
+  With `fast_extraction`, pairs are extracted with
+  `code_search.dataflow.utils.extract_function_docstring_pairs`.
+  With `dedupe_near_duplicates`, only one function of each cluster
+  of near-duplicates is kept, see `NearDuplicateFunctions`, and the
+  others are written to `near_duplicates_table` if it is set.
   """
 
-  def __init__(self, pairs_table, failed_tokenize_table):
+  def __init__(self, pairs_table, failed_tokenize_table, fast_extraction=False,
+               dedupe_near_duplicates=False, near_duplicates_table=None):
     super(TransformGithubDataset, self).__init__()
 
     self.pairs_table = pairs_table
     self.failed_tokenize_table = failed_tokenize_table
+    self.fast_extraction = fast_extraction
+    self.dedupe_near_duplicates = dedupe_near_duplicates
+    self.near_duplicates_table = near_duplicates_table
 
   @property
   def min_docstring_tokens(self):
-    return 5
+    return MIN_DOCSTRING_TOKENS
 
   def expand(self, input_or_inputs):
     tokenize_result = (input_or_inputs
      | "Split 'repo_path'" >> beam.ParDo(gh_do_fns.SplitRepoPath())
      | "Tokenize Code/Docstring Pairs" >> beam.ParDo(
-        gh_do_fns.TokenizeFunctionDocstrings()).with_outputs('err', main='rows')
+        gh_do_fns.TokenizeFunctionDocstrings(
+          fast_extraction=self.fast_extraction)).with_outputs('err', main='rows')
     )
 
     pairs, tokenize_errors = tokenize_result.rows, tokenize_result.err
@@ -64,6 +79,11 @@ class TransformGithubDataset(beam.PTransform):
         lambda row: len(row['docstring_tokens'].split(' ')) > self.min_docstring_tokens)
     )
 
+    if self.dedupe_near_duplicates:
+      flat_rows = (flat_rows
+        | "Dedupe Near Duplicates" >> NearDuplicateFunctions(self.near_duplicates_table)
+      )
+
     if self.pairs_table:
       logging.info("Writing results to BigQuery %s", self.pairs_table)
       tokenize_table_schema = bigquery.BigQuerySchema([
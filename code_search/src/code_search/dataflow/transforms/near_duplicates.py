@@ -0,0 +1,132 @@
+import logging
+
+import apache_beam as beam
+
+from code_search.dataflow.transforms import bigquery
+import code_search.dataflow.do_fns.near_duplicates as nd_do_fns
+
+
+class NearDuplicateFunctions(beam.PTransform):
+  """Keep one function of each cluster of near-duplicate functions.
+
+  Functions are bucketed by locality-sensitive hashing of the
+  MinHash signatures of their function tokens, see
+  `code_search.dataflow.do_fns.near_duplicates.MinHashBands`.
+  Functions sharing a bucket are connected if their estimated
+  Jaccard similarity is at least `threshold`, see `SimilarPairs`,
+  and clusters are the connected components. Labels are computed
+  by a distributed fixed-point iteration starting from the function
+  ids: for `num_iterations` rounds, every function and every label
+  sent to it by its neighbours take the smallest of these labels, see
+  `HookLabels`, and then functions take the label of their label
+  twice (pointer jumping). This converges in a number of rounds
+  logarithmic in the diameter of the clusters. The
+  labels of neighbouring functions which still differ are connected
+  and resolved to the smallest label of their component on a single
+  worker, see `ResolveRootLabels`, so clusters are exact. At most
+  `max_label_edges` edges are resolved this way, and more fail the
+  pipeline, which then needs more iterations. The function with the
+  smallest id represents its cluster and the others are dropped.
+
+  If `mapping_table` is set, each dropped function is written to it
+  with the function which represents it, so search results can list
+  the alternates of a representative.
+
+  Args:
+    mapping_table: The BigQuery table of the near-duplicates mapping, of the
+      form PROJECT:DATASET.TABLE.
+    num_perm: Number of MinHash values of a signature.
+    num_bands: Number of LSH bands the signature is split into.
+    shingle_size: Number of consecutive tokens of a shingle.
+    threshold: The smallest estimated Jaccard similarity of near-duplicates.
+    num_iterations: Number of rounds of label propagation before the labels
+      are resolved.
+    max_label_edges: The largest number of label edges resolved on a single worker.
+  """
+
+  def __init__(self, mapping_table=None, num_perm=128, num_bands=16, shingle_size=3,
+               threshold=0.8, num_iterations=5, max_label_edges=1000000):
+    super(NearDuplicateFunctions, self).__init__()
+
+    self.mapping_table = mapping_table
+    self.num_perm = num_perm
+    self.num_bands = num_bands
+    self.shingle_size = shingle_size
+    self.threshold = threshold
+    self.num_iterations = num_iterations
+    self.max_label_edges = max_label_edges
+
+  def expand(self, input_or_inputs):
+    keyed = (input_or_inputs
+      | "Key By Function Id" >> beam.Map(lambda e: (nd_do_fns.function_id(e), e))
+    )
+
+    neighbours = (input_or_inputs
+      | "Compute MinHash Bands" >> beam.ParDo(nd_do_fns.MinHashBands(
+        self.num_perm, self.num_bands, self.shingle_size))
+      | "Group By Band" >> beam.GroupByKey()
+      | "Similar Pairs" >> beam.ParDo(nd_do_fns.SimilarPairs(self.threshold))
+      | "Both Directions" >> beam.FlatMap(lambda edge: [edge, (edge[1], edge[0])])
+    )
+
+    labels = keyed | "Initial Labels" >> beam.Map(lambda kv: (kv[0], kv[0]))
+    for i in range(self.num_iterations):
+      labels = ({'labels': labels, 'neighbours': neighbours}
+        | "Join Labels {}".format(i) >> beam.CoGroupByKey()
+        | "Send Labels {}".format(i) >> beam.ParDo(nd_do_fns.SendLabel())
+        | "Group Labels {}".format(i) >> beam.GroupByKey()
+        | "Hook Labels {}".format(i) >> beam.ParDo(nd_do_fns.HookLabels())
+        | "Min Label {}".format(i) >> beam.CombinePerKey(min)
+      )
+      for j in range(2):
+        ids_by_label = (labels
+          | "Key By Label {}-{}".format(i, j) >> beam.Map(lambda kv: (kv[1], kv[0])))
+        labels = ({'ids': ids_by_label, 'roots': labels}
+          | "Join Label Labels {}-{}".format(i, j) >> beam.CoGroupByKey()
+          | "Jump Labels {}-{}".format(i, j) >> beam.ParDo(nd_do_fns.ApplyRootLabel())
+        )
+
+    root_labels = ({'labels': labels, 'neighbours': neighbours}
+      | "Join Final Labels" >> beam.CoGroupByKey()
+      | "Send Final Labels" >> beam.ParDo(nd_do_fns.SendLabel())
+      | "Group Final Labels" >> beam.GroupByKey()
+      | "Label Edges" >> beam.ParDo(nd_do_fns.LabelEdges())
+      # One more edge than resolved is kept to detect that there are too many.
+      | "Collect Label Edges" >> beam.combiners.Sample.FixedSizeGlobally(
+        self.max_label_edges + 1)
+      | "Resolve Root Labels" >> beam.ParDo(nd_do_fns.ResolveRootLabels(self.max_label_edges))
+    )
+    ids_by_label = labels | "Key By Label" >> beam.Map(lambda kv: (kv[1], kv[0]))
+    labels = ({'ids': ids_by_label, 'roots': root_labels}
+      | "Join Root Labels" >> beam.CoGroupByKey()
+      | "Apply Root Labels" >> beam.ParDo(nd_do_fns.ApplyRootLabel())
+    )
+
+    split = ({'elements': keyed, 'labels': labels}
+      | "Join Elements" >> beam.CoGroupByKey()
+      | "Split Near Duplicates" >> beam.ParDo(nd_do_fns.SplitNearDuplicates()).with_outputs(
+        nd_do_fns.SplitNearDuplicates.DUPLICATES_TAG, main='representatives')
+    )
+
+    if self.mapping_table:
+      logging.info("Writing near-duplicates to BigQuery %s", self.mapping_table)
+      mapping_table_schema = bigquery.BigQuerySchema([
+        ('representative_nwo', 'STRING'),
+        ('representative_path', 'STRING'),
+        ('representative_function_name', 'STRING'),
+        ('representative_lineno', 'STRING'),
+        ('nwo', 'STRING'),
+        ('path', 'STRING'),
+        ('function_name', 'STRING'),
+        ('lineno', 'STRING'),
+      ])
+      (split[nd_do_fns.SplitNearDuplicates.DUPLICATES_TAG]  # pylint: disable=expression-not-assigned
+        | "Save Near Duplicates" >> beam.io.WriteToBigQuery(table=self.mapping_table,
+                               schema=mapping_table_schema,
+                               create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED,
+                               write_disposition=beam.io.BigQueryDisposition.WRITE_EMPTY)
+      )
+    else:
+      logging.info("mapping_table not set will not write near-duplicates to BigQuery")
+
+    return split.representatives
@@ -0,0 +1,37 @@
+import apache_beam as beam
+
+import code_search.dataflow.do_fns.dict_to_parquet as dict_to_parquet
+
+
+class WriteToParquet(beam.PTransform):
+  """Write function dicts to Parquet files with typed columns.
+
+  This is a columnar alternative to formatting each element
+  as a CSV string. Functions are assigned to shards by a hash of
+  their location and each shard is written in row groups, see
+  `code_search.dataflow.do_fns.dict_to_parquet.WriteParquetShard`.
+  This needs pyarrow on the workers.
+
+  Args:
+    file_path_prefix: Path prefix of the output files.
+    schema: A list of tuples of a key and its column type, see
+      `code_search.dataflow.do_fns.dict_to_parquet.to_arrow_table`.
+    num_shards: Number of output shards.
+    row_group_size: Number of rows of a Parquet row group.
+  """
+
+  def __init__(self, file_path_prefix, schema, num_shards, row_group_size=10000):
+    super(WriteToParquet, self).__init__()
+
+    self.file_path_prefix = file_path_prefix
+    self.schema = schema
+    self.num_shards = num_shards
+    self.row_group_size = row_group_size
+
+  def expand(self, input_or_inputs):
+    return (input_or_inputs
+      | "Key By Shard" >> beam.ParDo(dict_to_parquet.KeyByEmbeddingShard(self.num_shards))
+      | "Group By Shard" >> beam.GroupByKey()
+      | "Write Shards" >> beam.ParDo(dict_to_parquet.WriteParquetShard(
+        self.file_path_prefix, self.schema, self.num_shards, self.row_group_size))
+    )
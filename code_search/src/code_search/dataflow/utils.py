@@ -1,30 +1,59 @@
 import logging
 import sys
+import textwrap
+import time
 
 import ast
+import inspect
+import tokenize as python_tokenize
 import astor
 import nltk.tokenize as tokenize
 import spacy
 
-en = spacy.load('en')
+_SPACY_MODEL = None
+_SPACY_TOKENIZER = None
 
 # In python2 we need to call decode but in python3 strings
 # are always unicode.
 def _maybe_decode(s):
-  if sys.version_info[0] < 3:
+  if sys.version_info[0] < 3 and isinstance(s, bytes):
     return s.decode("utf-8")
   return s
 
-def tokenize_docstring(text):
+
+def get_spacy_model():
+  """Load the spaCy English model once per process."""
+  global _SPACY_MODEL  # pylint: disable=global-statement
+  if _SPACY_MODEL is None:
+    _SPACY_MODEL = spacy.load('en')
+  return _SPACY_MODEL
+
+
+def get_spacy_tokenizer():
+  """Load only the spaCy English tokenizer once per process.
+
+  This has the tokenization rules of the English model
+  without loading its statistical models.
+  """
+  global _SPACY_TOKENIZER  # pylint: disable=global-statement
+  if _SPACY_TOKENIZER is None:
+    from spacy.lang.en import English
+    _SPACY_TOKENIZER = English().tokenizer
+  return _SPACY_TOKENIZER
+
+
+def tokenize_docstring(text, tokenizer=None):
   """Tokenize docstrings.
 
   Args:
     text: A docstring to be tokenized.
+    tokenizer: A spaCy tokenizer. Defaults to the one of the English model.
 
   Returns:
     A list of strings representing the tokens in the docstring.
   """
-  tokens = en.tokenizer(_maybe_decode(text))
+  tokenizer = tokenizer or get_spacy_model().tokenizer
+  tokens = tokenizer(_maybe_decode(text))
   return [token.text.lower() for token in tokens if not token.is_space]
 
 
@@ -41,7 +70,7 @@ def tokenize_code(text):
   """
   return tokenize.RegexpTokenizer(r'\w+').tokenize(text)
 
-def get_function_docstring_pairs(blob):
+def get_function_docstring_pairs(blob, timings=None):
   """Extract (function/method, docstring) pairs from a given code blob.
 
   This method reads a string representing a Python file, builds an
@@ -50,6 +79,8 @@ def get_function_docstring_pairs(blob):
 
   Args:
     blob: A string representing the Python file contents.
+    timings: An optional dict, in which the time spent building the AST
+      is set as "ast_parse_seconds".
 
   Returns:
     A list of tuples of the form:
@@ -66,7 +97,7 @@ def get_function_docstring_pairs(blob):
   """
   pairs = []
   try:
-    module = ast.parse(blob)
+    module = _parse(blob, timings)
     classes = [node for node in module.body if isinstance(node, ast.ClassDef)]
     functions = [node for node in module.body if isinstance(node, ast.FunctionDef)]
     for _class in classes:
@@ -92,3 +123,141 @@ def get_function_docstring_pairs(blob):
     logging.error("Exception occurred parsing code: %s", e)
 
   return pairs
+
+
+def _parse(blob, timings=None):
+  """Parse a code blob into an AST, timing it into `timings` if set."""
+  start = time.time()
+  module = ast.parse(blob)
+  if timings is not None:
+    timings['ast_parse_seconds'] = time.time() - start
+  return module
+
+
+def _function_nodes(body):
+  """Yield the functions of a module or class body, including those of nested classes."""
+  function_types = tuple(getattr(ast, name) for name in ['FunctionDef', 'AsyncFunctionDef']
+                         if hasattr(ast, name))
+  for node in body:
+    if isinstance(node, function_types):
+      yield node
+    elif isinstance(node, ast.ClassDef):
+      for function in _function_nodes(node.body):
+        yield function
+
+
+def _end_lineno(node, lines):
+  """Return the last line of a node.
+
+  This is `end_lineno` on Python 3.8+. Otherwise it is the
+  last line of any node below it, extended over the following
+  lines which are more indented than the node, such as closing
+  brackets, and without trailing blank lines.
+  """
+  end_lineno = getattr(node, 'end_lineno', None)
+  if end_lineno:
+    return end_lineno
+
+  end_lineno = max(child.lineno for child in ast.walk(node) if hasattr(child, 'lineno'))
+  while end_lineno < len(lines):
+    line = lines[end_lineno]
+    if line.strip() and len(line) - len(line.lstrip()) <= node.col_offset:
+      break
+    end_lineno += 1
+  while end_lineno > node.lineno and not lines[end_lineno - 1].strip():
+    end_lineno -= 1
+  return end_lineno
+
+
+def _remove_docstring(function_lines):
+  """Remove the docstring from the source lines of a function.
+
+  The docstring is the run of string tokens which follows the colon
+  ending the signature. It is cut by its position in the lines, so
+  that it matches whatever the indentation of the function, and the
+  lines it leaves blank are dropped. The lines are returned as is
+  if they cannot be tokenized.
+  """
+  lines_iter = iter(function_lines)
+  skipped_types = (python_tokenize.NEWLINE, python_tokenize.NL, python_tokenize.INDENT,
+                   python_tokenize.COMMENT)
+  in_signature = False
+  in_body = False
+  depth = 0
+  start = end = None
+  try:
+    for token_type, token, token_start, token_end, _ in python_tokenize.generate_tokens(
+        lambda: next(lines_iter, '')):
+      if in_body:
+        if token_type == python_tokenize.STRING:
+          start = start or token_start
+          end = token_end
+        elif token_type not in skipped_types or start:
+          break
+      elif in_signature:
+        if token in ('(', '[', '{'):
+          depth += 1
+        elif token in (')', ']', '}'):
+          depth -= 1
+        elif token == ':' and not depth:
+          in_body = True
+      elif token_type == python_tokenize.NAME and token == 'def':
+        in_signature = True
+  except (python_tokenize.TokenError, IndentationError) as e:
+    logging.warning("Could not tokenize function to remove its docstring: %s", e)
+    return function_lines
+  if start is None:
+    return function_lines
+
+  (start_row, start_col), (end_row, end_col) = start, end
+  remainder = function_lines[start_row - 1][:start_col] + function_lines[end_row - 1][end_col:]
+  remainder_lines = [remainder] if remainder.strip() else []
+  return function_lines[:start_row - 1] + remainder_lines + function_lines[end_row:]
+
+
+def extract_function_docstring_pairs(blob, timings=None):
+  """Extract (function/method, docstring) pairs in a single pass.
+
+  This returns the same tuples as `get_function_docstring_pairs`,
+  but the original function is sliced from `blob` by the line
+  range of its node (including decorators) and dedented, instead
+  of being regenerated from the AST. The function tokens hence
+  include comments. Docstrings are tokenized by the spaCy English
+  tokenizer alone, which is loaded on first use. Methods of nested
+  classes and async functions are extracted as well.
+
+  Args:
+    blob: A string representing the Python file contents.
+    timings: An optional dict like for `get_function_docstring_pairs`.
+
+  Returns:
+    A list of tuples like `get_function_docstring_pairs`.
+  """
+  pairs = []
+  try:
+    module = _parse(blob, timings)
+    lines = blob.splitlines(True)
+    tokenizer = get_spacy_tokenizer()
+
+    for f in _function_nodes(module.body):
+      start_lineno = min([f.lineno] + [d.lineno for d in f.decorator_list])
+      function_lines = lines[start_lineno - 1:_end_lineno(f, lines)]
+      source = textwrap.dedent(''.join(function_lines))
+
+      raw_docstring = ast.get_docstring(f, clean=False)
+      docstring = inspect.cleandoc(raw_docstring) if raw_docstring else ''
+      func = textwrap.dedent(''.join(_remove_docstring(function_lines))) if docstring else source
+
+      docstring_tokens = tokenize_docstring(docstring.split('\n\n')[0], tokenizer=tokenizer)
+      pairs.append((
+        _maybe_decode(f.name),
+        _maybe_decode(str(f.lineno)),
+        _maybe_decode(source),
+        _maybe_decode(' '.join(tokenize_code(func))),
+        _maybe_decode(' '.join(docstring_tokens)),
+      ))
+  except (AssertionError, MemoryError, SyntaxError,
+          UnicodeEncodeError) as e:
+    logging.error("Exception occurred parsing code: %s", e)
+
+  return pairs
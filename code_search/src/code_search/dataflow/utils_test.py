@@ -0,0 +1,116 @@
+import ast
+import logging
+import textwrap
+import unittest
+
+from code_search.dataflow import utils
+
+BLOB = textwrap.dedent('''\
+  import functools
+
+
+  def square(x):
+    """Square a number
+
+    More details here.
+    """
+    return x * x
+
+
+  class Outer(object):
+
+    @functools.wraps(square)
+    @staticmethod
+    def method(a,
+               b):
+      """Add two numbers"""
+      # A comment kept in the tokens.
+      return (a +
+              b)
+
+    class Inner(object):
+
+      def nested(self):
+        """Return a constant
+        with a wrapped line
+        """
+        return 1
+
+
+  def undocumented(y):
+    return y
+  ''')
+
+
+class TestExtractFunctionDocstringPairs(unittest.TestCase):
+  def setUp(self):
+    self.pairs = {pair[0]: pair for pair in utils.extract_function_docstring_pairs(BLOB)}
+
+  def test_functions(self):
+    self.assertEqual(sorted(self.pairs), ['method', 'nested', 'square', 'undocumented'])
+    self.assertEqual(self.pairs['square'][1], '4')
+    self.assertEqual(self.pairs['nested'][1], '25')
+
+  def test_docstring_tokens(self):
+    self.assertEqual(self.pairs['square'][4], 'square a number')
+    self.assertEqual(self.pairs['method'][4], 'add two numbers')
+    self.assertEqual(self.pairs['nested'][4], 'return a constant with a wrapped line')
+    self.assertEqual(self.pairs['undocumented'][4], '')
+
+  def test_function_tokens(self):
+    self.assertEqual(self.pairs['square'][3], 'def square x return x x')
+    self.assertEqual(self.pairs['method'][3],
+                     'functools wraps square staticmethod def method a b '
+                     'A comment kept in the tokens return a b')
+    self.assertEqual(self.pairs['nested'][3], 'def nested self return 1')
+    self.assertEqual(self.pairs['undocumented'][3], 'def undocumented y return y')
+
+  def test_original_function(self):
+    self.assertEqual(self.pairs['nested'][2], textwrap.dedent('''\
+      def nested(self):
+        """Return a constant
+        with a wrapped line
+        """
+        return 1
+      '''))
+    self.assertTrue(self.pairs['method'][2].startswith('@functools.wraps(square)\n'))
+    self.assertTrue(self.pairs['method'][2].endswith('          b)\n'))
+
+  def test_one_line_function(self):
+    pairs = utils.extract_function_docstring_pairs('def one(): "Return one"; return 1\n')
+    self.assertEqual(pairs[0][3], 'def one return 1')
+    self.assertEqual(pairs[0][4], 'return one')
+
+  @unittest.skipUnless(hasattr(ast, 'AsyncFunctionDef'), 'async functions need Python 3.5+')
+  def test_async_function(self):
+    pairs = utils.extract_function_docstring_pairs(textwrap.dedent('''\
+      class Client(object):
+
+        async def fetch(self):
+          """Fetch a value"""
+          await self.get()
+      '''))
+    self.assertEqual(pairs[0][0], 'fetch')
+    self.assertEqual(pairs[0][3], 'async def fetch self await self get')
+    self.assertEqual(pairs[0][4], 'fetch a value')
+
+  def test_end_lineno_fallback(self):
+    """The last lines without `end_lineno`, as on Python 2.7."""
+    lines = BLOB.splitlines(True)
+    module = ast.parse(BLOB)
+    for node in ast.walk(module):
+      node.end_lineno = None
+    functions = list(utils._function_nodes(module.body))  # pylint: disable=protected-access
+    self.assertEqual(
+      [utils._end_lineno(f, lines) for f in functions],  # pylint: disable=protected-access
+      [9, 21, 29, 33])
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO,
+                      format=('%(levelname)s|%(asctime)s'
+                              '|%(pathname)s|%(lineno)d| %(message)s'),
+                      datefmt='%Y-%m-%dT%H:%M:%S',
+                      )
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
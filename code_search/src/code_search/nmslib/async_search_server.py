@@ -0,0 +1,222 @@
+"""An asyncio alternative to `code_search.nmslib.search_server`.
+
+NOTE: This module requires Python 3.5+ and aiohttp.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+from code_search.nmslib.embedding_cache import normalize_query
+from code_search.nmslib.search_engine import QueryResult
+from code_search.nmslib.search_server import knn_response, parse_add_payload, \
+  parse_delete_payload, parse_knn_payload
+
+
+class AsyncCodeSearchServer:
+  """aiohttp server wrapping the Search Engine.
+
+  This serves the routes of `CodeSearchServer` except for
+  `/batch_query` from a single asyncio event loop, including `/knn`
+  for index shards and `/add` and `/delete` for the delta tier.
+  Query embeddings are awaited over a pool of keep-alive connections
+  to TF Serving, and the CPU-bound nmslib search runs in a thread
+  pool so that it never blocks the event loop. With an `embedder`,
+  queries are instead embedded in this process and awaited from its
+  inference thread.
+
+  Args:
+    engine: An instance of CodeSearchEngine.
+    ui_dir: Path to directory containing index.html and
+            other static assets for the web application.
+    encoder: A function which takes a query string and returns the
+             base64 encoded TF Example to send to TF Serving. Unused
+             with an `embedder`.
+    serving_url: Complete URL to the TF Serving REST predict endpoint.
+    host: A string host in IPv4 format.
+    port: An integer for port binding.
+    num_search_threads: Number of threads running nmslib queries.
+    max_connections: Maximum number of concurrent connections to TF Serving.
+    embedding_cache: An optional EmbeddingCache consulted before TF Serving.
+    embedder: An optional SavedModelEmbedder used instead of TF Serving.
+  """
+  def __init__(self, engine, ui_dir, encoder, serving_url, host='0.0.0.0', port=8008,
+               num_search_threads=4, max_connections=100, embedding_cache=None,
+               embedder=None):
+    self.engine = engine
+    self.ui_dir = ui_dir
+    self.encoder = encoder
+    self.serving_url = serving_url
+    self.host = host
+    self.port = port
+    self.max_connections = max_connections
+    self.embedding_cache = embedding_cache
+    self.embedder = embedder
+
+    self.executor = ThreadPoolExecutor(max_workers=num_search_threads)
+    self.session = None
+
+    self.app = web.Application()
+    self.app.on_startup.append(self.start_session)
+    self.app.on_cleanup.append(self.close_session)
+    self.init_routes()
+
+  def init_routes(self):
+    self.app.router.add_get('/', self.index)
+    self.app.router.add_get('/ping', self.ping)
+    self.app.router.add_get('/stats', self.stats)
+    self.app.router.add_get('/query', self.query)
+    self.app.router.add_post('/knn', self.knn)
+    self.app.router.add_post('/add', self.add)
+    self.app.router.add_post('/delete', self.delete)
+    if os.path.isdir(self.ui_dir):
+      self.app.router.add_static('/', self.ui_dir)
+    else:
+      logging.warning("UI directory %s does not exist; not serving the UI", self.ui_dir)
+
+  async def start_session(self, _app):
+    connector = aiohttp.TCPConnector(limit=self.max_connections)
+    self.session = aiohttp.ClientSession(connector=connector)
+
+  async def close_session(self, _app):
+    await self.session.close()
+    self.executor.shutdown(wait=False)
+
+  async def index(self, _request):
+    redirect_path = os.environ.get('PUBLIC_URL', '') + '/index.html'
+    raise web.HTTPFound(redirect_path)
+
+  async def ping(self, _request):
+    return web.json_response({'status': 200})
+
+  async def stats(self, _request):
+    stats = self.engine.stats()
+    if self.embedding_cache:
+      stats['embedding_cache'] = self.embedding_cache.stats()
+    return web.json_response(stats)
+
+  async def query(self, request):
+    query_str = request.query.get('q')
+    logging.info("Got query: %s", query_str)
+    if not query_str:
+      return web.json_response({'status': 400, 'error': 'empty query'}, status=400)
+
+    num_results = int(request.query.get('n', 2))
+    filters = {'nwo': request.query.get('nwo'), 'path_prefix': request.query.get('path')}
+    if (filters['nwo'] or filters['path_prefix']) and not self.engine.filtered_search:
+      return web.json_response({'status': 400, 'error': 'filtered search is disabled'},
+                               status=400)
+
+    if self.engine.hybrid:
+      result = await self.hybrid_query(query_str, num_results, filters)
+    else:
+      embedding = await self.embed_query(query_str)
+      result = await asyncio.get_event_loop().run_in_executor(
+        self.executor, functools.partial(self.engine.search, embedding, num_results, **filters))
+    return web.json_response({'result': result, 'version': result.version,
+                              'retrieval': result.retrieval, 'partial': result.partial})
+
+  async def knn(self, request):
+    """Serve the raw nearest neighbours of embeddings to a merging server, see `RemoteShard`."""
+    try:
+      embeddings, num_results = parse_knn_payload(await self.json_payload(request))
+    except ValueError as e:
+      return web.json_response({'status': 400, 'error': str(e)}, status=400)
+
+    neighbours, version = await asyncio.get_event_loop().run_in_executor(
+      self.executor, functools.partial(self.engine.knn, embeddings, k=num_results))
+    return web.json_response(knn_response(neighbours, version))
+
+  async def add(self, request):
+    """Add items to the delta tier of the engine, see `CodeSearchEngine.add`."""
+    payload = await self.json_payload(request)
+    try:
+      embeddings, rows = parse_add_payload(payload, self.engine.DICT_LABELS)
+      ids = await asyncio.get_event_loop().run_in_executor(
+        self.executor, functools.partial(self.engine.add, embeddings, rows))
+    except ValueError as e:
+      return web.json_response({'status': 400, 'error': str(e)}, status=400)
+    return web.json_response({'ids': ids, 'version': self.engine.version})
+
+  async def delete(self, request):
+    """Delete items from the engine, see `CodeSearchEngine.delete`."""
+    payload = await self.json_payload(request)
+    try:
+      ids = parse_delete_payload(payload)
+      await asyncio.get_event_loop().run_in_executor(
+        self.executor, functools.partial(self.engine.delete, ids))
+    except (ValueError, IndexError) as e:
+      return web.json_response({'status': 400, 'error': str(e)}, status=400)
+    return web.json_response({'status': 200, 'version': self.engine.version})
+
+  @staticmethod
+  async def json_payload(request):
+    """Return the JSON object of a request body, or an empty dict if it has none."""
+    try:
+      payload = await request.json()
+    except ValueError:
+      return {}
+    return payload if isinstance(payload, dict) else {}
+
+  async def hybrid_query(self, query_str, k, filters):
+    """Fuse the lexical and vector results of a query, like `CodeSearchEngine.hybrid_query`."""
+    loop = asyncio.get_event_loop()
+    depth = max(k, self.engine.fusion_depth)
+    lexical = loop.run_in_executor(self.executor, functools.partial(
+      self.engine.lexical_query, query_str, depth, **filters))
+
+    vector_result = None
+    if self.engine.embedding_available():
+      try:
+        embedding = await asyncio.wait_for(self.embed_query(query_str),
+                                           self.engine.embedding_timeout)
+        vector_result = await loop.run_in_executor(self.executor, functools.partial(
+          self.engine.search, embedding, depth, **filters))
+      except asyncio.TimeoutError:
+        self.engine.embedding_failed(
+          'timed out after {}s'.format(self.engine.embedding_timeout))
+      except (aiohttp.ClientError, KeyError, ValueError) as e:
+        self.engine.embedding_failed(e)
+
+    lexical_result = await lexical
+    if vector_result is None:
+      return QueryResult(lexical_result[:k], lexical_result.version, 'lexical')
+    return self.engine.fuse([vector_result, lexical_result], k)
+
+  async def embed_query(self, query_str):
+    """Embed a query string without blocking the event loop."""
+    if self.embedding_cache:
+      query_str = normalize_query(query_str)
+      embedding = self.embedding_cache.get(query_str)
+      if embedding is not None:
+        return embedding
+
+    if self.embedder:
+      embedding = await asyncio.wrap_future(self.embedder.embed_async(query_str))
+    else:
+      embedding = await self.request_embedding(query_str)
+
+    if self.embedding_cache:
+      self.embedding_cache.put(query_str, embedding)
+    return embedding
+
+  async def request_embedding(self, query_str):
+    """Embed a query string with a request to TF Serving."""
+    data = {"instances": [{"input": {"b64": self.encoder(query_str)}}]}
+    logging.info("Sending request to: %s", self.serving_url)
+    async with self.session.post(self.serving_url, data=json.dumps(data),
+                                 headers={'content-type': 'application/json'}) as response:
+      if response.status != 200:
+        logging.error("Request failed; status: %s reason %s response: %s",
+                      response.status, response.reason, await response.text())
+      result = await response.json()
+
+    return result['predictions'][0]['outputs']
+
+  def run(self):
+    web.run_app(self.app, host=self.host, port=self.port)
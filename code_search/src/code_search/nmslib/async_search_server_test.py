@@ -0,0 +1,130 @@
+"""Tests for `code_search.nmslib.async_search_server`.
+
+NOTE: This module requires Python 3.8+ and aiohttp.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import Future
+import numpy as np
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase, TestServer
+
+from code_search.nmslib.async_search_server import AsyncCodeSearchServer
+from code_search.nmslib.delta_index import EMBEDDINGS_SUFFIX
+from code_search.nmslib.search_engine import CodeSearchEngine
+
+
+class FakeEmbedder:
+  """Embed queries in the calling thread like a `SavedModelEmbedder`."""
+
+  def __init__(self, embedding_fn):
+    self.embedding_fn = embedding_fn
+
+  def embed_async(self, query_str):
+    future = Future()
+    future.set_result(self.embedding_fn(query_str))
+    return future
+
+
+class TestAsyncCodeSearchServer(AioHTTPTestCase):
+  async def get_application(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    index_file = os.path.join(self.tmp_dir, 'code.index')
+
+    self.data = np.random.RandomState(0).randn(50, 8).astype(np.float32)
+    rows = [['owner/repo', 'src/mod.py', 'f{}'.format(i), str(i), ''] for i in range(50)]
+    CodeSearchEngine.create_index(self.data, index_file, print_progress=False)
+    np.save(index_file + EMBEDDINGS_SUFFIX, self.data)
+    engine = CodeSearchEngine(index_file, rows, embedding_fn=None, version='v1', delta_tier=True)
+
+    # A fake TF Serving predict endpoint.
+    serving_app = web.Application()
+    serving_app.router.add_post('/v1/models/t2t:predict', self.predict)
+    self.serving_server = TestServer(serving_app)
+    await self.serving_server.start_server()
+    self.addAsyncCleanup(self.serving_server.close)
+
+    self.server = AsyncCodeSearchServer(engine, self.tmp_dir, encoder=lambda query_str: query_str,
+                                        serving_url=str(self.serving_server.make_url(
+                                          '/v1/models/t2t:predict')))
+    return self.server.app
+
+  def embed(self, query_str):
+    """Embed `fN` as the vector of item N."""
+    return self.data[int(query_str[1:])].tolist()
+
+  async def predict(self, request):
+    query_str = (await request.json())['instances'][0]['input']['b64']
+    return web.json_response({'predictions': [{'outputs': self.embed(query_str)}]})
+
+  async def test_query(self):
+    async with self.client.get('/query', params={'q': 'f3', 'n': '2'}) as response:
+      self.assertEqual(response.status, 200)
+      body = await response.json()
+    self.assertEqual(body['result'][0]['function_name'], 'f3')
+    self.assertEqual(len(body['result']), 2)
+    self.assertEqual(body['version'], 'v1')
+    self.assertFalse(body['partial'])
+
+  async def test_query_embedder(self):
+    self.server.embedder = FakeEmbedder(self.embed)
+    async with self.client.get('/query', params={'q': 'f7'}) as response:
+      self.assertEqual((await response.json())['result'][0]['function_name'], 'f7')
+
+  async def test_query_invalid(self):
+    async with self.client.get('/query', params={'q': ''}) as response:
+      self.assertEqual(response.status, 400)
+    async with self.client.get('/query', params={'q': 'f3', 'nwo': 'owner/repo'}) as response:
+      self.assertEqual(response.status, 400)
+
+  async def test_knn(self):
+    payload = {'embeddings': self.data[[3, 7]].tolist(), 'n': 2}
+    async with self.client.post('/knn', json=payload) as response:
+      self.assertEqual(response.status, 200)
+      body = await response.json()
+    self.assertEqual([ids[0] for ids in body['ids']], [3, 7])
+    self.assertEqual([len(dists) for dists in body['dists']], [2, 2])
+    self.assertEqual(body['version'], 'v1')
+
+    async with self.client.post('/knn', json={'embeddings': []}) as response:
+      self.assertEqual(response.status, 400)
+    async with self.client.post('/knn', data='not json') as response:
+      self.assertEqual(response.status, 400)
+
+  async def test_add_delete(self):
+    embedding = np.random.RandomState(1).randn(8).tolist()
+    payload = {'embeddings': [embedding], 'items': [{'function_name': 'g'}]}
+    async with self.client.post('/add', json=payload) as response:
+      self.assertEqual(response.status, 200)
+      self.assertEqual((await response.json())['ids'], [50])
+
+    async with self.client.post('/knn', json={'embeddings': [embedding], 'n': 1}) as response:
+      self.assertEqual((await response.json())['ids'], [[50]])
+
+    async with self.client.post('/delete', json={'ids': [50]}) as response:
+      self.assertEqual(response.status, 200)
+    async with self.client.post('/knn', json={'embeddings': [embedding], 'n': 1}) as response:
+      self.assertNotEqual((await response.json())['ids'], [[50]])
+
+  async def test_add_delete_invalid(self):
+    for payload in [{}, {'embeddings': [[1.] * 8], 'items': ['g']},
+                    {'embeddings': [[1.] * 4], 'items': [{}]}]:
+      async with self.client.post('/add', json=payload) as response:
+        self.assertEqual(response.status, 400, payload)
+    for payload in [{}, {'ids': []}, {'ids': ['x']}, {'ids': [99]}]:
+      async with self.client.post('/delete', json=payload) as response:
+        self.assertEqual(response.status, 400, payload)
+
+  async def test_stats(self):
+    async with self.client.get('/stats') as response:
+      self.assertEqual(await response.json(), {'version': 'v1', 'num_items': 50,
+                                               'delta_items': 0, 'deleted_items': 0})
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -9,8 +9,18 @@ def add_common_arguments(parser):
                      help='Path to CSV file for reverse index lookup.')
   parser.add_argument('--index_file', type=str, metavar='',
                      help='Path to output index file')
+  parser.add_argument('--lookup_store_file', type=str, metavar='', default='',
+                     help='Path to binary lookup store file. If set, it is used by the '
+                          'server instead of the lookup CSV file')
   parser.add_argument('--tmp_dir', type=str, metavar='', default='/tmp/code_search',
                      help='Path to temporary data directory')
+  parser.add_argument('--num_index_shards', type=int, metavar='', default=1,
+                     help='Number of index shards. Each shard has its own index and lookup '
+                          'files, named like --index_file, --lookup_file and '
+                          '--lookup_store_file with a "-XXXXX-of-NNNNN" suffix')
+  parser.add_argument('--index_shard', type=int, metavar='', default=None,
+                     help='Only build or serve this index shard. By default all shards '
+                          'are built, and served by merging their results')
 
 
 def add_server_arguments(parser):
@@ -18,12 +28,151 @@ def add_server_arguments(parser):
                       help='Name of the T2T problem')
   parser.add_argument('--serving_url', type=str, metavar='',
                       help='Complete URL to TF Serving Inference server')
+  parser.add_argument('--vocab_file', type=str, metavar='', default='',
+                      help='Path to the subword vocabulary file of --problem, e.g. '
+                           '<data_dir>/vocab.kf_github_function_docstring.8192.subwords. If '
+                           'set, queries are encoded without importing TensorFlow and T2T')
   parser.add_argument('--host', type=str, metavar='', default='0.0.0.0',
                      help='Host to start server on')
   parser.add_argument('--port', type=int, metavar='', default=8008,
                      help='Port to bind server to')
   parser.add_argument('--ui_dir', type=int, metavar='',
                      help='Path to static assets for the UI')
+  parser.add_argument('--max_batch_size', type=int, metavar='', default=1,
+                      help='Maximum number of concurrent queries coalesced into one '
+                           'embedding request and nmslib batch query. 1 disables batching')
+  parser.add_argument('--max_batch_wait_ms', type=int, metavar='', default=5,
+                      help='Maximum time in milliseconds a query waits for others '
+                           'to join its batch')
+  parser.add_argument('--embedding_cache_size', type=int, metavar='', default=0,
+                      help='Maximum number of query embeddings to cache. 0 disables '
+                           'the cache')
+  parser.add_argument('--model_version', type=str, metavar='', default='',
+                      help='Version of the model behind --serving_url, which keys cached '
+                           'embeddings. Defaults to the newest available version reported by '
+                           'the TF Serving model status endpoint, checked every '
+                           '--model_version_interval seconds')
+  parser.add_argument('--model_version_interval', type=int, metavar='', default=60,
+                      help='Time in seconds between two checks of the version of the model '
+                           'behind --serving_url, with --embedding_cache_size')
+  parser.add_argument('--index_watch_dir', type=str, metavar='', default='',
+                      help='Path to a directory with one subdirectory per index version. '
+                           'If set, the newest version is served and new versions are '
+                           'swapped in without a restart. Files in each version are named '
+                           'like --index_file, --lookup_file and --lookup_store_file')
+  parser.add_argument('--index_watch_subdir', type=str, metavar='', default='',
+                      help='Path of the index files relative to each version directory')
+  parser.add_argument('--index_watch_interval', type=int, metavar='', default=300,
+                      help='Time in seconds between two checks for a new index version')
+  parser.add_argument('--async_server', action='store_true',
+                      help='Serve with asyncio and a pooled, keep-alive HTTP client to '
+                           'TF Serving. Requires Python 3.5+ and aiohttp')
+  parser.add_argument('--num_search_threads', type=int, metavar='', default=4,
+                      help='Number of threads running index queries in async mode')
+  parser.add_argument('--max_serving_connections', type=int, metavar='', default=100,
+                      help='Maximum number of concurrent connections to TF Serving '
+                           'in async mode')
+  parser.add_argument('--shard_servers', type=str, metavar='', default='',
+                      help='Comma-separated URLs of the servers of each index shard, started '
+                           'with --index_shard. If set, shards are queried remotely and only '
+                           'their lookup files are loaded locally. With --index_watch_dir, '
+                           'the shard servers must watch the same index versions')
+  parser.add_argument('--embedding_cache_ttl', type=int, metavar='', default=3600,
+                      help='Time in seconds after which a cached query embedding expires')
+  parser.add_argument('--delta_tier', action='store_true',
+                      help='Serve the /add and /delete routes, which update an in-memory '
+                           'delta tier searched together with the index. Needs an unsharded '
+                           'index built with --save_embeddings or --quantization')
+  parser.add_argument('--compaction_interval', type=int, metavar='', default=300,
+                      help='Time in seconds between two checks for compacting the delta tier '
+                           'into a new index')
+  parser.add_argument('--compaction_min_items', type=int, metavar='', default=1000,
+                      help='Minimum number of added and deleted items to compact the delta tier')
+  parser.add_argument('--hybrid_search', action='store_true',
+                      help='Fuse the results of the vector search with those of the BM25 index '
+                           'built with --lexical_index, which are served alone when embedding '
+                           'the query fails or times out')
+  parser.add_argument('--embedding_timeout_ms', type=int, metavar='', default=0,
+                      help='Timeout in milliseconds of query embedding requests to TF Serving. '
+                           '0 disables the timeout')
+  parser.add_argument('--filtered_search', action='store_true',
+                      help='Allow restricting queries to a repository and a path prefix with '
+                           'the nwo and path parameters of /query. Needs an index built with '
+                           '--filter_index. Filters are searched exactly when the index has '
+                           'its embeddings, see --save_embeddings')
+  parser.add_argument('--exact_filter_size', type=int, metavar='', default=20000,
+                      help='Maximum number of items matching a filter for the filtered '
+                           'items to be searched exactly instead of the index')
+  parser.add_argument('--max_filter_fetch', type=int, metavar='', default=10000,
+                      help='Maximum number of neighbours fetched from the index by a filtered '
+                           'query. Queries which find fewer results than requested within '
+                           'them are marked as partial')
+  parser.add_argument('--embedding_retry_seconds', type=int, metavar='', default=10,
+                      help='Time in seconds during which queries are only served from the BM25 '
+                           'index after an embedding request failed, with --hybrid_search')
+  parser.add_argument('--saved_model_dir', type=str, metavar='', default=None,
+                      help='Path to the exported SavedModel, or to a directory of its numbered '
+                           'versions. If set, queries are embedded in this process instead '
+                           'of by --serving_url')
+  parser.add_argument('--inference_batch_size', type=int, metavar='', default=16,
+                      help='Maximum number of queries embedded at once with --saved_model_dir')
+  parser.add_argument('--inference_batch_wait_ms', type=int, metavar='', default=2,
+                      help='Maximum time in milliseconds a query waits for others to join '
+                           'its inference batch with --saved_model_dir')
+
+
+def add_index_arguments(parser):
+  parser.add_argument('--hnsw_m', type=int, metavar='', default=None,
+                      help='Maximum number of neighbours per node of the HNSW graph (M)')
+  parser.add_argument('--hnsw_ef_construction', type=int, metavar='', default=None,
+                      help='Size of the candidate list while building the index '
+                           '(efConstruction)')
+  parser.add_argument('--hnsw_ef_search', type=int, metavar='', default=None,
+                      help='Size of the candidate list while querying the index (efSearch)')
+  parser.add_argument('--index_threads', type=int, metavar='', default=None,
+                      help='Number of threads used to build the index (indexThreadQty)')
+  parser.add_argument('--quantization', type=str, metavar='', default='none',
+                      choices=['none', 'float16', 'int8'],
+                      help='Build a brute force index over float16 or int8 (with a '
+                           'per-dimension scale) vectors instead of an HNSW index. This '
+                           'trades query latency, which grows linearly with the number of '
+                           'functions, for 2x or 4x less memory. Compare both with '
+                           'benchmark_index')
+  parser.add_argument('--rescore_factor', type=int, metavar='', default=None,
+                      help='Number of candidates from the quantized vectors re-scored '
+                           'against the exact vectors per result. Only for quantized indexes')
+  parser.add_argument('--build_processes', type=int, metavar='', default=0,
+                      help='Number of processes parsing function embeddings files. '
+                           '0 uses all cores')
+  parser.add_argument('--save_embeddings', action='store_true',
+                      help='Also save the embeddings next to an HNSW index, which the server '
+                           'needs to compact the index with --delta_tier')
+  parser.add_argument('--lexical_index', action='store_true',
+                      help='Also build a BM25 inverted index of the function code, names and '
+                           'docstrings next to the index, which the server needs for '
+                           '--hybrid_search')
+  parser.add_argument('--filter_index', action='store_true',
+                      help='Also build the lists of items of each repository and path prefix '
+                           'next to the index, which the server needs for --filtered_search')
+
+
+def get_index_params(args):
+  """Return the nmslib index time parameters set on the command line."""
+  params = {
+    'M': args.hnsw_m,
+    'efConstruction': args.hnsw_ef_construction,
+    'indexThreadQty': args.index_threads,
+  }
+  return {key: value for key, value in params.items() if value is not None}
+
+
+def get_query_params(args):
+  """Return the nmslib query time parameters set on the command line."""
+  params = {
+    'efSearch': args.hnsw_ef_search,
+    'rescoreFactor': args.rescore_factor,
+  }
+  return {key: value for key, value in params.items() if value is not None}
 
 
 def parse_arguments(argv=None):
@@ -31,6 +180,9 @@ def parse_arguments(argv=None):
 
   add_common_arguments(parser)
 
+  index_args_parser = parser.add_argument_group('Index Arguments')
+  add_index_arguments(index_args_parser)
+
   server_args_parser = parser.add_argument_group('Server Arguments')
   add_server_arguments(server_args_parser)
 
@@ -38,8 +190,60 @@ def parse_arguments(argv=None):
   args.data_dir = os.path.expanduser(args.data_dir)
   args.lookup_file = os.path.expanduser(args.lookup_file)
   args.index_file = os.path.expanduser(args.index_file)
+  args.lookup_store_file = os.path.expanduser(args.lookup_store_file)
   args.tmp_dir = os.path.expanduser(args.tmp_dir)
+  args.shard_servers = [url for url in args.shard_servers.split(',') if url]
+  if args.shard_servers and len(args.shard_servers) != args.num_index_shards:
+    parser.error('--shard_servers needs one URL for each of the --num_index_shards shards')
 
   args.ui_dir = os.path.abspath(os.path.join(__file__, '../../../../ui/build'))
 
   return args
+
+
+def int_list(value):
+  return [int(item) for item in value.split(',')]
+
+
+def str_list(value):
+  return [item for item in value.split(',') if item]
+
+
+def parse_benchmark_arguments(argv=None):
+  parser = argparse.ArgumentParser(prog='Code Search Index Benchmark')
+
+  parser.add_argument('--data_dir', type=str, metavar='',
+                      help='Path to directory with CSV files containing function embeddings')
+  parser.add_argument('--output_file', type=str, metavar='', default='',
+                      help='Path to a JSON file to write the results to')
+  parser.add_argument('--tmp_dir', type=str, metavar='', default='/tmp/code_search',
+                      help='Path to temporary data directory')
+  parser.add_argument('--sample_size', type=int, metavar='', default=100000,
+                      help='Number of function embeddings to index')
+  parser.add_argument('--num_queries', type=int, metavar='', default=1000,
+                      help='Number of held out function embeddings used as queries')
+  parser.add_argument('--k', type=int, metavar='', default=10,
+                      help='Number of neighbours used to compute recall@k')
+  parser.add_argument('--seed', type=int, metavar='', default=0,
+                      help='Seed used to sample the function embeddings')
+  parser.add_argument('--hnsw_m', type=int_list, metavar='', default=[16],
+                      help='Comma-separated values of M to benchmark')
+  parser.add_argument('--hnsw_ef_construction', type=int_list, metavar='', default=[200],
+                      help='Comma-separated values of efConstruction to benchmark')
+  parser.add_argument('--hnsw_ef_search', type=int_list, metavar='', default=[10, 50, 100],
+                      help='Comma-separated values of efSearch to benchmark')
+  parser.add_argument('--index_threads', type=int, metavar='', default=0,
+                      help='Number of threads used to build each index. 0 uses all cores')
+  parser.add_argument('--quantization', type=str_list, metavar='', default=[],
+                      help='Comma-separated quantizations (float16, int8) to benchmark '
+                           'against the unquantized vectors and the HNSW configurations')
+  parser.add_argument('--rescore_factor', type=int_list, metavar='', default=[1, 4, 10],
+                      help='Comma-separated numbers of re-scored candidates per result to '
+                           'benchmark for each quantization')
+
+  args = parser.parse_args(argv)
+  args.data_dir = os.path.expanduser(args.data_dir)
+  args.output_file = os.path.expanduser(args.output_file)
+  args.tmp_dir = os.path.expanduser(args.tmp_dir)
+
+  return args
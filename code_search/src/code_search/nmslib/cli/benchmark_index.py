@@ -0,0 +1,278 @@
+import glob
+import itertools
+import json
+import logging
+import os
+import random
+import time
+import numpy as np
+
+import code_search.nmslib.cli.arguments as arguments
+from code_search.nmslib import file_io
+from code_search.nmslib.index_builder import iter_embedding_rows
+from code_search.nmslib.quantized_index import QuantizedIndex, normalize
+from code_search.nmslib.search_engine import CodeSearchEngine
+
+
+def sample_embeddings(data_dir, num_samples, seed=0):
+  """Reservoir sample function embeddings without loading all of them.
+
+  Returns:
+    A float32 numpy array with at most `num_samples` rows.
+  """
+  rng = random.Random(seed)
+  reservoir = []
+  for i, (_, embedding_vector) in enumerate(iter_embedding_rows(data_dir)):
+    if len(reservoir) < num_samples:
+      reservoir.append(embedding_vector)
+    else:
+      j = rng.randint(0, i)
+      if j < num_samples:
+        reservoir[j] = embedding_vector
+  rng.shuffle(reservoir)
+  return np.array(reservoir, dtype=np.float32)
+
+
+def exact_neighbours(data, queries, k, chunk_size=256):
+  """Compute the exact `k` nearest neighbours by cosine similarity.
+
+  Args:
+    data: A 2-D numpy array of indexed vectors.
+    queries: A 2-D numpy array of query vectors.
+    k: Number of neighbours per query.
+    chunk_size: Number of queries scored at once to bound memory.
+
+  Returns:
+    A 2-D numpy array of shape (num_queries, k) with neighbour ids
+    sorted by decreasing similarity.
+  """
+  data = normalize(data)
+  queries = normalize(queries)
+  neighbours = []
+  for start in range(0, len(queries), chunk_size):
+    sims = np.dot(queries[start:start + chunk_size], data.T)
+    rows = np.arange(len(sims))[:, np.newaxis]
+    top_k = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    order = np.argsort(-sims[rows, top_k], axis=1)
+    neighbours.append(top_k[rows, order])
+  return np.concatenate(neighbours)
+
+
+def recall_at_k(approx_ids, exact_ids):
+  """Average fraction of the exact neighbours found by the index."""
+  hits = [len(set(approx).intersection(exact))
+          for approx, exact in zip(approx_ids, exact_ids)]
+  return float(sum(hits)) / exact_ids.size
+
+
+def file_size(path_prefix):
+  return sum(os.path.getsize(path) for path in glob.glob(path_prefix + '*'))
+
+
+def measure_queries(index, queries, k):
+  """Query an index one query at a time.
+
+  Returns:
+    A tuple of the neighbour ids of every query and the query latencies.
+  """
+  latencies = []
+  approx_ids = []
+  for query in queries:
+    start = time.time()
+    ids, _ = index.knnQuery(query, k=k)
+    latencies.append(time.time() - start)
+    approx_ids.append(ids)
+  return approx_ids, latencies
+
+
+def benchmark_config(data, queries, ground_truth, k, m, ef_construction,
+                     ef_search_values, index_threads, tmp_dir):
+  """Build one index and measure it for every value of efSearch.
+
+  Returns:
+    A list of result dicts, one per value of efSearch.
+  """
+  index_params = {'M': m, 'efConstruction': ef_construction}
+  if index_threads > 0:
+    index_params['indexThreadQty'] = index_threads
+
+  index_file = os.path.join(tmp_dir, 'benchmark-m{}-efc{}.index'.format(m, ef_construction))
+  start = time.time()
+  CodeSearchEngine.create_index(data, index_file, index_params=index_params,
+                                print_progress=False)
+  build_seconds = time.time() - start
+  index_bytes = file_size(index_file)
+
+  results = []
+  for ef_search in ef_search_values:
+    index = CodeSearchEngine.load_index(index_file, {'efSearch': ef_search})
+
+    approx_ids, latencies = measure_queries(index, queries, k)
+
+    results.append({
+      'M': m,
+      'efConstruction': ef_construction,
+      'efSearch': ef_search,
+      'recall_at_k': recall_at_k(approx_ids, ground_truth),
+      'p50_latency_ms': float(np.percentile(latencies, 50)) * 1000,
+      'p99_latency_ms': float(np.percentile(latencies, 99)) * 1000,
+      'build_seconds': build_seconds,
+      'index_bytes': index_bytes,
+    })
+    logging.info("M=%d efConstruction=%d efSearch=%d recall@%d=%.4f "
+                 "p50=%.3fms p99=%.3fms build=%.1fs size=%dB",
+                 m, ef_construction, ef_search, k, results[-1]['recall_at_k'],
+                 results[-1]['p50_latency_ms'], results[-1]['p99_latency_ms'],
+                 build_seconds, index_bytes)
+
+  for path in glob.glob(index_file + '*'):
+    os.remove(path)
+
+  return results
+
+
+def benchmark_quantization(data, queries, ground_truth, k, quantization, rescore_factors,
+                           tmp_dir):
+  """Build one quantized index and measure it for every rescore factor.
+
+  Memory is reported as the bytes of the vectors held in memory,
+  next to the bytes of the unquantized float32 vectors.
+
+  Returns:
+    A list of result dicts, one per rescore factor.
+  """
+  index_file = os.path.join(tmp_dir, 'benchmark-{}.index'.format(quantization))
+  start = time.time()
+  QuantizedIndex.create(data, index_file, quantization)
+  build_seconds = time.time() - start
+  index = QuantizedIndex.load(index_file)
+
+  results = []
+  for rescore_factor in rescore_factors:
+    index.setQueryTimeParams({'rescoreFactor': rescore_factor})
+    approx_ids, latencies = measure_queries(index, queries, k)
+
+    results.append({
+      'quantization': quantization,
+      'rescoreFactor': rescore_factor,
+      'recall_at_k': recall_at_k(approx_ids, ground_truth),
+      'p50_latency_ms': float(np.percentile(latencies, 50)) * 1000,
+      'p99_latency_ms': float(np.percentile(latencies, 99)) * 1000,
+      'build_seconds': build_seconds,
+      'memory_bytes': index.nbytes,
+      'baseline_memory_bytes': data.astype(np.float32).nbytes,
+    })
+    logging.info("quantization=%s rescoreFactor=%d recall@%d=%.4f p50=%.3fms p99=%.3fms "
+                 "memory=%dB baseline=%dB", quantization, rescore_factor, k,
+                 results[-1]['recall_at_k'], results[-1]['p50_latency_ms'],
+                 results[-1]['p99_latency_ms'], results[-1]['memory_bytes'],
+                 results[-1]['baseline_memory_bytes'])
+
+  del index
+  for path in glob.glob(index_file + '*'):
+    os.remove(path)
+
+  return results
+
+
+def fastest_hnsw_result(results, recall):
+  """Return the HNSW result with the lowest p50 latency reaching `recall`.
+
+  If no HNSW configuration reaches `recall`, the one with the
+  highest recall is returned, or None if there is no result.
+  """
+  accurate = [result for result in results if result['recall_at_k'] >= recall]
+  if accurate:
+    return min(accurate, key=lambda result: result['p50_latency_ms'])
+  if results:
+    return max(results, key=lambda result: result['recall_at_k'])
+  return None
+
+
+def compare_to_hnsw(quantization_results, results, k):
+  """Add the fastest HNSW configuration as accurate as each quantized one.
+
+  A quantized index scans all its vectors for every query, so
+  its latency grows linearly with the number of functions while
+  HNSW's grows logarithmically. Each quantization result gets an
+  "hnsw_baseline" with the parameters, recall and latencies of the
+  HNSW result returned by `fastest_hnsw_result`.
+  """
+  for result in quantization_results:
+    baseline = fastest_hnsw_result(results, result['recall_at_k'])
+    if baseline is None:
+      result['hnsw_baseline'] = None
+      continue
+
+    result['hnsw_baseline'] = {key: baseline[key] for key in [
+      'M', 'efConstruction', 'efSearch', 'recall_at_k', 'p50_latency_ms', 'p99_latency_ms']}
+    logging.info("quantization=%s rescoreFactor=%d recall@%d=%.4f p50=%.3fms p99=%.3fms vs "
+                 "M=%d efConstruction=%d efSearch=%d recall@%d=%.4f p50=%.3fms p99=%.3fms",
+                 result['quantization'], result['rescoreFactor'], k, result['recall_at_k'],
+                 result['p50_latency_ms'], result['p99_latency_ms'], baseline['M'],
+                 baseline['efConstruction'], baseline['efSearch'], k, baseline['recall_at_k'],
+                 baseline['p50_latency_ms'], baseline['p99_latency_ms'])
+
+
+def benchmark_index(argv=None):
+  """Benchmark HNSW parameters on a sample of the function embeddings.
+
+  This routine samples function embeddings from the CSV files
+  written by the function embeddings Dataflow job, holds out
+  `--num_queries` of them as queries and computes their exact
+  nearest neighbours by brute force. It then builds an index for
+  every combination of `--hnsw_m` and `--hnsw_ef_construction`
+  and reports recall@k, p50/p99 query latency, build time and index
+  size for every value of `--hnsw_ef_search`. Every quantization
+  in `--quantization` is reported the same way for every value of
+  `--rescore_factor`, with its memory next to the float32 baseline
+  and its latency next to the fastest HNSW configuration with at
+  least the same recall.
+
+  Args:
+    argv: A list of strings representing command line arguments.
+  """
+  args = arguments.parse_benchmark_arguments(argv)
+
+  if not os.path.isdir(args.tmp_dir):
+    os.makedirs(args.tmp_dir)
+
+  embeddings = sample_embeddings(args.data_dir, args.sample_size + args.num_queries,
+                                 seed=args.seed)
+  queries, data = embeddings[:args.num_queries], embeddings[args.num_queries:]
+  logging.info("Benchmarking with %d indexed vectors and %d queries", len(data), len(queries))
+
+  start = time.time()
+  ground_truth = exact_neighbours(data, queries, args.k)
+  logging.info("Computed exact neighbours in %.1fs", time.time() - start)
+
+  results = []
+  for m, ef_construction in itertools.product(args.hnsw_m, args.hnsw_ef_construction):
+    results.extend(benchmark_config(data, queries, ground_truth, args.k, m, ef_construction,
+                                    args.hnsw_ef_search, args.index_threads, args.tmp_dir))
+
+  quantization_results = []
+  for quantization in args.quantization:
+    quantization_results.extend(benchmark_quantization(data, queries, ground_truth, args.k,
+                                                       quantization, args.rescore_factor,
+                                                       args.tmp_dir))
+  compare_to_hnsw(quantization_results, results, args.k)
+
+  if args.output_file:
+    logging.info("Writing results to %s", args.output_file)
+    with file_io.open_file(args.output_file, 'w') as output_file:
+      json.dump({'num_items': len(data), 'num_queries': len(queries), 'k': args.k,
+                 'results': results, 'quantization_results': quantization_results},
+                output_file, indent=2)
+
+  return results + quantization_results
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO,
+                      format=('%(levelname)s|%(asctime)s'
+                              '|%(pathname)s|%(lineno)d| %(message)s'),
+                      datefmt='%Y-%m-%dT%H:%M:%S',
+                      )
+  logging.getLogger().setLevel(logging.INFO)
+  benchmark_index()
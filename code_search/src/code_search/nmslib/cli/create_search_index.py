@@ -1,11 +1,17 @@
 import csv
 import logging
 import os
-import numpy as np
 import tensorflow as tf
 
 import code_search.nmslib.cli.arguments as arguments
 import code_search.nmslib.search_engine as search_engine
+from code_search.nmslib.delta_index import EMBEDDINGS_SUFFIX
+from code_search.nmslib.filter_index import FILTER_SUFFIX, FilterIndex
+from code_search.nmslib.index_builder import build_embeddings
+from code_search.nmslib.lexical_index import LEXICAL_SUFFIX, LexicalIndex
+from code_search.nmslib.lookup_store import LookupStoreWriter
+from code_search.nmslib.quantized_index import EXACT_SUFFIX, QuantizedIndex
+from code_search.nmslib.sharded_index import shard_file
 
 
 def create_search_index(argv=None):
@@ -15,6 +21,22 @@ def create_search_index(argv=None):
   directory, combines them into one for reverse lookup
   and uses the embeddings string to create an NMSLib index.
   This embedding is the last column of all CSV files.
+  Binary `.npy` shards with metadata CSV files written by
+  `create_function_embeddings --embeddings_format=npy` are
+  read instead if the directory has no such CSV files.
+  Files are parsed in parallel by `--build_processes`
+  processes into a memory-mapped float32 matrix.
+  If `--lookup_store_file` is set, the reverse lookup is
+  also written as a binary `LookupStore` file. With
+  `--num_index_shards`, the files are split round-robin
+  into that many independent index shards, which can be
+  built on different machines with `--index_shard`.
+  With `--quantization`, a `QuantizedIndex` is built
+  instead of an HNSW index. With `--save_embeddings`,
+  the embeddings are saved next to an HNSW index. With
+  `--lexical_index`, a BM25 `LexicalIndex` of the lookup
+  data is saved next to the index, and with `--filter_index`
+  a `FilterIndex` of it.
 
   Args:
     argv: A list of strings representing command line arguments.
@@ -27,35 +49,91 @@ def create_search_index(argv=None):
     logging.info("Creating directory %s", args.tmp_dir)
     os.makedirs(args.tmp_dir)
 
-  tmp_index_file = os.path.join(args.tmp_dir, os.path.basename(args.index_file))
-  tmp_lookup_file = os.path.join(args.tmp_dir, os.path.basename(args.lookup_file))
+  if args.index_shard is not None:
+    index_shards = [args.index_shard]
+  else:
+    index_shards = range(args.num_index_shards)
 
-  embeddings_data = []
+  for index_shard in index_shards:
+    build_index_shard(args, index_shard)
 
-  with open(tmp_lookup_file, 'w') as lookup_file:
-    lookup_writer = csv.writer(lookup_file)
-
-    for csv_file_path in tf.gfile.Glob('{}/*index*.csv'.format(args.data_dir)):
-      logging.info('Reading %s', csv_file_path)
-
-      with tf.gfile.Open(csv_file_path) as csv_file:
-        reader = csv.reader(csv_file)
-        for row in reader:
-          embedding_string = row[-1]
-          embedding_vector = [float(value) for value in embedding_string.split(',')]
-          embeddings_data.append(embedding_vector)
-
-          lookup_writer.writerow(row[:-1])
+  logging.info("Finished creating the index")
 
-  embeddings_data = np.array(embeddings_data)
 
-  search_engine.CodeSearchEngine.create_index(embeddings_data, tmp_index_file)
+def build_index_shard(args, index_shard):
+  """Build the index and lookup files of one index shard.
 
-  logging.info("Copying file %s to %s", tmp_lookup_file, args.lookup_file)
-  tf.gfile.Copy(tmp_lookup_file, args.lookup_file)
-  logging.info("Copying file %s to %s", tmp_index_file, args.index_file)
-  tf.gfile.Copy(tmp_index_file, args.index_file)
-  logging.info("Finished creating the index")
+  With a single shard these are the files named by `--index_file`,
+  `--lookup_file` and `--lookup_store_file`, see `shard_file`.
+  """
+  def output_file(path):
+    return shard_file(path, index_shard, args.num_index_shards)
+
+  index_file = output_file(args.index_file)
+  lookup_file = output_file(args.lookup_file)
+  lookup_store_file = output_file(args.lookup_store_file)
+
+  tmp_index_file = os.path.join(args.tmp_dir, os.path.basename(index_file))
+  tmp_lookup_file = os.path.join(args.tmp_dir, os.path.basename(lookup_file))
+  tmp_lookup_store_file = None
+  lookup_store_writer = None
+  if lookup_store_file:
+    tmp_lookup_store_file = os.path.join(args.tmp_dir, os.path.basename(lookup_store_file))
+    lookup_store_writer = LookupStoreWriter(
+      tmp_lookup_store_file, len(search_engine.CodeSearchEngine.DICT_LABELS))
+
+  tmp_embeddings_file = tmp_index_file + '.npy'
+
+  try:
+    embeddings_data = build_embeddings(args.data_dir, tmp_embeddings_file, tmp_lookup_file,
+                                       lookup_store_writer=lookup_store_writer,
+                                       num_processes=args.build_processes,
+                                       index_shard=index_shard,
+                                       num_index_shards=args.num_index_shards)
+
+    if lookup_store_writer:
+      lookup_store_writer.close()
+
+    if args.quantization != 'none':
+      QuantizedIndex.create(embeddings_data, tmp_index_file, args.quantization)
+    else:
+      search_engine.CodeSearchEngine.create_index(embeddings_data, tmp_index_file,
+                                                  index_params=arguments.get_index_params(args))
+
+    if args.lexical_index:
+      with open(tmp_lookup_file) as lookup_csv_file:
+        lexical_index = LexicalIndex.build(csv.reader(lookup_csv_file))
+      lexical_index.save(tmp_index_file + LEXICAL_SUFFIX)
+      logging.info("Copying file %s to %s", tmp_index_file + LEXICAL_SUFFIX,
+                   index_file + LEXICAL_SUFFIX)
+      tf.gfile.Copy(tmp_index_file + LEXICAL_SUFFIX, index_file + LEXICAL_SUFFIX)
+
+    if args.filter_index:
+      with open(tmp_lookup_file) as lookup_csv_file:
+        filter_index = FilterIndex.build(csv.reader(lookup_csv_file))
+      filter_index.save(tmp_index_file + FILTER_SUFFIX)
+      logging.info("Copying file %s to %s", tmp_index_file + FILTER_SUFFIX,
+                   index_file + FILTER_SUFFIX)
+      tf.gfile.Copy(tmp_index_file + FILTER_SUFFIX, index_file + FILTER_SUFFIX)
+
+    logging.info("Copying file %s to %s", tmp_lookup_file, lookup_file)
+    tf.gfile.Copy(tmp_lookup_file, lookup_file)
+    if tmp_lookup_store_file:
+      logging.info("Copying file %s to %s", tmp_lookup_store_file, lookup_store_file)
+      tf.gfile.Copy(tmp_lookup_store_file, lookup_store_file)
+    if args.quantization != 'none':
+      logging.info("Copying file %s to %s", tmp_index_file + EXACT_SUFFIX,
+                   index_file + EXACT_SUFFIX)
+      tf.gfile.Copy(tmp_index_file + EXACT_SUFFIX, index_file + EXACT_SUFFIX)
+    elif args.save_embeddings:
+      logging.info("Copying file %s to %s", tmp_embeddings_file, index_file + EMBEDDINGS_SUFFIX)
+      tf.gfile.Copy(tmp_embeddings_file, index_file + EMBEDDINGS_SUFFIX)
+    logging.info("Copying file %s to %s", tmp_index_file, index_file)
+    tf.gfile.Copy(tmp_index_file, index_file)
+  finally:
+    # The embeddings are only kept in the index directory, see `--save_embeddings`.
+    if os.path.exists(tmp_embeddings_file):
+      os.remove(tmp_embeddings_file)
 
 
 if __name__ == '__main__':
@@ -8,25 +8,46 @@ import csv  # pylint: disable=wrong-import-order
 import logging  # pylint: disable=wrong-import-order
 import json  # pylint: disable=wrong-import-order
 import os  # pylint: disable=wrong-import-order
+import shutil  # pylint: disable=wrong-import-order
 import functools # pylint: disable=wrong-import-order
 import requests  # pylint: disable=wrong-import-order
-import tensorflow as tf
 
 import code_search.nmslib.cli.arguments as arguments
-import code_search.t2t.query as query
-# We need to import function_docstring to ensure the problem is registered
-from code_search.t2t import function_docstring # pylint: disable=unused-import
+import code_search.nmslib.subword_encoder as subword_encoder
+from code_search.nmslib import file_io
+from code_search.nmslib.delta_index import EMBEDDINGS_SUFFIX, DeltaCompactor
+from code_search.nmslib.embedding_cache import EmbeddingCache, ModelVersionWatcher
+from code_search.nmslib.index_watcher import IndexWatcher
+from code_search.nmslib.filter_index import FILTER_SUFFIX
+from code_search.nmslib.lexical_index import LEXICAL_SUFFIX
+from code_search.nmslib.lookup_store import LookupStore
+from code_search.nmslib.quantized_index import EXACT_SUFFIX
+from code_search.nmslib.saved_model_embedder import SavedModelEmbedder, latest_saved_model_dir
 from code_search.nmslib.search_engine import CodeSearchEngine
 from code_search.nmslib.search_server import CodeSearchServer
+from code_search.nmslib.sharded_index import ShardedLookup, shard_file
 
 
-def embed_query(encoder, serving_url, query_str):
-  data = {"instances": [{"input": {"b64": encoder(query_str)}}]}
+def embed_queries(encoder, serving_url, query_strs, session=None, timeout=None):
+  """Embed a list of query strings with a single request to TF Serving.
 
-  logging.info("Sending request to: %s", serving_url)
-  response = requests.post(url=serving_url,
-                           headers={'content-type': 'application/json'},
-                           data=json.dumps(data))
+  Args:
+    encoder: A function which encodes a string into a base64 TF Example.
+    serving_url: Complete URL to the TF Serving REST predict endpoint.
+    query_strs: A list of strings to embed.
+    session: An optional `requests.Session` whose keep-alive connections are
+             reused across calls.
+    timeout: An optional timeout in seconds of the request.
+  """
+  data = {"instances": [{"input": {"b64": encoder(query_str)}}
+                        for query_str in query_strs]}
+
+  logging.info("Sending request with %d instances to: %s", len(query_strs),
+               serving_url)
+  response = (session or requests).post(url=serving_url,
+                                        headers={'content-type': 'application/json'},
+                                        data=json.dumps(data),
+                                        timeout=timeout)
 
   if not response.ok:
     logging.error("Request failed; status: %s reason %s response: %s",
@@ -34,22 +55,190 @@ def embed_query(encoder, serving_url, query_str):
                   response.reason,
                   response.content)
   result = response.json()
-  return result['predictions'][0]['outputs']
+  return [prediction['outputs'] for prediction in result['predictions']]
+
 
+def embed_query(encoder, serving_url, query_str, session=None, timeout=None):
+  return embed_queries(encoder, serving_url, [query_str], session=session, timeout=timeout)[0]
+
+
+def fetch_model_version(serving_url, session=None, timeout=None):
+  """Return the newest available version of the model behind a predict URL.
+
+  This asks the TF Serving model status endpoint, e.g.
+  `http://host:8501/v1/models/t2t_code_search` for the predict URL
+  `http://host:8501/v1/models/t2t_code_search:predict`.
+  """
+  status_url = serving_url.rsplit(':predict', 1)[0]
+  response = (session or requests).get(status_url, timeout=timeout)
+  response.raise_for_status()
+  versions = [status['version'] for status in response.json()['model_version_status']
+              if status['state'] == 'AVAILABLE']
+  if not versions:
+    raise ValueError('No available model version at {}'.format(status_url))
+  return max(versions, key=int)
 
-def build_query_encoder(problem, data_dir, embed_code=False):
+
+def build_query_encoder(problem, data_dir, embed_code=False, raw=False, vocab_file=None):
   """Build a query encoder.
 
+  The subword ids of the tokens of queries are memoized
+  across queries, see `query.encode_queries`. With a
+  `vocab_file`, queries are encoded the same way without
+  TensorFlow and T2T, see `subword_encoder`.
+
   Args:
     problem: The name of the T2T problem to use
     data_dir: Directory containing the data. This should include the vocabulary.
     embed_code: Whether to compute embeddings for natural language or code.
+    raw: Whether to encode queries as serialized TF Examples instead of base64.
+    vocab_file: Path to the subword vocabulary file of the problem.
   """
+  if vocab_file:
+    vocab = subword_encoder.SubwordEncoder.load(vocab_file)
+
+    def encode_subwords(query_str):
+      return subword_encoder.encode_queries(vocab, embed_code, [query_str], raw=raw)[0]
+
+    return encode_subwords
+
+  # Imported here as TensorFlow and T2T take long to import and are not
+  # needed with a vocabulary file.
+  import code_search.t2t.query as query
+  # We need to import function_docstring to ensure the problem is registered
+  from code_search.t2t import function_docstring # pylint: disable=unused-import
+
   encoder = query.get_encoder(problem, data_dir)
-  query_encoder = functools.partial(query.encode_query, encoder, embed_code)
+  cache = {}
+
+  def query_encoder(query_str):
+    return query.encode_queries(encoder, embed_code, [query_str], raw=raw, cache=cache)[0]
 
   return query_encoder
 
+def load_lookup_data(lookup_file, lookup_store_file, tmp_dir):
+  """Load the lookup data of an index.
+
+  Args:
+    lookup_file: Path string to the lookup CSV file.
+    lookup_store_file: Path string to the binary lookup store file. If set,
+                       it is copied to `tmp_dir` and used instead of the
+                       lookup CSV file.
+    tmp_dir: Path string to the local directory to copy files to.
+  """
+  if lookup_store_file:
+    tmp_lookup_store_file = os.path.join(tmp_dir, os.path.basename(lookup_store_file))
+    logging.info('Reading %s', lookup_store_file)
+    if not os.path.isfile(tmp_lookup_store_file):
+      file_io.copy(lookup_store_file, tmp_lookup_store_file)
+    return LookupStore(tmp_lookup_store_file)
+
+  logging.info('Reading %s', lookup_file)
+  lookup_data = []
+  with file_io.open_file(lookup_file) as lookup_csv_file:
+    reader = csv.reader(lookup_csv_file)
+    for row in reader:
+      lookup_data.append(row)
+  return lookup_data
+
+
+def load_index_files(index_file, lookup_file, lookup_store_file, tmp_dir):
+  """Copy an index to a local directory and load its lookup data.
+
+  Args:
+    index_file: Path string to the nmslib index file.
+    lookup_file: Path string to the lookup CSV file.
+    lookup_store_file: Path string to the binary lookup store file. If set,
+                       it is used instead of the lookup CSV file.
+    tmp_dir: Path string to the local directory to copy files to.
+
+  Returns:
+    A tuple of the local index file path and the lookup data.
+  """
+  if not os.path.isdir(tmp_dir):
+    os.makedirs(tmp_dir)
+
+  lookup_data = load_lookup_data(lookup_file, lookup_store_file, tmp_dir)
+
+  tmp_index_file = os.path.join(tmp_dir, os.path.basename(index_file))
+
+  # The exact vectors of a quantized index, the embeddings saved
+  # with an HNSW index, the lexical index and the filter index are
+  # stored next to it.
+  for suffix in [EXACT_SUFFIX, EMBEDDINGS_SUFFIX, LEXICAL_SUFFIX, FILTER_SUFFIX]:
+    if file_io.exists(index_file + suffix):
+      logging.info('Reading %s', index_file + suffix)
+      if not os.path.isfile(tmp_index_file + suffix):
+        file_io.copy(index_file + suffix, tmp_index_file + suffix)
+
+  logging.info('Reading %s', index_file)
+  if not os.path.isfile(tmp_index_file):
+    file_io.copy(index_file, tmp_index_file)
+
+  return tmp_index_file, lookup_data
+
+
+def load_index_shards(args, index_file, lookup_file, lookup_store_file, tmp_dir):
+  """Load the index files served with the sharding arguments.
+
+  Without `--num_index_shards` this is `load_index_files`. With
+  `--index_shard`, only the files of that shard are loaded. Otherwise
+  the lookup data of all shards is loaded together with their index
+  files, or with the URLs of `--shard_servers`.
+
+  Returns:
+    A tuple of the local index file path, or a list of index shard
+    paths and URLs, and the lookup data.
+  """
+  num_shards = args.num_index_shards
+  if num_shards <= 1:
+    return load_index_files(index_file, lookup_file, lookup_store_file, tmp_dir)
+
+  def shard_files(shard):
+    return [shard_file(path, shard, num_shards)
+            for path in [index_file, lookup_file, lookup_store_file]]
+
+  if args.index_shard is not None:
+    return load_index_files(*shard_files(args.index_shard), tmp_dir=tmp_dir)
+
+  index_files = []
+  lookups = []
+  for shard in range(num_shards):
+    shard_index_file, shard_lookup_file, shard_lookup_store_file = shard_files(shard)
+    if args.shard_servers:
+      if not os.path.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+      index_files.append(args.shard_servers[shard])
+      lookups.append(load_lookup_data(shard_lookup_file, shard_lookup_store_file, tmp_dir))
+    else:
+      tmp_index_file, lookup_data = load_index_files(shard_index_file, shard_lookup_file,
+                                                     shard_lookup_store_file, tmp_dir)
+      index_files.append(tmp_index_file)
+      lookups.append(lookup_data)
+
+  return index_files, ShardedLookup(lookups)
+
+
+def load_index_version(args, version, version_path):
+  """Load one version of the index watched with `--index_watch_dir`.
+
+  Each version directory holds files with the same names as
+  `--index_file`, `--lookup_file` and `--lookup_store_file`.
+  """
+  def version_file(path):
+    return path and os.path.join(version_path, os.path.basename(path))
+
+  return load_index_shards(args,
+                           version_file(args.index_file),
+                           version_file(args.lookup_file),
+                           version_file(args.lookup_store_file),
+                           os.path.join(args.tmp_dir, 'versions', version))
+
+
+def remove_index_version(args, version):
+  shutil.rmtree(os.path.join(args.tmp_dir, 'versions', version), ignore_errors=True)
+
+
 def start_search_server(argv=None):
   """Start a Flask REST server.
 
@@ -57,6 +246,24 @@ def start_search_server(argv=None):
   an in memory index and a reverse-lookup database of
   Python files which can be queried via a simple REST
   API. It also serves the UI for a friendlier interface.
+  With `--num_index_shards`, results of all the index
+  shards are merged, and with `--index_shard` the server
+  serves a single shard to such a merging server. With
+  `--delta_tier`, items can be added and deleted without
+  rebuilding the index and are periodically compacted
+  into a new index. With `--hybrid_search`, queries are
+  also run against the BM25 index built with
+  `--lexical_index`, which serves them alone when
+  embedding the query fails or times out. With
+  `--filtered_search`, queries can be restricted to a
+  repository and a path prefix with the filter index built
+  with `--filter_index`. With `--saved_model_dir`,
+  queries are embedded by the SavedModel in this process
+  instead of by TF Serving. Cached query embeddings are
+  keyed on the version of the model, see `--model_version`.
+  With `--vocab_file`, queries are encoded without importing
+  TensorFlow, which is then only needed to read remote files
+  or with `--saved_model_dir`.
 
   Args:
     argv: A list of strings representing command line arguments.
@@ -66,26 +273,116 @@ def start_search_server(argv=None):
   if not os.path.isdir(args.tmp_dir):
     os.makedirs(args.tmp_dir)
 
-  logging.info('Reading %s', args.lookup_file)
-  lookup_data = []
-  with tf.gfile.Open(args.lookup_file) as lookup_file:
-    reader = csv.reader(lookup_file)
-    for row in reader:
-      lookup_data.append(row)
+  watcher = None
+  version = None
+  if args.index_watch_dir:
+    # A version is complete once the index files of all its served shards exist.
+    shards = range(args.num_index_shards) if args.index_shard is None else [args.index_shard]
+    index_names = [shard_file(os.path.basename(args.index_file), shard, args.num_index_shards)
+                   for shard in shards]
+    watcher = IndexWatcher(args.index_watch_dir, index_names,
+                           functools.partial(load_index_version, args),
+                           subdir=args.index_watch_subdir,
+                           interval_seconds=args.index_watch_interval,
+                           cleanup_fn=functools.partial(remove_index_version, args))
+    version = watcher.latest_version()
+    if version is None:
+      raise ValueError('No complete index version found in {}'.format(args.index_watch_dir))
+    tmp_index_file, lookup_data = watcher.load(version)
+  else:
+    tmp_index_file, lookup_data = load_index_shards(args, args.index_file, args.lookup_file,
+                                                    args.lookup_store_file, args.tmp_dir)
 
-  tmp_index_file = os.path.join(args.tmp_dir, os.path.basename(args.index_file))
+  embedding_timeout = args.embedding_timeout_ms / 1000. if args.embedding_timeout_ms else None
+  query_encoder = None
+  embedder = None
+  if args.saved_model_dir:
+    # The SavedModel takes the serialized TF Examples of the natural language strings.
+    embedder = SavedModelEmbedder.load(
+      args.saved_model_dir,
+      build_query_encoder(args.problem, args.data_dir, embed_code=False, raw=True,
+                          vocab_file=args.vocab_file),
+      max_batch_size=args.inference_batch_size,
+      max_wait_ms=args.inference_batch_wait_ms)
+    embedding_fn = embedder
+    batch_embedding_fn = embedder.embed_batch
+  else:
+    # Build an an encoder for the natural language strings.
+    query_encoder = build_query_encoder(args.problem, args.data_dir,
+                                        embed_code=False, vocab_file=args.vocab_file)
+    session = requests.Session()
+    embedding_fn = functools.partial(embed_query, query_encoder, args.serving_url,
+                                     session=session, timeout=embedding_timeout)
+    batch_embedding_fn = functools.partial(embed_queries, query_encoder, args.serving_url,
+                                           session=session, timeout=embedding_timeout)
 
-  logging.info('Reading %s', args.index_file)
-  if not os.path.isfile(tmp_index_file):
-    tf.gfile.Copy(args.index_file, tmp_index_file)
+  embedding_cache = None
+  if args.embedding_cache_size > 0:
+    # Cached embeddings are keyed on the model version, so they are never
+    # shared between versions of the model.
+    version_fn = None
+    if args.saved_model_dir:
+      model_version = latest_saved_model_dir(args.saved_model_dir)
+    elif args.model_version:
+      model_version = args.model_version
+    else:
+      version_fn = functools.partial(fetch_model_version, args.serving_url,
+                                     timeout=embedding_timeout)
+      try:
+        model_version = version_fn()
+      except (requests.RequestException, KeyError, ValueError) as e:
+        # The watcher keeps trying, so the server also starts before TF Serving.
+        logging.warning("Failed to read the model version from TF Serving: %s", e)
+        model_version = args.serving_url
+
+    embedding_cache = EmbeddingCache(embedding_fn,
+                                     batch_embedding_fn=batch_embedding_fn,
+                                     max_size=args.embedding_cache_size,
+                                     ttl_seconds=args.embedding_cache_ttl,
+                                     model_version=model_version)
+    embedding_fn = embedding_cache
+    batch_embedding_fn = embedding_cache.embed_batch
+
+    if version_fn:
+      ModelVersionWatcher(embedding_cache, version_fn,
+                          interval_seconds=args.model_version_interval).start()
+
+  search_engine = CodeSearchEngine(tmp_index_file, lookup_data, embedding_fn,
+                                   batch_embedding_fn=batch_embedding_fn,
+                                   max_batch_size=args.max_batch_size,
+                                   max_batch_wait_ms=args.max_batch_wait_ms,
+                                   version=version,
+                                   query_params=arguments.get_query_params(args),
+                                   delta_tier=args.delta_tier,
+                                   index_params=arguments.get_index_params(args),
+                                   hybrid=args.hybrid_search,
+                                   filtered_search=args.filtered_search,
+                                   exact_filter_size=args.exact_filter_size,
+                                   max_filter_fetch=args.max_filter_fetch,
+                                   embedding_timeout=embedding_timeout,
+                                   embedding_retry_seconds=args.embedding_retry_seconds)
+
+  if watcher:
+    watcher.start(search_engine)
 
-  # Build an an encoder for the natural language strings.
-  query_encoder = build_query_encoder(args.problem, args.data_dir,
-                                      embed_code=False)
-  embedding_fn = functools.partial(embed_query, query_encoder, args.serving_url)
+  if args.delta_tier:
+    compactor = DeltaCompactor(os.path.join(args.tmp_dir, 'delta'),
+                               interval_seconds=args.compaction_interval,
+                               min_items=args.compaction_min_items)
+    compactor.start(search_engine)
 
-  search_engine = CodeSearchEngine(tmp_index_file, lookup_data, embedding_fn)
-  search_server = CodeSearchServer(search_engine, args.ui_dir, host=args.host, port=args.port)
+  if args.async_server:
+    # Imported here as the async server needs Python 3 and aiohttp.
+    from code_search.nmslib.async_search_server import AsyncCodeSearchServer
+    search_server = AsyncCodeSearchServer(search_engine, args.ui_dir, query_encoder,
+                                          args.serving_url, host=args.host, port=args.port,
+                                          num_search_threads=args.num_search_threads,
+                                          max_connections=args.max_serving_connections,
+                                          embedding_cache=embedding_cache,
+                                          embedder=embedder)
+  else:
+    search_server = CodeSearchServer(search_engine, args.ui_dir, host=args.host,
+                                     port=args.port)
   search_server.run()
 
 
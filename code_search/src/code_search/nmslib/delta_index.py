@@ -0,0 +1,368 @@
+import logging
+import os
+import shutil
+import threading
+import numpy as np
+
+from code_search.nmslib.quantized_index import normalize
+
+EMBEDDINGS_SUFFIX = '.npy'
+# The lookup store of the items of a compacted index.
+LOOKUP_STORE_SUFFIX = '.lookup.bin'
+
+
+def filter_tombstones(ids, dists, tombstones, k):
+  """Drop deleted ids from nearest neighbours and keep the top k."""
+  if tombstones:
+    alive = np.array([idx not in tombstones for idx in ids], dtype=bool)
+    ids, dists = ids[alive], dists[alive]
+  return ids[:k], dists[:k]
+
+
+class DeltaIndex:
+  """Brute force cosine search over vectors added at runtime.
+
+  Vectors are normalized and appended to a buffer whose capacity
+  doubles when full, so adding vectors never rebuilds anything.
+  The buffer and the number of vectors written to it are published
+  together as one tuple, and appends only write past that number,
+  so a query reads a consistent prefix of the buffer without taking
+  the lock.
+
+  This exposes the `knnQuery` and `knnQueryBatch` methods of an
+  nmslib index with the distances of nmslib's `cosinesimil` space.
+  """
+
+  def __init__(self):
+    # A tuple of the buffer (or None) and the number of vectors in it.
+    self._data = (None, 0)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return self._data[1]
+
+  @property
+  def vectors(self):
+    """The normalized vectors added so far."""
+    buffer, size = self._data
+    if buffer is None:
+      return np.zeros((0, 0), dtype=np.float32)
+    return buffer[:size]
+
+  @property
+  def dim(self):
+    """The dimension of the vectors, or None before any was added."""
+    buffer, _ = self._data
+    return buffer.shape[1] if buffer is not None else None
+
+  def add(self, vectors):
+    """Append vectors and return the id of the first one."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2 or (self.dim is not None and vectors.shape[1] != self.dim):
+      raise ValueError('Expected vectors of dimension {}, got an array of shape {}'.format(
+        self.dim, vectors.shape))
+    vectors = normalize(vectors)
+    with self._lock:
+      buffer, start = self._data
+      end = start + len(vectors)
+      if buffer is None or end > len(buffer):
+        capacity = max(end, 2 * (len(buffer) if buffer is not None else 0), 64)
+        new_buffer = np.empty((capacity, vectors.shape[1]), dtype=np.float32)
+        if start:
+          new_buffer[:start] = buffer[:start]
+        buffer = new_buffer
+      buffer[start:end] = vectors
+      self._data = (buffer, end)
+    return start
+
+  def knnQuery(self, vector, k=10):  # pylint: disable=invalid-name
+    return self.knnQueryBatch(np.asarray([vector]), k=k)[0]
+
+  def knnQueryBatch(self, vectors, k=10,  # pylint: disable=invalid-name,unused-argument
+                    num_threads=0):
+    data = self.vectors
+    k = min(k, len(data))
+    if k == 0:
+      return [(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32))
+              for _ in range(len(vectors))]
+
+    queries = normalize(np.asarray(vectors, dtype=np.float32))
+    dists = 1 - np.dot(queries, data.T)
+    results = []
+    for query_dists in dists:
+      ids = np.argpartition(query_dists, k - 1)[:k]
+      ids = ids[np.argsort(query_dists[ids], kind='mergesort')]
+      results.append((ids.astype(np.int32), query_dists[ids]))
+    return results
+
+
+class TieredIndex:
+  """Search a main index together with a delta tier of newer vectors.
+
+  Ids below `main_size` address the main index and the following
+  ids address the `DeltaIndex`, which new vectors are appended to
+  without rebuilding the main index. Deleted ids are kept in a set
+  of tombstones and filtered out of the results, for which the main
+  index is over-fetched by the number of tombstones.
+  `CodeSearchEngine.compact` folds the delta tier and the tombstones
+  into a new main index.
+
+  Items are added and deleted by external ids, which compaction
+  keeps even though it changes the position of the items in the
+  index. External ids increase with the positions, so they are
+  mapped back to positions by binary search.
+
+  This exposes the `knnQuery` and `knnQueryBatch` methods of an
+  nmslib index, so it can be used by `CodeSearchEngine` in place
+  of a single index.
+
+  Args:
+    main: A loaded nmslib index or `QuantizedIndex`.
+    main_size: Number of items in the main index.
+    embeddings: A 2-D numpy array (usually memory-mapped) of the vectors
+                of the main index, which compaction needs to rebuild it.
+    main_ids: An optional increasing int64 array of the external ids of
+              the items of the main index. Defaults to their positions.
+    next_id: The external id of the next added item. Defaults to one
+             more than the last id of the main index.
+  """
+
+  def __init__(self, main, main_size, embeddings=None, main_ids=None, next_id=None):
+    self.main = main
+    self.main_size = main_size
+    self.embeddings = embeddings
+    self.main_ids = main_ids
+    self.delta_ids = []
+    if next_id is None:
+      next_id = int(main_ids[-1]) + 1 if main_ids is not None and len(main_ids) else main_size
+    self.next_id = next_id
+    self.delta = DeltaIndex()
+    # Positions of the deleted items. Replaced rather than updated, so
+    # queries can read it without a lock.
+    self.tombstones = frozenset()
+
+  def __len__(self):
+    return self.main_size + len(self.delta)
+
+  def setQueryTimeParams(self, params):  # pylint: disable=invalid-name
+    self.main.setQueryTimeParams(params)
+
+  @property
+  def dim(self):
+    """The dimension of the vectors, or None if it is not known yet."""
+    if self.embeddings is not None:
+      return self.embeddings.shape[1]
+    return self.delta.dim
+
+  def add(self, vectors, ids=None):
+    """Append vectors to the delta tier and return their external ids.
+
+    Args:
+      vectors: A 2-D array of vectors.
+      ids: Optional increasing external ids of the vectors, above all the
+           current ones. Defaults to new ids.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 2 and self.dim is not None and vectors.shape[1] != self.dim:
+      raise ValueError('Expected vectors of dimension {}, got an array of shape {}'.format(
+        self.dim, vectors.shape))
+    if ids is None:
+      ids = list(range(self.next_id, self.next_id + len(vectors)))
+    self.delta.add(vectors)
+    self.delta_ids.extend(ids)
+    if ids:
+      self.next_id = max(self.next_id, ids[-1] + 1)
+    return list(ids)
+
+  def delete(self, ids):
+    """Mark items as deleted by external id."""
+    self.tombstones = self.tombstones.union(self.positions(ids).tolist())
+
+  def ids(self, positions):
+    """Return the external ids of items by position."""
+    positions = np.asarray(positions, dtype=np.int64)
+    main = positions < self.main_size
+    ids = np.empty(len(positions), dtype=np.int64)
+    ids[main] = positions[main] if self.main_ids is None else self.main_ids[positions[main]]
+    ids[~main] = np.asarray(self.delta_ids, dtype=np.int64)[positions[~main] - self.main_size]
+    return ids
+
+  def positions(self, ids):
+    """Return the positions of items by external id.
+
+    Raises:
+      IndexError: If an id is not one of an item of the index.
+    """
+    positions = []
+    for idx in ids:
+      position = self._position(self.main_ids, idx, self.main_size)
+      if position is None:
+        position = self._position(self.delta_ids, idx, len(self.delta_ids))
+        position = None if position is None else self.main_size + position
+      if position is None:
+        raise IndexError('index id {} not found'.format(idx))
+      positions.append(position)
+    return np.array(positions, dtype=np.int64)
+
+  @staticmethod
+  def _position(ids, idx, size):
+    if ids is None:
+      return idx if 0 <= idx < size else None
+    position = int(np.searchsorted(ids, idx))
+    return position if position < size and ids[position] == idx else None
+
+  def knnQuery(self, vector, k=10):  # pylint: disable=invalid-name
+    return self.knnQueryBatch(np.asarray([vector]), k=k)[0]
+
+  def knnQueryBatch(self, vectors, k=10, num_threads=0):  # pylint: disable=invalid-name
+    tombstones = self.tombstones
+    fetch_k = k + len(tombstones)
+
+    if self.main_size:
+      main_results = self.main.knnQueryBatch(vectors, k=min(fetch_k, self.main_size),
+                                             num_threads=num_threads)
+    else:
+      main_results = [([], [])] * len(vectors)
+    delta_results = self.delta.knnQueryBatch(vectors, k=fetch_k)
+
+    results = []
+    for (main_ids, main_dists), (delta_ids, delta_dists) in zip(main_results, delta_results):
+      ids = np.concatenate([np.asarray(main_ids, dtype=np.int64),
+                            np.asarray(delta_ids, dtype=np.int64) + self.main_size])
+      dists = np.concatenate([np.asarray(main_dists, dtype=np.float32),
+                              np.asarray(delta_dists, dtype=np.float32)])
+      order = np.argsort(dists, kind='mergesort')
+      results.append(filter_tombstones(ids[order], dists[order], tombstones, k))
+    return results
+
+  def save_vectors(self, ids, path, chunk_size=65536):
+    """Write the vectors of sorted ids to a float32 `.npy` file, a chunk at a time."""
+    if self.dim is None:
+      raise ValueError('Compacting the index needs the vectors of the main index')
+
+    ids = np.asarray(ids, dtype=np.int64)
+    vectors = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                        shape=(len(ids), self.dim))
+    for start in range(0, len(ids), chunk_size):
+      vectors[start:start + chunk_size] = self.vectors(ids[start:start + chunk_size])
+    vectors.flush()
+    del vectors
+
+  def vectors(self, ids):
+    """Return the vectors of sorted ids from both tiers."""
+    ids = np.asarray(ids, dtype=np.int64)
+    main_ids = ids[ids < self.main_size]
+    delta_ids = ids[ids >= self.main_size] - self.main_size
+    if len(main_ids) and self.embeddings is None:
+      raise ValueError('Compacting the index needs the vectors of the main index')
+
+    parts = []
+    if len(main_ids):
+      parts.append(normalize(np.asarray(self.embeddings[main_ids], dtype=np.float32)))
+    if len(delta_ids):
+      parts.append(self.delta.vectors[delta_ids])
+    return np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+
+
+class TieredLookup:
+  """The lookup data of a `TieredIndex`.
+
+  Args:
+    main: The lookup data of the main index.
+  """
+
+  def __init__(self, main):
+    self.main = main
+    self.main_size = len(main)
+    self.rows = []
+
+  def __len__(self):
+    return self.main_size + len(self.rows)
+
+  def __getitem__(self, idx):
+    if idx < 0:
+      idx += len(self)
+    if not 0 <= idx < len(self):
+      raise IndexError('lookup index out of range')
+
+    if idx < self.main_size:
+      return self.main[idx]
+    return self.rows[idx - self.main_size]
+
+  def add(self, rows):
+    self.rows.extend(rows)
+
+  def truncate(self, size):
+    """Drop the rows added after the first `size` rows."""
+    del self.rows[max(size - self.main_size, 0):]
+
+  def close(self):
+    if hasattr(self.main, 'close'):
+      self.main.close()
+
+
+class DeltaCompactor:
+  """Periodically fold the delta tier of an engine into a new main index.
+
+  Compacted indexes are written to numbered subdirectories of
+  `tmp_dir`, and the one which was replaced is removed after
+  every compaction.
+
+  Args:
+    tmp_dir: Path string to the local directory to write indexes to.
+    interval_seconds: Time in seconds between two checks of the delta tier.
+    min_items: Minimum number of added and deleted items to compact.
+  """
+
+  def __init__(self, tmp_dir, interval_seconds=300, min_items=1):
+    self.tmp_dir = tmp_dir
+    self.interval_seconds = interval_seconds
+    self.min_items = min_items
+    self.generation = 0
+
+    self._stop_event = threading.Event()
+
+  def generation_dir(self, generation):
+    return os.path.join(self.tmp_dir, 'compacted', str(generation))
+
+  def check(self, engine):
+    """Compact the engine's index if enough items were added or deleted.
+
+    Args:
+      engine: An instance of CodeSearchEngine with a delta tier.
+
+    Returns:
+      True if the index was compacted.
+    """
+    index = engine.index
+    if len(index.delta) + len(index.tombstones) < self.min_items:
+      return False
+
+    generation_dir = self.generation_dir(self.generation + 1)
+    if not os.path.isdir(generation_dir):
+      os.makedirs(generation_dir)
+
+    if not engine.compact(os.path.join(generation_dir, 'code.index')):
+      shutil.rmtree(generation_dir, ignore_errors=True)
+      return False
+
+    shutil.rmtree(self.generation_dir(self.generation), ignore_errors=True)
+    self.generation += 1
+    return True
+
+  def start(self, engine):
+    """Keep compacting the engine's index in the background."""
+    thread = threading.Thread(target=self._run, args=(engine,), name='delta-compactor')
+    thread.daemon = True
+    thread.start()
+
+  def stop(self):
+    self._stop_event.set()
+
+  def _run(self, engine):
+    while not self._stop_event.wait(self.interval_seconds):
+      try:
+        self.check(engine)
+      # Keep serving the current index whatever goes wrong with the new one.
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error("Failed to compact the index: %s", e)
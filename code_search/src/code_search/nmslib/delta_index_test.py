@@ -0,0 +1,160 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from code_search.nmslib.delta_index import EMBEDDINGS_SUFFIX, DeltaCompactor, DeltaIndex, \
+  TieredIndex, TieredLookup
+from code_search.nmslib.lookup_store import LookupStore
+from code_search.nmslib.search_engine import CodeSearchEngine
+
+
+class TestTieredIndex(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.RandomState(0)
+    self.data = rng.randn(60, 8).astype(np.float32)
+    self.queries = self.data[::7] + 0.01 * rng.randn(9, 8).astype(np.float32)
+
+    main = DeltaIndex()
+    main.add(self.data[:40])
+    self.index = TieredIndex(main, 40, embeddings=self.data[:40])
+
+  def exact_neighbours(self, data, k):
+    data = data / np.linalg.norm(data, axis=1, keepdims=True)
+    return np.argsort(-np.dot(self.queries, data.T), axis=1)[:, :k]
+
+  def test_add(self):
+    self.assertEqual(self.index.add(self.data[40:50]), list(range(40, 50)))
+    self.assertEqual(self.index.add(self.data[50:]), list(range(50, 60)))
+    self.assertEqual(len(self.index), 60)
+
+    neighbours = self.index.knnQueryBatch(self.queries, k=5)
+    for (ids, dists), expected_ids in zip(neighbours, self.exact_neighbours(self.data, 5)):
+      self.assertEqual(ids.tolist(), expected_ids.tolist())
+      self.assertTrue(np.all(np.diff(dists) >= 0))
+
+  def test_delete(self):
+    self.index.add(self.data[40:])
+    self.index.delete([0, 7, 49])
+    with self.assertRaises(IndexError):
+      self.index.delete([60])
+
+    ids, _ = self.index.knnQuery(self.data[7], k=3)
+    self.assertNotIn(7, ids.tolist())
+    self.assertEqual(len(ids), 3)
+    ids, _ = self.index.knnQuery(self.data[49], k=60)
+    self.assertEqual(sorted(ids.tolist()), sorted(set(range(60)) - {0, 7, 49}))
+
+  def test_vectors(self):
+    self.index.add(self.data[40:])
+    vectors = self.index.vectors([3, 41])
+    expected = self.data[[3, 41]] / np.linalg.norm(self.data[[3, 41]], axis=1, keepdims=True)
+    np.testing.assert_allclose(vectors, expected, rtol=1e-5)
+
+  def test_save_vectors(self):
+    self.index.add(self.data[40:])
+    path = os.path.join(tempfile.mkdtemp(), 'vectors.npy')
+    try:
+      self.index.save_vectors([3, 39, 41, 59], path, chunk_size=3)
+      np.testing.assert_allclose(np.load(path), self.index.vectors([3, 39, 41, 59]), rtol=1e-6)
+    finally:
+      shutil.rmtree(os.path.dirname(path))
+
+  def test_tiered_lookup(self):
+    lookup = TieredLookup([['a'], ['b']])
+    lookup.add([['c']])
+    self.assertEqual(len(lookup), 3)
+    self.assertEqual([lookup[i] for i in range(3)], [['a'], ['b'], ['c']])
+    self.assertEqual(lookup[-1], ['c'])
+    with self.assertRaises(IndexError):
+      lookup[3]  # pylint: disable=pointless-statement
+
+
+class TestDeltaCompaction(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.index_file = os.path.join(self.tmp_dir, 'code.index')
+
+    rng = np.random.RandomState(0)
+    self.data = rng.randn(300, 16).astype(np.float32)
+    self.rows = [['owner/repo', 'a.py', 'f{}'.format(i), str(i), ''] for i in range(300)]
+
+    CodeSearchEngine.create_index(self.data[:200], self.index_file, print_progress=False)
+    np.save(self.index_file + EMBEDDINGS_SUFFIX, self.data[:200])
+    self.engine = CodeSearchEngine(self.index_file, self.rows[:200], None, delta_tier=True,
+                                   query_params={'efSearch': 100})
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def function_names(self, embedding, k):
+    return [result['function_name'] for result in self.engine.search(embedding, k=k)]
+
+  def test_add_delete_compact(self):
+    self.assertEqual(self.engine.add(self.data[200:], self.rows[200:]), list(range(200, 300)))
+    self.engine.delete([5, 250])
+    self.assertEqual(self.function_names(self.data[260], 1), ['f260'])
+    self.assertNotIn('f250', self.function_names(self.data[250], 5))
+    self.assertNotIn('f5', self.function_names(self.data[5], 5))
+
+    compactor = DeltaCompactor(self.tmp_dir, min_items=10)
+    self.assertTrue(compactor.check(self.engine))
+    self.assertEqual(len(self.engine.index.delta), 0)
+    self.assertEqual(self.engine.index.main_size, 298)
+    self.assertEqual(len(self.engine.lookup_data), 298)
+    self.assertIsInstance(self.engine.lookup_data.main, LookupStore)
+    self.assertEqual(self.function_names(self.data[260], 1), ['f260'])
+    self.assertNotIn('f250', self.function_names(self.data[250], 5))
+    self.assertFalse(compactor.check(self.engine))
+
+    # The compacted index keeps its vectors for the next compaction.
+    self.engine.add(self.data[5:6], self.rows[5:6])
+    self.engine.delete([0])
+    self.engine.compact(os.path.join(self.tmp_dir, 'again.index'))
+    self.assertEqual(len(self.engine.lookup_data), 298)
+    self.assertEqual(self.function_names(self.data[5], 1), ['f5'])
+    self.assertEqual(self.engine.stats()['delta_items'], 0)
+
+  def test_add_invalid(self):
+    with self.assertRaises(ValueError):
+      self.engine.add(self.data[200:202, :8], self.rows[200:202])
+    with self.assertRaises(ValueError):
+      self.engine.add([list(self.data[200]), list(self.data[201][:3])], self.rows[200:202])
+    with self.assertRaises(ValueError):
+      self.engine.add(self.data[200:202], self.rows[200:201])
+
+    # Nothing was added, so the lookup data is still aligned with the index.
+    self.assertEqual(len(self.engine.lookup_data), 200)
+    self.assertEqual(len(self.engine.index), 200)
+    self.assertEqual(self.engine.add(self.data[200:201], self.rows[200:201]), [200])
+    self.assertEqual(self.function_names(self.data[200], 1), ['f200'])
+
+  def test_stable_ids(self):
+    ids = self.engine.add(self.data[200:], self.rows[200:])
+    self.engine.delete(list(range(50)))
+    self.engine.compact(os.path.join(self.tmp_dir, 'compacted.index'))
+
+    # Ids returned before compaction still address the same items.
+    self.engine.delete([ids[10], 199])
+    self.assertNotIn('f210', self.function_names(self.data[210], 5))
+    self.assertNotIn('f199', self.function_names(self.data[199], 5))
+    self.assertEqual(self.function_names(self.data[211], 1), ['f211'])
+    with self.assertRaises(IndexError):
+      self.engine.delete([0])
+
+    # New ids are never reused, even when the last items were deleted.
+    self.engine.delete([ids[-1]])
+    self.engine.compact(os.path.join(self.tmp_dir, 'again.index'))
+    self.assertEqual(self.engine.add(self.data[:1], self.rows[:1]), [300])
+
+  def test_add_without_delta_tier(self):
+    engine = CodeSearchEngine(self.index_file, self.rows[:200], None)
+    with self.assertRaises(ValueError):
+      engine.add(self.data[200:], self.rows[200:])
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -0,0 +1,165 @@
+import collections
+import logging
+import threading
+import time
+
+
+def normalize_query(query_str):
+  """Normalize a query string for caching.
+
+  Leading, trailing and repeated whitespace is removed.
+  The normalized string is also what gets embedded so that
+  all queries sharing a cache entry share the same embedding.
+  """
+  return u' '.join(query_str.split())
+
+
+class EmbeddingCache:
+  """Bounded LRU cache with expiry in front of an embedding function.
+
+  Entries are keyed on the normalized query string and the model
+  version, so pointing the server at a new model never returns
+  stale embeddings. The least recently used entry is evicted once
+  `max_size` entries are held, and entries older than `ttl_seconds`
+  are recomputed. An instance can be used as a drop-in replacement
+  for the embedding function it wraps.
+
+  Args:
+    embedding_fn: A function which takes a string and returns a high-dimensional
+                  embedding.
+    batch_embedding_fn: An optional function which takes a list of strings and
+                        returns a list of embeddings.
+    max_size: Maximum number of cached embeddings.
+    ttl_seconds: Time in seconds after which an entry expires. A value of 0 or
+                 None means entries never expire.
+    model_version: A string identifying the model producing the embeddings.
+    clock: A function returning the current time in seconds.
+  """
+
+  def __init__(self, embedding_fn, batch_embedding_fn=None, max_size=10000,
+               ttl_seconds=3600, model_version='', clock=time.time):
+    self.embedding_fn = embedding_fn
+    self.batch_embedding_fn = batch_embedding_fn
+    self.max_size = max_size
+    self.ttl_seconds = ttl_seconds
+    self.model_version = model_version
+    self.clock = clock
+
+    self.hits = 0
+    self.misses = 0
+
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __call__(self, query_str):
+    query_str = normalize_query(query_str)
+    embedding = self.get(query_str)
+    if embedding is None:
+      embedding = self.embedding_fn(query_str)
+      self.put(query_str, embedding)
+    return embedding
+
+  def embed_batch(self, query_strs):
+    """Embed a list of strings, only computing the uncached ones."""
+    query_strs = [normalize_query(query_str) for query_str in query_strs]
+    embeddings = [self.get(query_str) for query_str in query_strs]
+
+    missing = sorted({query_str for query_str, embedding in zip(query_strs, embeddings)
+                      if embedding is None})
+    if missing:
+      if self.batch_embedding_fn:
+        computed = self.batch_embedding_fn(missing)
+      else:
+        computed = [self.embedding_fn(query_str) for query_str in missing]
+      computed = dict(zip(missing, computed))
+      for query_str, embedding in computed.items():
+        self.put(query_str, embedding)
+      embeddings = [computed[query_str] if embedding is None else embedding
+                    for query_str, embedding in zip(query_strs, embeddings)]
+
+    return embeddings
+
+  def get(self, query_str):
+    """Return the cached embedding for a normalized query, or None."""
+    key = (query_str, self.model_version)
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        inserted_at, embedding = entry
+        if not self.ttl_seconds or self.clock() - inserted_at < self.ttl_seconds:
+          self._entries[key] = entry
+          self.hits += 1
+          return embedding
+      self.misses += 1
+      return None
+
+  def put(self, query_str, embedding):
+    key = (query_str, self.model_version)
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (self.clock(), embedding)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        'size': len(self._entries),
+        'max_size': self.max_size,
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+      }
+
+
+class ModelVersionWatcher:
+  """Keep the model version of an `EmbeddingCache` up to date.
+
+  The version is polled in a background thread, so cached
+  embeddings of a previous model stop being served once a new
+  version of it is rolled out behind the same URL.
+
+  Args:
+    cache: An EmbeddingCache.
+    version_fn: A function returning the current version of the model.
+    interval_seconds: Time in seconds between two checks of the version.
+  """
+
+  def __init__(self, cache, version_fn, interval_seconds=60):
+    self.cache = cache
+    self.version_fn = version_fn
+    self.interval_seconds = interval_seconds
+
+    self._stop_event = threading.Event()
+
+  def check(self):
+    """Update the model version of the cache.
+
+    Returns:
+      True if the version changed.
+    """
+    version = self.version_fn()
+    if version == self.cache.model_version:
+      return False
+
+    logging.info("Caching embeddings of model version %s", version)
+    self.cache.model_version = version
+    return True
+
+  def start(self):
+    """Keep polling the model version in the background."""
+    thread = threading.Thread(target=self._run, name='model-version-watcher')
+    thread.daemon = True
+    thread.start()
+
+  def stop(self):
+    self._stop_event.set()
+
+  def _run(self):
+    while not self._stop_event.wait(self.interval_seconds):
+      try:
+        self.check()
+      # Keep caching with the current version whatever goes wrong.
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error("Failed to check the model version: %s", e)
@@ -0,0 +1,97 @@
+import logging
+import unittest
+
+from code_search.nmslib.embedding_cache import EmbeddingCache, ModelVersionWatcher
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestEmbeddingCache(unittest.TestCase):
+  def setUp(self):
+    self.calls = []
+    self.clock = FakeClock()
+
+  def embed(self, query_str):
+    self.calls.append(query_str)
+    return [float(len(query_str))]
+
+  def embed_batch(self, query_strs):
+    self.calls.append(list(query_strs))
+    return [[float(len(query_str))] for query_str in query_strs]
+
+  def test_hits_on_normalized_query(self):
+    cache = EmbeddingCache(self.embed, clock=self.clock)
+
+    self.assertEqual(cache('read  a file '), [11.0])
+    self.assertEqual(cache(' read a file'), [11.0])
+
+    self.assertEqual(self.calls, ['read a file'])
+    self.assertEqual(cache.stats()['hits'], 1)
+    self.assertEqual(cache.stats()['misses'], 1)
+
+  def test_lru_eviction(self):
+    cache = EmbeddingCache(self.embed, max_size=2, clock=self.clock)
+
+    cache('a')
+    cache('bb')
+    cache('a')
+    cache('ccc')
+    cache('a')
+    cache('bb')
+
+    self.assertEqual(self.calls, ['a', 'bb', 'ccc', 'bb'])
+    self.assertEqual(cache.stats()['size'], 2)
+
+  def test_ttl_expiry(self):
+    cache = EmbeddingCache(self.embed, ttl_seconds=10, clock=self.clock)
+
+    cache('a')
+    self.clock.now = 9
+    cache('a')
+    self.clock.now = 10
+    cache('a')
+
+    self.assertEqual(self.calls, ['a', 'a'])
+
+  def test_model_version_is_part_of_key(self):
+    cache = EmbeddingCache(self.embed, clock=self.clock, model_version='1')
+    cache('a')
+    cache.model_version = '2'
+    cache('a')
+
+    self.assertEqual(self.calls, ['a', 'a'])
+
+  def test_model_version_watcher(self):
+    cache = EmbeddingCache(self.embed, clock=self.clock, model_version='1')
+    versions = ['1', '2']
+    watcher = ModelVersionWatcher(cache, lambda: versions[0])
+    cache('a')
+
+    self.assertFalse(watcher.check())
+    versions.pop(0)
+    self.assertTrue(watcher.check())
+    self.assertEqual(cache.model_version, '2')
+    cache('a')
+
+    self.assertEqual(self.calls, ['a', 'a'])
+
+  def test_embed_batch_only_computes_misses(self):
+    cache = EmbeddingCache(self.embed, batch_embedding_fn=self.embed_batch,
+                           clock=self.clock)
+    cache('a')
+
+    embeddings = cache.embed_batch(['a', 'bb', 'bb ', 'ccc'])
+
+    self.assertEqual(embeddings, [[1.0], [2.0], [2.0], [3.0]])
+    self.assertEqual(self.calls, ['a', ['bb', 'ccc']])
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
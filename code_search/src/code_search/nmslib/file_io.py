@@ -0,0 +1,51 @@
+"""File operations which only need TensorFlow for remote paths.
+
+Paths with a scheme, e.g. `gs://bucket/code.index`, go through
+`tf.gfile`, while local paths use the standard library. The search
+server hence starts without importing TensorFlow when it serves
+local files.
+"""
+import os
+import shutil
+
+
+def is_remote(path):
+  return '://' in path
+
+
+def _gfile():
+  # Imported here as TensorFlow is only needed to access remote files.
+  import tensorflow as tf
+  return tf.gfile
+
+
+def exists(path):
+  if is_remote(path):
+    return _gfile().Exists(path)
+  return os.path.exists(path)
+
+
+def copy(src, dst):
+  if is_remote(src) or is_remote(dst):
+    _gfile().Copy(src, dst)
+  else:
+    shutil.copyfile(src, dst)
+
+
+def open_file(path, mode='r'):
+  if is_remote(path):
+    return _gfile().Open(path, mode)
+  return open(path, mode)
+
+
+def list_directory(path):
+  if is_remote(path):
+    return _gfile().ListDirectory(path)
+  return os.listdir(path)
+
+
+def mtime_nsec(path):
+  """Return the modification time of a file in nanoseconds."""
+  if is_remote(path):
+    return _gfile().Stat(path).mtime_nsec
+  return int(os.path.getmtime(path) * 1e9)
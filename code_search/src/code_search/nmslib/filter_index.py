@@ -0,0 +1,233 @@
+import logging
+import numpy as np
+import six
+
+from code_search.nmslib.quantized_index import normalize
+
+FILTER_SUFFIX = '.filter.npz'
+
+
+def to_text(value):
+  if isinstance(value, six.binary_type):
+    return value.decode('utf-8', 'replace')
+  return six.text_type(value)
+
+
+def path_prefixes(path):
+  """Return the directory prefixes of a file path and the path itself.
+
+  For example `src/pkg/a.py` has the prefixes `src`, `src/pkg`
+  and `src/pkg/a.py`.
+  """
+  parts = path.strip('/').split('/')
+  return ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+
+def exact_knn(vectors, embedding, k):
+  """Return the `k` nearest neighbours of an embedding among a few vectors.
+
+  Distances are those of nmslib's `cosinesimil` space.
+
+  Args:
+    vectors: A 2-D array of normalized vectors.
+    embedding: The query embedding.
+    k: Number of neighbours to return.
+
+  Returns:
+    A tuple of the positions of the neighbours in `vectors` and their
+    distances, by increasing distance.
+  """
+  query = normalize(np.asarray([embedding], dtype=np.float32))[0]
+  dists = 1. - np.dot(vectors, query)
+  if len(dists) > k:
+    positions = np.argpartition(dists, k - 1)[:k]
+  else:
+    positions = np.arange(len(dists))
+  positions = positions[np.argsort(dists[positions], kind='mergesort')]
+  return positions, dists[positions]
+
+
+class IdLists:
+  """Sorted id arrays by key, stored one after the other in a single array.
+
+  Args:
+    keys: A sorted array of unicode keys.
+    offsets: An int64 array with the start of the ids of each key,
+             followed by the end of the last one.
+    ids: An int64 array with the sorted ids of every key in turn.
+  """
+
+  def __init__(self, keys, offsets, ids):
+    self.keys = keys
+    self.offsets = offsets
+    self.ids = ids
+
+  def __len__(self):
+    return len(self.keys)
+
+  def get(self, key):
+    """Return the sorted ids of a key, which are empty for an unknown key."""
+    pos = np.searchsorted(self.keys, key)
+    if pos == len(self.keys) or self.keys[pos] != key:
+      return np.zeros(0, dtype=np.int64)
+    return self.ids[self.offsets[pos]:self.offsets[pos + 1]]
+
+  def pairs(self):
+    """Return arrays with the key and the id of each id."""
+    return np.repeat(self.keys, np.diff(self.offsets)), self.ids
+
+  @staticmethod
+  def from_pairs(keys, ids):
+    """Group arrays of keys and ids by key."""
+    keys = np.asarray(keys, dtype=six.text_type)
+    ids = np.asarray(ids, dtype=np.int64)
+    order = np.lexsort((ids, keys))
+    sorted_keys, starts = np.unique(keys[order], return_index=True)
+    offsets = np.append(starts, len(ids)).astype(np.int64)
+    return IdLists(sorted_keys, offsets, ids[order])
+
+
+class FilterIndex:
+  """Sorted id lists of the items of each repository and path prefix.
+
+  This is built from the lookup data by `create_search_index`
+  with `--filter_index` and saved next to the index, like the
+  lexical index, so that the ids matching a filter are known
+  before searching, see `CodeSearchEngine.filtered_knn`. A path
+  prefix matches whole directory or file names, see `path_prefixes`.
+
+  Items added later, e.g. to a delta tier, are kept in separate
+  lists which are merged when filtering.
+
+  Args:
+    nwo_ids: The `IdLists` of the items by repository.
+    path_ids: The `IdLists` of the items by path prefix.
+    num_items: Number of items of the lookup data.
+  """
+
+  NWO_LABEL = 0
+  PATH_LABEL = 1
+
+  def __init__(self, nwo_ids, path_ids, num_items):
+    self.nwo_ids = nwo_ids
+    self.path_ids = path_ids
+    self.num_items = num_items
+    self.added_nwo_ids = {}
+    self.added_path_ids = {}
+
+  def __len__(self):
+    return self.num_items
+
+  def add(self, rows, start):
+    """Add lookup rows whose ids start at `start`."""
+    for idx, row in enumerate(rows, start):
+      self.added_nwo_ids.setdefault(to_text(row[self.NWO_LABEL]), []).append(idx)
+      for prefix in path_prefixes(to_text(row[self.PATH_LABEL])):
+        self.added_path_ids.setdefault(prefix, []).append(idx)
+
+  @staticmethod
+  def _lookup(id_lists, added_ids, key):
+    ids = id_lists.get(key)
+    added = added_ids.get(key)
+    if not added:
+      return ids
+    return np.concatenate([ids, np.array(added, dtype=np.int64)])
+
+  def ids(self, nwo=None, path_prefix=None):
+    """Return the sorted ids of the items matching all the given filters.
+
+    Args:
+      nwo: A repository, e.g. `kubeflow/examples`.
+      path_prefix: A directory or file path within repositories.
+    """
+    result = None
+    if nwo:
+      result = self._lookup(self.nwo_ids, self.added_nwo_ids, to_text(nwo))
+    if path_prefix:
+      path_ids = self._lookup(self.path_ids, self.added_path_ids,
+                              to_text(path_prefix).strip('/'))
+      result = path_ids if result is None else np.intersect1d(result, path_ids,
+                                                              assume_unique=True)
+    return result
+
+  def subset(self, keep):
+    """Return the index of the items in `keep`, renumbered by their position in it.
+
+    Added items become part of the returned index.
+
+    Args:
+      keep: A sorted array of item ids.
+    """
+    keep = np.asarray(keep, dtype=np.int64)
+
+    def subset_ids(id_lists, added_ids):
+      keys, ids = id_lists.pairs()
+      added_keys = [key for key, key_ids in added_ids.items() for _ in key_ids]
+      added = [idx for key_ids in added_ids.values() for idx in key_ids]
+      keys = np.concatenate([keys, np.array(added_keys, dtype=six.text_type)])
+      ids = np.concatenate([ids, np.array(added, dtype=np.int64)])
+
+      positions = np.searchsorted(keep, ids)
+      kept = (positions < len(keep)) & (keep[np.minimum(positions, len(keep) - 1)] == ids)
+      return IdLists.from_pairs(keys[kept], positions[kept])
+
+    return FilterIndex(subset_ids(self.nwo_ids, self.added_nwo_ids),
+                       subset_ids(self.path_ids, self.added_path_ids), len(keep))
+
+  def save(self, path):
+    with open(path, 'wb') as index_file:
+      np.savez(index_file, nwo_keys=self.nwo_ids.keys, nwo_offsets=self.nwo_ids.offsets,
+               nwo_ids=self.nwo_ids.ids, path_keys=self.path_ids.keys,
+               path_offsets=self.path_ids.offsets, path_ids=self.path_ids.ids,
+               num_items=np.array(self.num_items, dtype=np.int64))
+
+  @staticmethod
+  def load(path):
+    with np.load(path) as data:
+      return FilterIndex(IdLists(data['nwo_keys'], data['nwo_offsets'], data['nwo_ids']),
+                         IdLists(data['path_keys'], data['path_offsets'], data['path_ids']),
+                         int(data['num_items']))
+
+  @staticmethod
+  def build(rows):
+    """Build the id lists of the rows of lookup data.
+
+    Args:
+      rows: An iterable of lookup rows, in the order of
+            `CodeSearchEngine.DICT_LABELS`.
+    """
+    nwo_keys, nwo_ids = [], []
+    path_keys, path_ids = [], []
+    num_items = 0
+    for idx, row in enumerate(rows):
+      nwo_keys.append(to_text(row[FilterIndex.NWO_LABEL]))
+      nwo_ids.append(idx)
+      for prefix in path_prefixes(to_text(row[FilterIndex.PATH_LABEL])):
+        path_keys.append(prefix)
+        path_ids.append(idx)
+      num_items = idx + 1
+
+    index = FilterIndex(IdLists.from_pairs(nwo_keys, nwo_ids),
+                        IdLists.from_pairs(path_keys, path_ids), num_items)
+    logging.info("Indexed %d repositories and %d path prefixes", len(index.nwo_ids),
+                 len(index.path_ids))
+    return index
+
+  @staticmethod
+  def concat(indexes, offsets):
+    """Merge the filter indexes of index shards into one of global ids.
+
+    Args:
+      indexes: A list with the `FilterIndex` of each shard.
+      offsets: A list with the global id of the first item of each shard,
+               e.g. `ShardedLookup.offsets`.
+    """
+    def concat_ids(shard_id_lists):
+      pairs = [id_lists.pairs() for id_lists in shard_id_lists]
+      return IdLists.from_pairs(np.concatenate([keys for keys, _ in pairs]),
+                                np.concatenate([ids + offset
+                                                for (_, ids), offset in zip(pairs, offsets)]))
+
+    return FilterIndex(concat_ids([index.nwo_ids for index in indexes]),
+                       concat_ids([index.path_ids for index in indexes]),
+                       sum(len(index) for index in indexes))
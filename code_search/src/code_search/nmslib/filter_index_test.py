@@ -0,0 +1,172 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from code_search.nmslib.delta_index import EMBEDDINGS_SUFFIX
+from code_search.nmslib.filter_index import FILTER_SUFFIX, FilterIndex, exact_knn, path_prefixes
+from code_search.nmslib.search_engine import CodeSearchEngine
+
+
+def make_rows(num_items):
+  return [['owner/repo{}'.format(i % 5), 'src/pkg{}/mod{}.py'.format(i % 3, i % 7),
+           'f{}'.format(i), str(i), ''] for i in range(num_items)]
+
+
+class TestFilterIndex(unittest.TestCase):
+  def setUp(self):
+    self.rows = make_rows(100)
+    self.index = FilterIndex.build(self.rows)
+
+  def expected_ids(self, predicate):
+    return [i for i, row in enumerate(self.rows) if predicate(row)]
+
+  def test_path_prefixes(self):
+    self.assertEqual(path_prefixes('src/pkg/a.py'), ['src', 'src/pkg', 'src/pkg/a.py'])
+    self.assertEqual(path_prefixes('a.py'), ['a.py'])
+
+  def test_ids(self):
+    self.assertIsNone(self.index.ids())
+    self.assertEqual(self.index.ids(nwo='owner/repo1').tolist(),
+                     self.expected_ids(lambda row: row[0] == 'owner/repo1'))
+    self.assertEqual(self.index.ids(path_prefix='src/pkg2/').tolist(),
+                     self.expected_ids(lambda row: row[1].startswith('src/pkg2/')))
+    self.assertEqual(self.index.ids(nwo='owner/repo1', path_prefix='src/pkg2/mod3.py').tolist(),
+                     self.expected_ids(lambda row: row[0] == 'owner/repo1' and
+                                       row[1] == 'src/pkg2/mod3.py'))
+    # Prefixes only match whole directory names.
+    self.assertEqual(len(self.index.ids(path_prefix='src/pk')), 0)
+    self.assertEqual(len(self.index.ids(nwo='unknown/repo')), 0)
+
+  def test_add(self):
+    self.index.add([['owner/new', 'src/pkg1/new.py', 'g', '1', '']], 100)
+    self.assertEqual(self.index.ids(nwo='owner/new').tolist(), [100])
+    self.assertEqual(self.index.ids(path_prefix='src/pkg1').tolist()[-1], 100)
+
+  def test_save_load(self):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp_dir, 'code.index' + FILTER_SUFFIX)
+      self.index.save(path)
+      loaded = FilterIndex.load(path)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+    self.assertEqual(len(loaded), 100)
+    self.assertEqual(loaded.ids(nwo='owner/repo3', path_prefix='src').tolist(),
+                     self.index.ids(nwo='owner/repo3', path_prefix='src').tolist())
+
+  def test_subset(self):
+    self.index.add([['owner/repo1', 'src/new.py', 'g', '1', '']], 100)
+    keep = np.array([i for i in range(101) if i % 4 != 1], dtype=np.int64)
+    subset = self.index.subset(keep)
+
+    rows = self.rows + [['owner/repo1', 'src/new.py', 'g', '1', '']]
+    self.assertEqual(len(subset), len(keep))
+    self.assertEqual(keep[subset.ids(nwo='owner/repo1')].tolist(),
+                     [i for i in keep if rows[i][0] == 'owner/repo1'])
+    self.assertEqual(keep[subset.ids(path_prefix='src/new.py')].tolist(), [100])
+
+  def test_concat(self):
+    index = FilterIndex.concat([FilterIndex.build(self.rows[:40]),
+                                FilterIndex.build(self.rows[40:])], [0, 40, 100])
+    self.assertEqual(len(index), 100)
+    self.assertEqual(index.ids(nwo='owner/repo2', path_prefix='src/pkg0').tolist(),
+                     self.index.ids(nwo='owner/repo2', path_prefix='src/pkg0').tolist())
+
+  def test_exact_knn(self):
+    vectors = np.eye(4, dtype=np.float32)
+    positions, dists = exact_knn(vectors, [0., 2., 1., 0.], 2)
+    self.assertEqual(positions.tolist(), [1, 2])
+    self.assertTrue(np.all(np.diff(dists) >= 0))
+
+
+class TestFilteredSearch(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.index_file = os.path.join(self.tmp_dir, 'code.index')
+
+    rng = np.random.RandomState(0)
+    self.data = rng.randn(1000, 16).astype(np.float32)
+    self.rows = make_rows(1000)
+    self.queries = rng.randn(10, 16).astype(np.float32)
+
+    CodeSearchEngine.create_index(self.data, self.index_file, print_progress=False)
+    np.save(self.index_file + EMBEDDINGS_SUFFIX, self.data)
+    FilterIndex.build(self.rows).save(self.index_file + FILTER_SUFFIX)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def exact_function_names(self, query, ids, k):
+    data = self.data[ids] / np.linalg.norm(self.data[ids], axis=1, keepdims=True)
+    order = np.argsort(-np.dot(data, query / np.linalg.norm(query)))[:k]
+    return ['f{}'.format(ids[i]) for i in order]
+
+  def check_results(self, engine, nwo, path_prefix, k=5, deleted=()):
+    ids = [i for i, row in enumerate(self.rows)
+           if row[0] == nwo and row[1].startswith(path_prefix) and i not in deleted]
+    for query in self.queries:
+      result = engine.search(query, k=k, nwo=nwo, path_prefix=path_prefix)
+      self.assertEqual([item['function_name'] for item in result],
+                       self.exact_function_names(query, ids, k))
+      self.assertFalse(result.partial)
+
+  def test_exact(self):
+    engine = CodeSearchEngine(self.index_file, self.rows, None, filtered_search=True)
+    self.check_results(engine, 'owner/repo2', 'src/pkg1/')
+
+  def test_overfetch(self):
+    engine = CodeSearchEngine(self.index_file, self.rows, None, filtered_search=True,
+                              exact_filter_size=0, query_params={'efSearch': 400})
+    self.check_results(engine, 'owner/repo2', 'src/pkg1/')
+
+  def test_overfetch_without_embeddings(self):
+    os.remove(self.index_file + EMBEDDINGS_SUFFIX)
+    engine = CodeSearchEngine(self.index_file, self.rows, None, filtered_search=True,
+                              query_params={'efSearch': 400})
+    self.check_results(engine, 'owner/repo4', 'src')
+
+  def test_partial(self):
+    engine = CodeSearchEngine(self.index_file, self.rows, None, filtered_search=True,
+                              exact_filter_size=0, max_filter_fetch=20)
+    result = engine.search(self.queries[0], k=5, nwo='owner/repo2', path_prefix='src/pkg1/')
+    self.assertTrue(result.partial)
+    self.assertLess(len(result), 5)
+
+  def test_without_filter_index(self):
+    os.remove(self.index_file + FILTER_SUFFIX)
+    with self.assertRaises(ValueError):
+      CodeSearchEngine(self.index_file, self.rows, None, filtered_search=True)
+
+  def test_delta_tier(self):
+    FilterIndex.build(self.rows[:900]).save(self.index_file + FILTER_SUFFIX)
+    engine = CodeSearchEngine(self.index_file, self.rows[:900], None, filtered_search=True,
+                              delta_tier=True)
+    engine.add(self.data[900:], self.rows[900:])
+    engine.delete([10])
+    self.check_results(engine, 'owner/repo0', 'src/pkg1/mod3.py', deleted=(10,))
+
+    result = engine.search(self.data[10], k=3, nwo='owner/repo0')
+    self.assertNotIn('f10', [item['function_name'] for item in result])
+
+  def test_compact(self):
+    FilterIndex.build(self.rows[:900]).save(self.index_file + FILTER_SUFFIX)
+    engine = CodeSearchEngine(self.index_file, self.rows[:900], None, filtered_search=True,
+                              delta_tier=True)
+    engine.add(self.data[900:], self.rows[900:])
+    engine.delete([10, 950])
+    self.assertTrue(engine.compact(os.path.join(self.tmp_dir, 'compacted.index')))
+    self.check_results(engine, 'owner/repo0', 'src/pkg1/', deleted=(10, 950))
+
+  def test_without_filtered_search(self):
+    engine = CodeSearchEngine(self.index_file, self.rows, None)
+    with self.assertRaises(ValueError):
+      engine.search(self.queries[0], k=2, nwo='owner/repo0')
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
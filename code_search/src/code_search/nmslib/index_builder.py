@@ -0,0 +1,266 @@
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import numpy as np
+import six
+import tensorflow as tf
+
+from code_search.nmslib.lookup_store import LookupStore, LookupStoreWriter
+
+
+def parse_embedding(embedding_string):
+  """Parse a comma-separated embedding string into a float32 vector.
+
+  Raises:
+    ValueError: If a value is not a float.
+  """
+  return np.array(embedding_string.split(','), dtype=np.float32)
+
+
+def metadata_path(embeddings_path):
+  """Return the path of the metadata CSV file of a binary embeddings shard."""
+  head, tail = os.path.split(embeddings_path)
+  name = tail.replace('-embeddings-', '-metadata-', 1)
+  return os.path.join(head, os.path.splitext(name)[0] + '.csv')
+
+
+LOOKUP_COLUMNS = ['nwo', 'path', 'function_name', 'lineno', 'original_function']
+EMBEDDING_COLUMN = 'function_embedding'
+
+
+def list_shards(data_dir):
+  """List the function embeddings shards in a directory.
+
+  These are either CSV files (`*index*.csv`) with the embedding
+  as text in the last column, Parquet files (`*index*.parquet`)
+  with a float32 list column, or float32 `.npy` files
+  (`*-embeddings-*.npy`) each with a metadata CSV file, as written
+  by `create_function_embeddings` with `--embeddings_format=parquet`
+  or `--embeddings_format=npy`. The first kind present is used.
+  """
+  for pattern in ['*index*.csv', '*index*.parquet', '*-embeddings-*.npy']:
+    paths = tf.gfile.Glob('{}/{}'.format(data_dir, pattern))
+    if paths:
+      return sorted(paths)
+  return []
+
+
+def iter_parquet_shard(path):
+  """Yield the lookup rows and embeddings of a Parquet shard, one row group at a time."""
+  # Imported here as pyarrow is only needed for Parquet shards.
+  import pyarrow.parquet as pq
+
+  with tf.gfile.Open(path, 'rb') as parquet_file:
+    reader = pq.ParquetFile(io.BytesIO(parquet_file.read()))
+  for row_group in range(reader.num_row_groups):
+    table = reader.read_row_group(row_group, columns=LOOKUP_COLUMNS + [EMBEDDING_COLUMN])
+    columns = [table.column(name).to_pylist() for name in LOOKUP_COLUMNS]
+    if six.PY2:
+      # Lookup rows read from CSV files are byte strings in Python 2.
+      columns = [[value.encode('utf-8') for value in column] for column in columns]
+    rows = iter(zip(*columns))
+    for chunk in table.column(EMBEDDING_COLUMN).chunks:
+      if not len(chunk):  # pylint: disable=len-as-condition
+        continue
+      values = chunk.flatten().to_numpy()
+      for embedding_vector in values.reshape(len(chunk), -1).astype(np.float32):
+        yield list(next(rows)), embedding_vector
+
+
+def iter_shard(path):
+  """Yield the lookup rows and embeddings of one shard.
+
+  CSV shards are read one row at a time, Parquet shards one
+  row group at a time and `.npy` shards at once.
+
+  Args:
+    path: Path string to a shard as returned by `list_shards`.
+
+  Yields:
+    A tuple of the lookup row and its float32 embedding vector.
+  """
+  logging.info('Reading %s', path)
+  if path.endswith('.parquet'):
+    for row, embedding_vector in iter_parquet_shard(path):
+      yield row, embedding_vector
+    return
+
+  if path.endswith('.npy'):
+    with tf.gfile.Open(path, 'rb') as npy_file:
+      embeddings = np.load(io.BytesIO(npy_file.read()))
+    with tf.gfile.Open(metadata_path(path)) as csv_file:
+      for row, embedding_vector in zip(csv.reader(csv_file), embeddings):
+        yield row, embedding_vector
+    return
+
+  with tf.gfile.Open(path) as csv_file:
+    for row in csv.reader(csv_file):
+      yield row[:-1], parse_embedding(row[-1])
+
+
+def iter_embedding_rows(data_dir):
+  """Yield the rows of every function embeddings shard in a directory.
+
+  Args:
+    data_dir: Path string to the directory with the shards.
+
+  Yields:
+    A tuple of the lookup row and its embedding vector.
+  """
+  for path in list_shards(data_dir):
+    for row, embedding_vector in iter_shard(path):
+      yield row, embedding_vector
+
+
+def parse_shard(shard_args):
+  """Parse one function embeddings shard into local part files.
+
+  This runs in a worker process. Rows are streamed from the shard:
+  the embeddings are appended to a raw float32 file and the lookup
+  rows are written to a CSV file and optionally to a `LookupStore`
+  file. The part files are removed if the shard fails to parse.
+
+  Args:
+    shard_args: A tuple of the shard path, the index of the shard,
+                the directory to write the part files to and the number
+                of lookup fields if a lookup store part should be written.
+
+  Returns:
+    A tuple of the path to the embeddings part file, the path to the
+    lookup CSV part file, the path to the lookup store part file (or
+    None), the dimension of the embeddings (or None if the shard is
+    empty) and the number of rows in the shard.
+  """
+  shard_path, shard_index, parts_dir, num_lookup_fields = shard_args
+
+  part_path = os.path.join(parts_dir, 'part-{:05d}'.format(shard_index))
+  embeddings_part_file = part_path + '.f32'
+  lookup_part_file = part_path + '.csv'
+  lookup_store_part_file = None
+  lookup_store_writer = None
+  if num_lookup_fields:
+    lookup_store_part_file = part_path + '.bin'
+    lookup_store_writer = LookupStoreWriter(lookup_store_part_file, num_lookup_fields)
+
+  dim = None
+  num_rows = 0
+  completed = False
+  try:
+    with open(lookup_part_file, 'w') as lookup_file, \
+        open(embeddings_part_file, 'wb') as embeddings_part:
+      lookup_writer = csv.writer(lookup_file)
+      for row, embedding_vector in iter_shard(shard_path):
+        embedding_vector = np.asarray(embedding_vector, dtype=np.float32)
+        if dim is None:
+          dim = len(embedding_vector)
+        elif len(embedding_vector) != dim:
+          raise ValueError('Expected embeddings of dimension {} in {}, got {}'.format(
+            dim, shard_path, len(embedding_vector)))
+
+        embeddings_part.write(embedding_vector.tobytes())
+        lookup_writer.writerow(row)
+        if lookup_store_writer:
+          lookup_store_writer.write(row)
+        num_rows += 1
+    completed = True
+  finally:
+    if lookup_store_writer:
+      if completed:
+        lookup_store_writer.close()
+      else:
+        lookup_store_writer.discard()
+    if not completed:
+      for path in [embeddings_part_file, lookup_part_file]:
+        if os.path.exists(path):
+          os.remove(path)
+
+  return embeddings_part_file, lookup_part_file, lookup_store_part_file, dim, num_rows
+
+
+def build_embeddings(data_dir, embeddings_file, lookup_file, lookup_store_writer=None,
+                     num_processes=0, index_shard=0, num_index_shards=1):
+  """Parse all function embeddings shards into a float32 matrix.
+
+  Shards are parsed in parallel by a pool of processes, which stream
+  their rows into part files, see `iter_shard`. The embeddings of the
+  parts are then copied in order into a memory-mapped float32 `.npy`
+  file preallocated to the total number of rows, so CSV and Parquet
+  shards are never held in memory as a whole. The lookup rows of
+  every shard are concatenated in the same order into `lookup_file`,
+  and into `lookup_store_writer` if given. The part files are removed
+  even if parsing fails.
+
+  Args:
+    data_dir: Path string to the directory with the shards, see `list_shards`.
+    embeddings_file: Local path string to write the `.npy` matrix to.
+    lookup_file: Local path string to write the reverse lookup CSV file to.
+    lookup_store_writer: An optional LookupStoreWriter for the lookup rows.
+    num_processes: Number of processes parsing shards. 0 uses all cores
+                   and 1 parses in the current process.
+    index_shard: The index shard to build. Files in `data_dir` are
+                 assigned to index shards round-robin.
+    num_index_shards: Total number of index shards.
+
+  Returns:
+    A read-only memory-mapped numpy array with one embedding per row.
+  """
+  shard_paths = list_shards(data_dir)[index_shard::num_index_shards]
+  if not shard_paths:
+    raise ValueError('No function embeddings files found in {}'.format(data_dir))
+
+  parts_dir = embeddings_file + '.parts'
+  if not os.path.isdir(parts_dir):
+    os.makedirs(parts_dir)
+
+  try:
+    num_lookup_fields = lookup_store_writer.num_fields if lookup_store_writer else None
+    shard_args = [(path, i, parts_dir, num_lookup_fields)
+                  for i, path in enumerate(shard_paths)]
+    num_processes = num_processes or multiprocessing.cpu_count()
+    num_processes = min(num_processes, len(shard_args))
+    logging.info('Parsing %d files with %d processes', len(shard_args), num_processes)
+
+    if num_processes > 1:
+      pool = multiprocessing.Pool(num_processes)
+      try:
+        parts = pool.map(parse_shard, shard_args)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      parts = [parse_shard(args) for args in shard_args]
+
+    num_rows = sum(part[-1] for part in parts)
+    dims = set(part[-2] for part in parts if part[-1])
+    if len(dims) != 1:
+      raise ValueError('Expected embeddings of a single dimension, got {}'.format(sorted(dims)))
+    dim = dims.pop()
+    logging.info('Writing %d embeddings of dimension %d to %s', num_rows, dim, embeddings_file)
+
+    embeddings = np.lib.format.open_memmap(embeddings_file, mode='w+', dtype=np.float32,
+                                           shape=(num_rows, dim))
+    offset = 0
+    with open(lookup_file, 'wb') as output_lookup_file:
+      for embeddings_part_file, lookup_part_file, lookup_store_part_file, _, part_rows in parts:
+        if part_rows:
+          embeddings[offset:offset + part_rows] = np.memmap(
+            embeddings_part_file, dtype=np.float32, mode='r', shape=(part_rows, dim))
+          offset += part_rows
+
+        with open(lookup_part_file, 'rb') as input_lookup_file:
+          shutil.copyfileobj(input_lookup_file, output_lookup_file)
+        if lookup_store_writer:
+          lookup_store_part = LookupStore(lookup_store_part_file)
+          for i in range(len(lookup_store_part)):
+            lookup_store_writer.write(lookup_store_part[i])
+          lookup_store_part.close()
+
+    embeddings.flush()
+    del embeddings
+  finally:
+    shutil.rmtree(parts_dir)
+
+  return np.load(embeddings_file, mmap_mode='r')
@@ -0,0 +1,128 @@
+import csv
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from code_search.nmslib.index_builder import build_embeddings, parse_embedding, parse_shard
+from code_search.nmslib.lookup_store import LookupStore, LookupStoreWriter
+
+
+class TestBuildEmbeddings(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.data_dir = os.path.join(self.tmp_dir, 'data')
+    os.makedirs(self.data_dir)
+
+    self.rows = []
+    for shard in range(3):
+      path = os.path.join(self.data_dir, 'func-index-{:05d}-of-00003.csv'.format(shard))
+      with open(path, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        for i in range(shard * 2):
+          row = ['owner/repo', 'a.py', 'f{}_{}'.format(shard, i), str(i),
+                 'def f():\n  return "a,b"', '{},{}.5,-1'.format(shard, i)]
+          writer.writerow(row)
+          self.rows.append(row)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def build(self, num_processes):
+    embeddings_file = os.path.join(self.tmp_dir, 'embeddings.npy')
+    lookup_file = os.path.join(self.tmp_dir, 'lookup.csv')
+    lookup_store_file = os.path.join(self.tmp_dir, 'lookup.bin')
+
+    with LookupStoreWriter(lookup_store_file, 5) as lookup_store_writer:
+      embeddings = build_embeddings(self.data_dir, embeddings_file, lookup_file,
+                                    lookup_store_writer=lookup_store_writer,
+                                    num_processes=num_processes)
+
+    expected_embeddings = np.array([[float(value) for value in row[-1].split(',')]
+                                    for row in self.rows], dtype=np.float32)
+    self.assertEqual(embeddings.dtype, np.float32)
+    np.testing.assert_array_equal(embeddings, expected_embeddings)
+
+    with open(lookup_file) as csv_file:
+      self.assertEqual(list(csv.reader(csv_file)), [row[:-1] for row in self.rows])
+
+    lookup_store = LookupStore(lookup_store_file)
+    self.assertEqual([lookup_store[i] for i in range(len(lookup_store))],
+                     [row[:-1] for row in self.rows])
+    lookup_store.close()
+    self.assertFalse(os.path.exists(embeddings_file + '.parts'))
+
+  def test_single_process(self):
+    self.build(num_processes=1)
+
+  def test_process_pool(self):
+    self.build(num_processes=2)
+
+  def test_dimension_mismatch(self):
+    path = os.path.join(self.data_dir, 'func-index-00002-of-00003.csv')
+    with open(path, 'a') as csv_file:
+      csv.writer(csv_file).writerow(['owner/repo', 'a.py', 'g', '1', '', '1,2'])
+
+    embeddings_file = os.path.join(self.tmp_dir, 'embeddings.npy')
+    with self.assertRaises(ValueError):
+      build_embeddings(self.data_dir, embeddings_file, os.path.join(self.tmp_dir, 'lookup.csv'),
+                       num_processes=1)
+    self.assertFalse(os.path.exists(embeddings_file + '.parts'))
+
+  def test_malformed_embedding(self):
+    np.testing.assert_array_equal(parse_embedding('1, 2.5,-1'), [1, 2.5, -1])
+    for embedding_string in ['1,,2', '1,a', '']:
+      with self.assertRaises(ValueError):
+        parse_embedding(embedding_string)
+
+    path = os.path.join(self.data_dir, 'func-index-00002-of-00003.csv')
+    with open(path, 'a') as csv_file:
+      csv.writer(csv_file).writerow(['owner/repo', 'a.py', 'g', '1', '', '1,2.5.1,-1'])
+
+    parts_dir = os.path.join(self.tmp_dir, 'parts')
+    os.makedirs(parts_dir)
+    with self.assertRaises(ValueError):
+      parse_shard((path, 0, parts_dir, 5))
+    self.assertEqual(os.listdir(parts_dir), [])
+
+  def test_npy_shards(self):
+    for path in os.listdir(self.data_dir):
+      os.remove(os.path.join(self.data_dir, path))
+
+    for shard in range(3):
+      shard_rows = [row for row in self.rows if row[2].startswith('f{}_'.format(shard))]
+      path = os.path.join(self.data_dir, 'func-metadata-{:05d}-of-00003.csv'.format(shard))
+      with open(path, 'w') as csv_file:
+        csv.writer(csv_file).writerows([row[:-1] for row in shard_rows])
+      path = os.path.join(self.data_dir, 'func-embeddings-{:05d}-of-00003.npy'.format(shard))
+      np.save(path, np.array([[float(value) for value in row[-1].split(',')]
+                              for row in shard_rows], dtype=np.float32))
+
+    self.build(num_processes=2)
+
+  def test_parquet_shards(self):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    for path in os.listdir(self.data_dir):
+      os.remove(os.path.join(self.data_dir, path))
+
+    names = ['nwo', 'path', 'function_name', 'lineno', 'original_function']
+    for shard in range(3):
+      shard_rows = [row for row in self.rows if row[2].startswith('f{}_'.format(shard))]
+      columns = [pa.array([row[i] for row in shard_rows], type=pa.string())
+                 for i in range(len(names))]
+      columns.append(pa.array([[float(value) for value in row[-1].split(',')]
+                               for row in shard_rows], type=pa.list_(pa.float32())))
+      table = pa.Table.from_arrays(columns, names=names + ['function_embedding'])
+      path = os.path.join(self.data_dir, 'func-index-{:05d}-of-00003.parquet'.format(shard))
+      pq.write_table(table, path, row_group_size=1)
+
+    self.build(num_processes=2)
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
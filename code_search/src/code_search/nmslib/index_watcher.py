@@ -0,0 +1,105 @@
+import logging
+import os
+import threading
+
+from code_search.nmslib import file_io
+
+
+class IndexWatcher:
+  """Poll a versioned index location and hot swap new versions.
+
+  The watched directory contains one subdirectory per index
+  version, for instance one per run of the index update pipeline.
+
+    <watch_dir>/<version>/<subdir>/<index_name>
+
+  A version is complete once all its index files exist, e.g. those
+  of every shard, which `create_search_index` copies last. The
+  newest complete version (by the modification time of its newest
+  index file) is loaded in a background
+  thread and then swapped into the engine, which keeps serving the
+  previous version until the swap.
+
+  Args:
+    watch_dir: Path string to the directory holding the index versions.
+    index_names: A list of the file names of the index, or of its
+                 shards, inside a version directory.
+    load_fn: A function which takes a version name and the path to its
+             directory and returns a tuple of a local index file path and
+             the lookup data.
+    subdir: Optional path of the index files relative to each version directory.
+    interval_seconds: Time in seconds between two polls of `watch_dir`.
+    cleanup_fn: An optional function called with the name of the version
+                which was replaced after every swap.
+  """
+
+  def __init__(self, watch_dir, index_names, load_fn, subdir='',
+               interval_seconds=300, cleanup_fn=None):
+    self.watch_dir = watch_dir
+    self.index_names = index_names
+    self.load_fn = load_fn
+    self.subdir = subdir
+    self.interval_seconds = interval_seconds
+    self.cleanup_fn = cleanup_fn
+
+    self._stop_event = threading.Event()
+
+  def version_path(self, version):
+    return os.path.join(self.watch_dir, version, self.subdir)
+
+  def latest_version(self):
+    """Return the name of the newest complete version, or None."""
+    candidates = []
+    for entry in file_io.list_directory(self.watch_dir):
+      version = entry.rstrip('/')
+      index_files = [os.path.join(self.version_path(version), index_name)
+                     for index_name in self.index_names]
+      if all(file_io.exists(index_file) for index_file in index_files):
+        candidates.append((max(file_io.mtime_nsec(index_file) for index_file in index_files),
+                           version))
+
+    if not candidates:
+      return None
+    return max(candidates)[1]
+
+  def load(self, version):
+    return self.load_fn(version, self.version_path(version))
+
+  def check(self, engine):
+    """Swap the latest version into an engine if it is not already active.
+
+    Args:
+      engine: An instance of CodeSearchEngine.
+
+    Returns:
+      True if a new version was swapped in.
+    """
+    version = self.latest_version()
+    if version is None or version == engine.version:
+      return False
+
+    logging.info("Found new index version %s", version)
+    previous_version = engine.version
+    index_file, lookup_data = self.load(version)
+    engine.swap(index_file, lookup_data, version=version)
+
+    if self.cleanup_fn and previous_version is not None:
+      self.cleanup_fn(previous_version)
+    return True
+
+  def start(self, engine):
+    """Keep polling for new versions of the engine's index in the background."""
+    thread = threading.Thread(target=self._run, args=(engine,), name='index-watcher')
+    thread.daemon = True
+    thread.start()
+
+  def stop(self):
+    self._stop_event.set()
+
+  def _run(self, engine):
+    while not self._stop_event.wait(self.interval_seconds):
+      try:
+        self.check(engine)
+      # Keep serving the current version whatever goes wrong with the new one.
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error("Failed to update the index from %s: %s", self.watch_dir, e)
@@ -0,0 +1,62 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from code_search.nmslib.index_watcher import IndexWatcher
+from code_search.nmslib.search_engine import CodeSearchEngine
+
+
+class TestIndexWatcher(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.data = np.random.RandomState(0).randn(20, 8).astype(np.float32)
+    self.removed = []
+    self.watcher = IndexWatcher(self.tmp_dir, ['code.index-0', 'code.index-1'], self.load,
+                                subdir='index', cleanup_fn=self.removed.append)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def write_version(self, version, shards, mtime):
+    version_dir = os.path.join(self.tmp_dir, version, 'index')
+    os.makedirs(version_dir)
+    for shard in shards:
+      index_file = os.path.join(version_dir, 'code.index-{}'.format(shard))
+      CodeSearchEngine.create_index(self.data, index_file, print_progress=False)
+      os.utime(index_file, (mtime, mtime))
+
+  def load(self, version, version_path):
+    rows = [[version, 'src/mod.py', 'f{}'.format(i), str(i), ''] for i in range(20)]
+    return os.path.join(version_path, 'code.index-0'), rows
+
+  def test_latest_version(self):
+    self.assertIsNone(self.watcher.latest_version())
+
+    self.write_version('v1', [0, 1], 1000)
+    self.write_version('v2', [1, 0], 2000)
+    # The newest version is incomplete until all its shards exist.
+    self.write_version('v3', [0], 3000)
+    self.assertEqual(self.watcher.latest_version(), 'v2')
+
+  def test_check(self):
+    self.write_version('v1', [0, 1], 1000)
+    engine = CodeSearchEngine(*self.load('v1', self.watcher.version_path('v1')),
+                              embedding_fn=None, version='v1')
+    self.assertFalse(self.watcher.check(engine))
+
+    self.write_version('v2', [0, 1], 2000)
+    self.assertTrue(self.watcher.check(engine))
+    self.assertEqual(engine.version, 'v2')
+    self.assertEqual(engine.search(self.data[3], k=1)[0]['nwo'], 'v2')
+    self.assertEqual(self.removed, ['v1'])
+
+    self.assertFalse(self.watcher.check(engine))
+    self.assertEqual(self.removed, ['v1'])
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -0,0 +1,241 @@
+import logging
+import re
+import numpy as np
+import six
+
+from code_search.nmslib.sharded_index import merge_top_k
+
+LEXICAL_SUFFIX = '.bm25.npz'
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_SUBWORD_RE = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+
+
+def tokenize(text):
+  """Split code or a query into lowercase terms for BM25.
+
+  Identifiers are kept whole, so exact identifier matches score
+  highest, and are also split into their snake case and camel case
+  parts, e.g. `getUserName` into `getusername`, `get`, `user` and
+  `name`.
+  """
+  if isinstance(text, six.binary_type):
+    text = text.decode('utf-8', 'replace')
+
+  terms = []
+  for word in _WORD_RE.findall(text):
+    terms.append(word.lower())
+    parts = [part.lower() for part in _SUBWORD_RE.findall(word)]
+    if len(parts) > 1:
+      terms.extend(parts)
+  return terms
+
+
+def reciprocal_rank_fusion(result_lists, key, k, rrf_k=60):
+  """Fuse ranked lists of results by reciprocal rank.
+
+  Each result scores `1 / (rrf_k + rank)` in every list it is in,
+  with ranks starting at 1, and results are ordered by their total.
+
+  Args:
+    result_lists: A list of lists of results, best first.
+    key: A function returning the identity of a result across lists.
+    k: Number of results to return.
+    rrf_k: Constant damping the weight of the top ranks.
+
+  Returns:
+    A list of tuples of a result, from the first list it is in, and
+    its fused score, by decreasing score.
+  """
+  scores = {}
+  results = {}
+  for result_list in result_lists:
+    for rank, result in enumerate(result_list):
+      result_key = key(result)
+      results.setdefault(result_key, result)
+      scores[result_key] = scores.get(result_key, 0.) + 1. / (rrf_k + rank + 1)
+
+  ranked = sorted(scores, key=lambda result_key: -scores[result_key])[:k]
+  return [(results[result_key], scores[result_key]) for result_key in ranked]
+
+
+class LexicalIndex:
+  """A BM25 inverted index over the lookup data of a search index.
+
+  Each item is indexed by the terms of its original function,
+  which covers the function tokens and the docstring, and by its
+  function name, whose terms are counted `name_weight` times. Its
+  id is its row in the lookup data, which is the same as in the
+  nmslib index built from the same files.
+
+  The postings of all terms are stored as flat arrays ordered by
+  term, with the terms sorted so that looking one up is a binary
+  search, and are written as a single `.npz` file.
+
+  Args:
+    terms: A sorted array of unicode terms.
+    offsets: An int64 array with the start of the postings of each
+             term, and their total number as last value.
+    docs: An int32 array with the item ids of the postings.
+    freqs: An array with the term frequency of each posting.
+    doc_lengths: An array with the number of terms of each item.
+    k1: BM25 term frequency saturation.
+    b: BM25 document length normalization.
+  """
+
+  NAME_LABEL = 2
+  FUNCTION_LABEL = 4
+
+  def __init__(self, terms, offsets, docs, freqs, doc_lengths, k1=1.2, b=0.75):
+    self.terms = terms
+    self.offsets = offsets
+    self.docs = docs
+    self.freqs = freqs
+    self.doc_lengths = doc_lengths
+    self.k1 = k1
+    self.b = b
+
+    self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.
+    self.length_norm = (k1 * (1 - b + b * doc_lengths / max(self.avg_doc_length, 1.))).astype(
+      np.float32)
+
+  def __len__(self):
+    return len(self.doc_lengths)
+
+  def postings(self, term):
+    """Return the item ids and term frequencies of a term."""
+    pos = np.searchsorted(self.terms, term)
+    if pos >= len(self.terms) or self.terms[pos] != term:
+      return None, None
+    start, end = self.offsets[pos], self.offsets[pos + 1]
+    return self.docs[start:end], self.freqs[start:end]
+
+  def search(self, query_str, k=10, ids=None):
+    """Return the `k` items with the highest BM25 score for a query.
+
+    Args:
+      query_str: The query string.
+      k: Number of items to return.
+      ids: An optional sorted array of the ids of the items to search.
+
+    Returns:
+      A tuple of item ids and scores by decreasing score. Items
+      matching no term of the query are never returned.
+    """
+    num_docs = len(self)
+    scores = None
+    for term in set(tokenize(query_str)):
+      docs, freqs = self.postings(term)
+      if docs is None:
+        continue
+      if scores is None:
+        scores = np.zeros(num_docs, dtype=np.float32)
+      idf = np.log(1. + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+      freqs = freqs.astype(np.float32)
+      scores[docs] += idf * freqs * (self.k1 + 1) / (freqs + self.length_norm[docs])
+
+    if scores is None:
+      return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    matches = np.flatnonzero(scores)
+    if ids is not None:
+      matches = np.intersect1d(matches, ids, assume_unique=True)
+    if len(matches) > k:
+      matches = matches[np.argpartition(-scores[matches], k - 1)[:k]]
+    order = np.argsort(-scores[matches], kind='mergesort')
+    return matches[order].astype(np.int64), scores[matches[order]]
+
+  def subset(self, keep):
+    """Return the index of the items in `keep`, renumbered by their position in it.
+
+    Args:
+      keep: A sorted array of item ids.
+    """
+    keep = np.asarray(keep, dtype=np.int64)
+    positions = np.searchsorted(keep, self.docs)
+    kept = (positions < len(keep)) & (keep[np.minimum(positions, len(keep) - 1)] == self.docs)
+
+    term_ids = np.repeat(np.arange(len(self.terms)), np.diff(self.offsets))[kept]
+    offsets = np.zeros(len(self.terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(self.terms)))
+    return LexicalIndex(self.terms, offsets, positions[kept].astype(np.int32),
+                        self.freqs[kept], self.doc_lengths[keep], k1=self.k1, b=self.b)
+
+  def save(self, path):
+    with open(path, 'wb') as index_file:
+      np.savez(index_file, terms=self.terms, offsets=self.offsets, docs=self.docs,
+               freqs=self.freqs, doc_lengths=self.doc_lengths, params=np.array([self.k1, self.b]))
+
+  @staticmethod
+  def load(path):
+    with np.load(path) as data:
+      k1, b = data['params']
+      return LexicalIndex(data['terms'], data['offsets'], data['docs'], data['freqs'],
+                          data['doc_lengths'], k1=float(k1), b=float(b))
+
+  @staticmethod
+  def build(rows, name_weight=3):
+    """Build the index of the rows of lookup data.
+
+    Args:
+      rows: An iterable of lookup rows, in the order of
+            `CodeSearchEngine.DICT_LABELS`.
+      name_weight: Number of times the terms of function names are counted.
+    """
+    vocabulary = {}
+    term_ids, docs, freqs, doc_lengths = [], [], [], []
+    for doc, row in enumerate(rows):
+      counts = {}
+      doc_terms = tokenize(row[LexicalIndex.FUNCTION_LABEL])
+      doc_terms += tokenize(row[LexicalIndex.NAME_LABEL]) * name_weight
+      for term in doc_terms:
+        counts[term] = counts.get(term, 0) + 1
+      for term, count in counts.items():
+        term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+        docs.append(doc)
+        freqs.append(min(count, np.iinfo(np.uint16).max))
+      doc_lengths.append(len(doc_terms))
+
+    logging.info("Indexed %d terms of %d items", len(vocabulary), len(doc_lengths))
+    terms = sorted(vocabulary, key=vocabulary.get)
+    sorted_terms = np.array(sorted(terms), dtype=six.text_type)
+    # Renumber terms in sorted order, keeping the postings of a term ordered by item.
+    rank = np.searchsorted(sorted_terms, np.array(terms, dtype=six.text_type))
+    term_ids = rank[np.array(term_ids, dtype=np.int64)]
+    order = np.argsort(term_ids, kind='mergesort')
+
+    offsets = np.zeros(len(sorted_terms) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(sorted_terms)))
+    return LexicalIndex(sorted_terms, offsets,
+                        np.array(docs, dtype=np.int32)[order],
+                        np.array(freqs, dtype=np.uint16)[order],
+                        np.array(doc_lengths, dtype=np.int32))
+
+
+class ShardedLexicalIndex:
+  """Search the lexical indexes of several index shards as one.
+
+  Args:
+    indexes: A list with the `LexicalIndex` of each shard.
+    offsets: A list with the global id of the first item of each shard,
+             e.g. `ShardedLookup.offsets`.
+  """
+
+  def __init__(self, indexes, offsets):
+    self.indexes = indexes
+    self.offsets = offsets[:len(indexes)]
+
+  def __len__(self):
+    return sum(len(index) for index in self.indexes)
+
+  def search(self, query_str, k=10, ids=None):
+    shard_results = []
+    for index, offset in zip(self.indexes, self.offsets):
+      shard_ids = None
+      if ids is not None:
+        shard_ids = ids[(ids >= offset) & (ids < offset + len(index))] - offset
+      shard_results.append(index.search(query_str, k=k, ids=shard_ids))
+    # merge_top_k keeps the smallest values, so scores are negated.
+    ids, scores = merge_top_k([(ids, -scores) for ids, scores in shard_results],
+                              self.offsets, k)
+    return ids, -scores
@@ -0,0 +1,157 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+
+from code_search.nmslib.delta_index import EMBEDDINGS_SUFFIX
+from code_search.nmslib.lexical_index import LEXICAL_SUFFIX, LexicalIndex, \
+  ShardedLexicalIndex, reciprocal_rank_fusion, tokenize
+from code_search.nmslib.search_engine import CodeSearchEngine
+
+FUNCTIONS = [
+  ('get_user_name', 'def get_user_name(uid):\n  """Return the name of a user."""\n  '
+                    'return users[uid].name'),
+  ('parseJson', 'def parseJson(text):\n  """Parse a JSON document."""\n  return json.loads(text)'),
+  ('read_file', 'def read_file(path):\n  """Read a whole file."""\n  '
+                'with open(path) as f:\n    return f.read()'),
+  ('add', 'def add(a, b):\n  return a + b'),
+]
+
+
+def make_rows():
+  return [['owner/repo', 'a.py', name, str(i), source]
+          for i, (name, source) in enumerate(FUNCTIONS)]
+
+
+class TestLexicalIndex(unittest.TestCase):
+  def setUp(self):
+    self.index = LexicalIndex.build(make_rows())
+
+  def test_tokenize(self):
+    self.assertEqual(tokenize(u'getUserName(HTTPServer, parse_json)'),
+                     [u'getusername', u'get', u'user', u'name', u'httpserver', u'http',
+                      u'server', u'parse_json', u'parse', u'json'])
+
+  def test_search(self):
+    ids, scores = self.index.search('name of the user', k=2)
+    self.assertEqual(ids.tolist(), [0])
+    self.assertGreater(scores[0], 0)
+
+    # Function names are split into their parts and weighted.
+    ids, _ = self.index.search('parse json', k=10)
+    self.assertEqual(ids.tolist(), [1])
+    ids, _ = self.index.search('read_file', k=10)
+    self.assertEqual(ids.tolist(), [2])
+    ids, scores = self.index.search('unknown words', k=10)
+    self.assertEqual(len(ids), 0)
+    self.assertEqual(len(scores), 0)
+
+  def test_save_load(self):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp_dir, 'code.index' + LEXICAL_SUFFIX)
+      self.index.save(path)
+      loaded = LexicalIndex.load(path)
+      self.assertEqual(len(loaded), len(FUNCTIONS))
+      for query in ['user name', 'json', 'a b']:
+        np.testing.assert_array_equal(loaded.search(query)[0], self.index.search(query)[0])
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def test_subset(self):
+    subset = self.index.subset([1, 3])
+    self.assertEqual(len(subset), 2)
+    self.assertEqual(subset.search('parse json')[0].tolist(), [0])
+    self.assertEqual(subset.search('add')[0].tolist(), [1])
+    self.assertEqual(len(subset.search('user name')[0]), 0)
+
+  def test_sharded(self):
+    sharded = ShardedLexicalIndex([LexicalIndex.build(make_rows()[:2]),
+                                   LexicalIndex.build(make_rows()[2:])], [0, 2, 4])
+    self.assertEqual(sharded.search('read file')[0].tolist(), [2])
+    self.assertEqual(sharded.search('parse json')[0].tolist(), [1])
+
+  def test_reciprocal_rank_fusion(self):
+    fused = reciprocal_rank_fusion([['a', 'b', 'c'], ['c', 'a']], lambda result: result, 2)
+    self.assertEqual([result for result, _ in fused], ['a', 'c'])
+    self.assertAlmostEqual(fused[0][1], 1. / 61 + 1. / 62)
+
+
+class TestHybridSearch(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.index_file = os.path.join(self.tmp_dir, 'code.index')
+
+    rng = np.random.RandomState(0)
+    self.data = rng.randn(len(FUNCTIONS), 8).astype(np.float32)
+    self.rows = make_rows()
+
+    CodeSearchEngine.create_index(self.data, self.index_file, print_progress=False)
+    LexicalIndex.build(self.rows).save(self.index_file + LEXICAL_SUFFIX)
+
+    self.release = threading.Event()
+    self.release.set()
+
+  def tearDown(self):
+    self.release.set()
+    shutil.rmtree(self.tmp_dir)
+
+  def embed(self, _query_str):
+    self.release.wait()
+    # Every query is embedded as the function "add".
+    return self.data[3]
+
+  def function_names(self, result):
+    return [item['function_name'] for item in result]
+
+  def test_hybrid_query(self):
+    engine = CodeSearchEngine(self.index_file, self.rows, self.embed, hybrid=True,
+                              embedding_timeout=5)
+    result = engine.query('parse json', k=2)
+    self.assertEqual(result.retrieval, 'hybrid')
+    self.assertEqual(sorted(self.function_names(result)), ['add', 'parseJson'])
+
+  def test_lexical_fallback(self):
+    engine = CodeSearchEngine(self.index_file, self.rows, self.embed, hybrid=True,
+                              embedding_timeout=0.05, embedding_retry_seconds=60)
+    self.release.clear()
+    result = engine.query('parse json', k=2)
+    self.assertEqual(result.retrieval, 'lexical')
+    self.assertEqual(self.function_names(result), ['parseJson'])
+
+    # Queries are served lexically without waiting until the retry time.
+    self.assertFalse(engine.embedding_available())
+    self.assertEqual(engine.query('read file', k=2).retrieval, 'lexical')
+
+  def test_lexical_fallback_on_error(self):
+    def fail(_query_str):
+      raise IOError('TF Serving is down')
+
+    engine = CodeSearchEngine(self.index_file, self.rows, fail, hybrid=True)
+    result = engine.query('user name', k=2)
+    self.assertEqual(result.retrieval, 'lexical')
+    self.assertEqual(self.function_names(result), ['get_user_name'])
+
+  def test_compact(self):
+    np.save(self.index_file + EMBEDDINGS_SUFFIX, self.data)
+    engine = CodeSearchEngine(self.index_file, self.rows, self.embed, hybrid=True,
+                              delta_tier=True)
+    engine.delete([0])
+    self.assertEqual(len(engine.lexical_query('user name', k=2)), 0)
+
+    engine.compact(os.path.join(self.tmp_dir, 'compacted.index'))
+    self.assertEqual(self.function_names(engine.lexical_query('read file', k=2)),
+                     ['read_file'])
+
+  def test_missing_lexical_index(self):
+    os.remove(self.index_file + LEXICAL_SUFFIX)
+    with self.assertRaises(ValueError):
+      CodeSearchEngine(self.index_file, self.rows, self.embed, hybrid=True)
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
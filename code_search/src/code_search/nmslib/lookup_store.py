@@ -0,0 +1,139 @@
+"""A compact, memory-mapped store for the reverse index lookup.
+
+The file layout is
+
+  +--------------------------------------------------+
+  | header: magic, version, num_rows, num_fields     |
+  +--------------------------------------------------+
+  | offsets: (num_rows * num_fields + 1) x uint64    |
+  +--------------------------------------------------+
+  | heap: UTF-8 encoded field values, back to back   |
+  +--------------------------------------------------+
+
+Field `j` of row `i` is the heap slice between offsets
+`i * num_fields + j` and `i * num_fields + j + 1`. Only the
+rows which are actually requested are ever decoded.
+"""
+import mmap
+import os
+import shutil
+import struct
+
+MAGIC = b'CSLK'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sIQI')
+_OFFSET = struct.Struct('<Q')
+
+
+class LookupStoreWriter:
+  """Stream rows into a lookup store file.
+
+  Field values and their offsets are appended to temporary files
+  as they arrive so that no rows are held in memory. The final
+  file is assembled when the writer is closed, or the temporary
+  files are removed if it is discarded. Used as a context manager,
+  the writer is discarded when an exception is raised.
+
+  Args:
+    path: Path string to the output lookup store file.
+    num_fields: Number of fields in every row.
+  """
+
+  def __init__(self, path, num_fields):
+    self.path = path
+    self.num_fields = num_fields
+    self.num_rows = 0
+
+    self._offset = 0
+    self._offsets_path = path + '.offsets'
+    self._offsets = open(self._offsets_path, 'wb')
+    self._offsets.write(_OFFSET.pack(self._offset))
+    self._heap_path = path + '.heap'
+    self._heap = open(self._heap_path, 'wb')
+
+  def write(self, row):
+    if len(row) != self.num_fields:
+      raise ValueError('Expected {} fields but got {}'.format(self.num_fields, len(row)))
+
+    for value in row:
+      if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+      self._heap.write(value)
+      self._offset += len(value)
+      self._offsets.write(_OFFSET.pack(self._offset))
+    self.num_rows += 1
+
+  def close(self):
+    self._offsets.close()
+    self._heap.close()
+
+    with open(self.path, 'wb') as store_file:
+      store_file.write(_HEADER.pack(MAGIC, VERSION, self.num_rows, self.num_fields))
+      for part_path in [self._offsets_path, self._heap_path]:
+        with open(part_path, 'rb') as part_file:
+          shutil.copyfileobj(part_file, store_file)
+        os.remove(part_path)
+
+  def discard(self):
+    """Close the writer and remove its files without writing the lookup store."""
+    self._offsets.close()
+    self._heap.close()
+    for part_path in [self._offsets_path, self._heap_path]:
+      os.remove(part_path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *_args):
+    if exc_type is None:
+      self.close()
+    else:
+      self.discard()
+
+
+class LookupStore:
+  """Read-only, memory-mapped view over a lookup store file.
+
+  This behaves like the list of CSV rows it replaces: `len`
+  returns the number of rows and indexing returns the list of
+  field strings for a row.
+
+  Args:
+    path: Path string to a local lookup store file.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as store_file:
+      self._mmap = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, self.num_rows, self.num_fields = _HEADER.unpack_from(self._mmap, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError('{} is not a version {} lookup store'.format(path, VERSION))
+
+    self._row = struct.Struct('<{}Q'.format(self.num_fields + 1))
+    self._offsets_start = _HEADER.size
+    self._heap_start = (self._offsets_start +
+                        (self.num_rows * self.num_fields + 1) * _OFFSET.size)
+
+  def __len__(self):
+    return self.num_rows
+
+  def __getitem__(self, idx):
+    idx = int(idx)
+    if idx < 0:
+      idx += self.num_rows
+    if not 0 <= idx < self.num_rows:
+      raise IndexError('lookup store index out of range')
+
+    offsets = self._row.unpack_from(
+      self._mmap, self._offsets_start + idx * self.num_fields * _OFFSET.size)
+    heap_start = self._heap_start
+    return [
+      self._mmap[heap_start + start:heap_start + end].decode('utf-8')
+      for start, end in zip(offsets, offsets[1:])
+    ]
+
+  def close(self):
+    self._mmap.close()
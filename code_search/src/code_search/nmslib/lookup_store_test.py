@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from code_search.nmslib.lookup_store import LookupStore, LookupStoreWriter
+
+
+class TestLookupStore(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.store_file = os.path.join(self.tmp_dir, 'lookup.bin')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def test_round_trip(self):
+    rows = [
+      [u'kubeflow/examples', u'code_search/a.py', u'f', u'1', u'def f():\n  return "a,b"'],
+      [u'owner/repo', u'', u'g', u'42', u''],
+      [u'owner/ünïcödé', u'b.py', u'h', u'7', u'def h():\n  """Dóc."""'],
+    ]
+    with LookupStoreWriter(self.store_file, 5) as writer:
+      for row in rows:
+        writer.write(row)
+
+    store = LookupStore(self.store_file)
+    self.assertEqual(len(store), len(rows))
+    for idx, row in enumerate(rows):
+      self.assertEqual(store[idx], row)
+    self.assertEqual(store[-1], rows[-1])
+    with self.assertRaises(IndexError):
+      store[len(rows)]  # pylint: disable=pointless-statement
+    store.close()
+
+    self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['lookup.bin'])
+
+  def test_wrong_number_of_fields(self):
+    with LookupStoreWriter(self.store_file, 2) as writer:
+      with self.assertRaises(ValueError):
+        writer.write([u'a'])
+
+  def test_discard_on_error(self):
+    with self.assertRaises(ValueError):
+      with LookupStoreWriter(self.store_file, 2) as writer:
+        writer.write([u'a', u'b'])
+        raise ValueError('failed')
+
+    self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
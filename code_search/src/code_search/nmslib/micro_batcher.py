@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from six.moves import queue
+
+
+class MicroBatcher:
+  """Coalesce concurrent single requests into batches.
+
+  Callers block in `submit` while a background thread
+  collects pending requests until either `max_batch_size`
+  requests are available or `max_wait_ms` has elapsed since
+  the first request of the batch arrived. The whole batch is
+  then handed to `batch_fn` in one call and each caller gets
+  its own result back.
+
+  Args:
+    batch_fn: A function which takes a list of requests and returns
+              a list of results in the same order.
+    max_batch_size: An integer upper bound on the number of requests
+                    per call to `batch_fn`.
+    max_wait_ms: Maximum time in milliseconds to hold the first request
+                 of a batch while waiting for more to arrive.
+  """
+
+  def __init__(self, batch_fn, max_batch_size=32, max_wait_ms=5):
+    self.batch_fn = batch_fn
+    self.max_batch_size = max_batch_size
+    self.max_wait_ms = max_wait_ms
+
+    self._queue = queue.Queue()
+    self._thread = threading.Thread(target=self._run, name='micro-batcher')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, request):
+    """Enqueue a request and block until its result is available."""
+    return self.submit_async(request).result()
+
+  def submit_async(self, request):
+    """Enqueue a request and return a `Future` of its result."""
+    future = Future()
+    self._queue.put((request, future))
+    return future
+
+  def _next_batch(self):
+    batch = []
+    deadline = None
+    while len(batch) < self.max_batch_size:
+      if deadline is None:
+        item = self._queue.get()
+      else:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        try:
+          item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+          break
+
+      # Requests cancelled while queued, e.g. by a timeout of the
+      # caller, are dropped. The others can no longer be cancelled.
+      if not item[1].set_running_or_notify_cancel():
+        continue
+      batch.append(item)
+      if deadline is None:
+        deadline = time.time() + self.max_wait_ms / 1000.0
+    return batch
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      requests = [request for request, _ in batch]
+      logging.debug("Processing micro-batch of size %d", len(requests))
+      try:
+        results = self.batch_fn(requests)
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error("Micro-batch of size %d failed: %s", len(requests), e)
+        for _, future in batch:
+          set_future(future, exception=e)
+        continue
+
+      for (_, future), result in zip(batch, results):
+        set_future(future, result=result)
+
+
+def set_future(future, result=None, exception=None):
+  """Resolve a running future, ignoring errors if it is already done."""
+  try:
+    if exception is not None:
+      future.set_exception(exception)
+    else:
+      future.set_result(result)
+  except Exception as e:  # pylint: disable=broad-except
+    logging.warning("Could not resolve a micro-batch request: %s", e)
@@ -0,0 +1,60 @@
+import logging
+import threading
+import unittest
+
+from code_search.nmslib.micro_batcher import MicroBatcher
+
+
+class TestMicroBatcher(unittest.TestCase):
+  def setUp(self):
+    self.batches = []
+    self.release = threading.Event()
+    self.release.set()
+    self.batcher = MicroBatcher(self.double, max_batch_size=4, max_wait_ms=20)
+
+  def double(self, requests):
+    self.release.wait()
+    self.batches.append(list(requests))
+    return [request * 2 for request in requests]
+
+  def test_batches(self):
+    batcher = MicroBatcher(self.double, max_batch_size=4, max_wait_ms=200)
+    futures = [batcher.submit_async(i) for i in range(6)]
+
+    self.assertEqual([future.result(timeout=5) for future in futures],
+                     [2 * i for i in range(6)])
+    self.assertEqual(self.batches, [[0, 1, 2, 3], [4, 5]])
+
+  def test_batch_error(self):
+    batcher = MicroBatcher(self.reject, max_batch_size=4, max_wait_ms=20)
+    futures = [batcher.submit_async(i) for i in range(3)]
+    for future in futures:
+      with self.assertRaises(ValueError):
+        future.result(timeout=5)
+
+  def reject(self, requests):
+    raise ValueError('Cannot process {}'.format(requests))
+
+  def test_cancel_pending_request(self):
+    # Hold the batch of the first request so that the next ones stay queued.
+    self.release.clear()
+    first = self.batcher.submit_async(1)
+    while not first.running():
+      pass
+    cancelled = self.batcher.submit_async(2)
+    pending = self.batcher.submit_async(3)
+    self.assertTrue(cancelled.cancel())
+    self.assertFalse(first.cancel())
+    self.release.set()
+
+    self.assertEqual(first.result(timeout=5), 2)
+    self.assertEqual(pending.result(timeout=5), 6)
+    self.assertNotIn(2, [request for batch in self.batches for request in batch])
+
+    # The batching thread keeps answering requests.
+    self.assertEqual(self.batcher.submit(5), 10)
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -0,0 +1,164 @@
+import zipfile
+import numpy as np
+
+EXACT_SUFFIX = '.exact.npy'
+
+QUANTIZATION_DTYPES = {
+  'float16': np.float16,
+  'int8': np.int8,
+}
+
+
+def normalize(vectors):
+  norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+  return vectors / np.maximum(norms, 1e-12)
+
+
+def int8_scale(data, chunk_size=65536):
+  """Per-dimension scale mapping the largest absolute value to 127."""
+  max_abs = np.zeros(data.shape[1], dtype=np.float32)
+  for start in range(0, len(data), chunk_size):
+    chunk = normalize(np.asarray(data[start:start + chunk_size], dtype=np.float32))
+    max_abs = np.maximum(max_abs, np.abs(chunk).max(axis=0))
+  return np.maximum(max_abs, 1e-12) / 127
+
+
+def quantize(vectors, quantization, scale=None):
+  if quantization == 'int8':
+    return np.clip(np.round(vectors / scale), -127, 127).astype(np.int8)
+  return vectors.astype(QUANTIZATION_DTYPES[quantization])
+
+
+class QuantizedIndex:
+  """Brute force cosine search over scalar quantized vectors.
+
+  Vectors are normalized and stored either as float16 or as int8
+  with a per-dimension scale, which is 2x or 4x smaller than
+  float32. A query scores all the compressed vectors in chunks,
+  keeps the best `rescore_factor * k` candidates and re-scores
+  them against the exact normalized float32 vectors, which are
+  memory-mapped from disk so that only the candidates are read.
+  Unlike an HNSW index, query time grows linearly with the number
+  of vectors, which `benchmark_index` reports side by side.
+
+  This exposes the `knnQuery` and `knnQueryBatch` methods of an
+  nmslib index with the distances of nmslib's `cosinesimil` space.
+
+  Args:
+    codes: A 2-D numpy array of quantized normalized vectors.
+    scale: A 1-D numpy array with the scale of each dimension for int8
+           codes, or None.
+    exact: A 2-D numpy array (usually memory-mapped) of the exact
+           normalized float32 vectors.
+    rescore_factor: Number of candidates re-scored per result.
+    chunk_size: Number of vectors scored at once.
+  """
+
+  # The query time parameters of `setQueryTimeParams`.
+  QUERY_PARAMS = ['rescoreFactor']
+
+  def __init__(self, codes, scale, exact, rescore_factor=4, chunk_size=65536):
+    self.codes = codes
+    self.scale = scale
+    self.exact = exact
+    self.rescore_factor = rescore_factor
+    self.chunk_size = chunk_size
+
+  def __len__(self):
+    return len(self.codes)
+
+  @property
+  def quantization(self):
+    return 'int8' if self.codes.dtype == np.int8 else 'float16'
+
+  @property
+  def nbytes(self):
+    """Number of bytes held in memory by the compressed vectors."""
+    return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+  def setQueryTimeParams(self, params):  # pylint: disable=invalid-name
+    self.rescore_factor = params.get('rescoreFactor', self.rescore_factor)
+
+  def knnQuery(self, vector, k=10):  # pylint: disable=invalid-name
+    return self.knnQueryBatch(np.asarray([vector]), k=k)[0]
+
+  def knnQueryBatch(self, vectors, k=10,  # pylint: disable=invalid-name,unused-argument
+                    num_threads=0):
+    queries = normalize(np.asarray(vectors, dtype=np.float32))
+    k = min(k, len(self.codes))
+    num_candidates = min(max(k * self.rescore_factor, k), len(self.codes))
+
+    candidates = self.candidates(queries, num_candidates)
+
+    results = []
+    for query, query_candidates in zip(queries, candidates):
+      query_candidates = np.sort(query_candidates)
+      dists = 1 - np.dot(self.exact[query_candidates], query)
+      order = np.argsort(dists, kind='mergesort')[:k]
+      results.append((query_candidates[order].astype(np.int32), dists[order]))
+    return results
+
+  def candidates(self, queries, num_candidates):
+    """Return the ids of the best candidates by approximate similarity."""
+    if self.scale is not None:
+      queries = queries * self.scale
+
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    best_sims = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(self.codes), self.chunk_size):
+      chunk = np.asarray(self.codes[start:start + self.chunk_size], dtype=np.float32)
+      sims = np.concatenate([best_sims, np.dot(queries, chunk.T)], axis=1)
+      ids = np.concatenate([best_ids, np.broadcast_to(
+        np.arange(start, start + len(chunk)), (len(queries), len(chunk)))], axis=1)
+
+      if sims.shape[1] > num_candidates:
+        top = np.argpartition(-sims, num_candidates - 1, axis=1)[:, :num_candidates]
+        rows = np.arange(len(queries))[:, np.newaxis]
+        sims, ids = sims[rows, top], ids[rows, top]
+      best_sims, best_ids = sims, ids
+
+    return best_ids
+
+  @staticmethod
+  def is_quantized(path):
+    return zipfile.is_zipfile(path)
+
+  @staticmethod
+  def load(path, mmap_exact=True):
+    """Load a quantized index and memory-map its exact vectors."""
+    with np.load(path) as arrays:
+      codes = arrays['codes']
+      scale = arrays['scale'] if arrays['scale'].size else None
+    exact = np.load(path + EXACT_SUFFIX, mmap_mode='r' if mmap_exact else None)
+    return QuantizedIndex(codes, scale, exact)
+
+  @staticmethod
+  def create(data, save_path, quantization, chunk_size=65536):
+    """Quantize numpy data and save it to path.
+
+    The quantized vectors are saved to `save_path` and the
+    exact normalized vectors to `save_path` + `EXACT_SUFFIX`.
+
+    Args:
+      data: A 2-D numpy array with one embedding per row.
+      save_path: Path string to write the index to.
+      quantization: Either 'float16' or 'int8'.
+      chunk_size: Number of vectors processed at once.
+    """
+    if quantization not in QUANTIZATION_DTYPES:
+      raise ValueError('Unknown quantization {}'.format(quantization))
+
+    scale = int8_scale(data, chunk_size) if quantization == 'int8' else None
+    codes = np.empty(data.shape, dtype=QUANTIZATION_DTYPES[quantization])
+    exact = np.lib.format.open_memmap(save_path + EXACT_SUFFIX, mode='w+', dtype=np.float32,
+                                      shape=data.shape)
+    for start in range(0, len(data), chunk_size):
+      chunk = normalize(np.asarray(data[start:start + chunk_size], dtype=np.float32))
+      exact[start:start + chunk_size] = chunk
+      codes[start:start + chunk_size] = quantize(chunk, quantization, scale)
+    exact.flush()
+    del exact
+
+    with open(save_path, 'wb') as index_file:
+      np.savez(index_file, codes=codes,
+               scale=scale if scale is not None else np.zeros(0, dtype=np.float32))
@@ -0,0 +1,69 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from code_search.nmslib.quantized_index import QuantizedIndex
+from code_search.nmslib.search_engine import CodeSearchEngine
+
+
+class TestQuantizedIndex(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.index_file = os.path.join(self.tmp_dir, 'quantized.index')
+
+    rng = np.random.RandomState(0)
+    self.data = rng.randn(500, 16).astype(np.float32)
+    self.queries = self.data[:20] + 0.01 * rng.randn(20, 16).astype(np.float32)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def exact_neighbours(self, k):
+    data = self.data / np.linalg.norm(self.data, axis=1, keepdims=True)
+    queries = self.queries / np.linalg.norm(self.queries, axis=1, keepdims=True)
+    return np.argsort(-np.dot(queries, data.T), axis=1)[:, :k]
+
+  def check_quantization(self, quantization, expected_dtype):
+    QuantizedIndex.create(self.data, self.index_file, quantization, chunk_size=64)
+    self.assertTrue(QuantizedIndex.is_quantized(self.index_file))
+
+    index = QuantizedIndex.load(self.index_file)
+    index.chunk_size = 64
+    self.assertEqual(index.codes.dtype, expected_dtype)
+    self.assertLess(index.nbytes, self.data.nbytes)
+
+    index.setQueryTimeParams({'rescoreFactor': 10})
+    expected = self.exact_neighbours(5)
+    neighbours = index.knnQueryBatch(self.queries, k=5)
+    for (ids, dists), expected_ids in zip(neighbours, expected):
+      self.assertEqual(ids.tolist(), expected_ids.tolist())
+      self.assertTrue(np.all(np.diff(dists) >= 0))
+
+    ids, dists = index.knnQuery(self.data[7], k=1)
+    self.assertEqual(ids.tolist(), [7])
+    self.assertAlmostEqual(float(dists[0]), 0.0, places=5)
+
+  def test_query_params(self):
+    params = {'efSearch': 50, 'rescoreFactor': 7}
+    QuantizedIndex.create(self.data, self.index_file, 'int8')
+    self.assertEqual(CodeSearchEngine.load_index(self.index_file, params).rescore_factor, 7)
+
+    # HNSW indexes only get their own parameters.
+    hnsw_file = os.path.join(self.tmp_dir, 'hnsw.index')
+    CodeSearchEngine.create_index(self.data, hnsw_file, print_progress=False)
+    index = CodeSearchEngine.load_index(hnsw_file, params)
+    self.assertEqual(index.knnQuery(self.data[3], k=1)[0].tolist(), [3])
+
+  def test_float16(self):
+    self.check_quantization('float16', np.float16)
+
+  def test_int8(self):
+    self.check_quantization('int8', np.int8)
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -0,0 +1,97 @@
+import logging
+import os
+import re
+import time
+import numpy as np
+
+from code_search.nmslib import file_io
+from code_search.nmslib.micro_batcher import MicroBatcher
+
+
+def latest_saved_model_dir(saved_model_dir):
+  """Return the directory of the newest version of an exported model.
+
+  Like TF Serving, an export directory with numbered version
+  subdirectories is resolved to its highest version.
+  """
+  if file_io.exists(os.path.join(saved_model_dir, 'saved_model.pb')):
+    return saved_model_dir
+
+  versions = [name.rstrip('/') for name in file_io.list_directory(saved_model_dir)
+              if re.match(r'^\d+/?$', name)]
+  if not versions:
+    raise ValueError('No SavedModel found in {}'.format(saved_model_dir))
+  return os.path.join(saved_model_dir, max(versions, key=int))
+
+
+class SavedModelEmbedder:
+  """Embed queries with a SavedModel loaded in this process.
+
+  This replaces the requests to TF Serving of the search server.
+  Queries are serialized into TF Examples by the calling threads
+  and queued. A single inference thread drains the queue in
+  batches of up to `max_batch_size` queries, waiting at most
+  `max_wait_ms` for a batch to fill, and runs the model once per
+  batch, see `MicroBatcher`. An instance can be used as the
+  embedding function of `CodeSearchEngine`.
+
+  Args:
+    predict_fn: A function which takes a dict with a list of serialized
+                TF Examples under `input_key` and returns a dict with a
+                batch of embeddings under `output_key`.
+    encoder: A function which encodes a query string into a serialized
+             TF Example.
+    max_batch_size: Maximum number of queries embedded at once.
+    max_wait_ms: Maximum time in milliseconds the first query of a batch
+                 waits for others to arrive.
+    input_key: Name of the serialized examples input of the signature.
+    output_key: Name of the embeddings output of the signature.
+  """
+
+  def __init__(self, predict_fn, encoder, max_batch_size=16, max_wait_ms=2,
+               input_key='input', output_key='outputs'):
+    self.predict_fn = predict_fn
+    self.encoder = encoder
+    self.input_key = input_key
+    self.output_key = output_key
+
+    self.batcher = MicroBatcher(self._predict, max_batch_size=max_batch_size,
+                                max_wait_ms=max_wait_ms)
+
+  def __call__(self, query_str):
+    return self.embed_async(query_str).result()
+
+  def embed_batch(self, query_strs):
+    """Embed a list of query strings, in as many batches as needed."""
+    futures = [self.embed_async(query_str) for query_str in query_strs]
+    return [future.result() for future in futures]
+
+  def embed_async(self, query_str):
+    """Queue a query string and return a `Future` of its embedding."""
+    return self.batcher.submit_async(self.encoder(query_str))
+
+  def _predict(self, examples):
+    start = time.time()
+    embeddings = np.asarray(self.predict_fn({self.input_key: examples})[self.output_key])
+    logging.debug("Embedded %d queries in %.1fms", len(examples), (time.time() - start) * 1000)
+    return list(embeddings)
+
+  @staticmethod
+  def load(saved_model_dir, encoder, signature_def_key='serving_default', **kwargs):
+    """Load a SavedModel exported for TF Serving.
+
+    Args:
+      saved_model_dir: Path to the SavedModel, or to an export directory with
+                       numbered versions of it.
+      encoder: A function which encodes a query string into a serialized
+               TF Example.
+      signature_def_key: The signature to run.
+      kwargs: Arguments of `SavedModelEmbedder`.
+    """
+    # Imported here as TensorFlow is only needed to embed queries in-process.
+    from tensorflow.contrib import predictor
+
+    saved_model_dir = latest_saved_model_dir(saved_model_dir)
+    logging.info("Loading the SavedModel in %s", saved_model_dir)
+    predict_fn = predictor.from_saved_model(saved_model_dir, signature_def_key=signature_def_key)
+    return SavedModelEmbedder(predict_fn, encoder, **kwargs)
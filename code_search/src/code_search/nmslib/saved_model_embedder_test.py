@@ -0,0 +1,60 @@
+import logging
+import threading
+import unittest
+import numpy as np
+
+from code_search.nmslib.saved_model_embedder import SavedModelEmbedder
+
+
+class FakePredictor:
+  """Embed an example `b'<n>'` as the vector `[n, n]` and record the batches."""
+
+  def __init__(self):
+    self.batch_sizes = []
+    self.threads = set()
+    self.release = threading.Event()
+    self.release.set()
+
+  def __call__(self, inputs):
+    self.release.wait()
+    self.batch_sizes.append(len(inputs['input']))
+    self.threads.add(threading.current_thread().name)
+    return {'outputs': np.array([[float(example)] * 2 for example in inputs['input']])}
+
+
+class TestSavedModelEmbedder(unittest.TestCase):
+  def setUp(self):
+    self.predictor = FakePredictor()
+    self.embedder = SavedModelEmbedder(self.predictor, lambda query_str: query_str.encode(),
+                                       max_batch_size=4, max_wait_ms=20)
+
+  def test_embed(self):
+    np.testing.assert_array_equal(self.embedder('3'), [3., 3.])
+
+  def test_embed_batch(self):
+    embeddings = self.embedder.embed_batch([str(i) for i in range(10)])
+    np.testing.assert_array_equal(embeddings, [[i, i] for i in range(10)])
+    self.assertEqual(sum(self.predictor.batch_sizes), 10)
+    self.assertTrue(all(size <= 4 for size in self.predictor.batch_sizes))
+
+  def test_single_inference_thread(self):
+    # Hold the first batch so that concurrent queries queue up behind it.
+    self.predictor.release.clear()
+    futures = [self.embedder.embed_async(str(i)) for i in range(8)]
+    self.predictor.release.set()
+    self.assertEqual([future.result()[0] for future in futures], list(range(8)))
+    self.assertEqual(len(self.predictor.threads), 1)
+    self.assertLess(len(self.predictor.batch_sizes), 8)
+
+  def test_error(self):
+    def fail(_inputs):
+      raise ValueError('Bad input')
+
+    embedder = SavedModelEmbedder(fail, lambda query_str: query_str.encode())
+    with self.assertRaises(ValueError):
+      embedder('query')
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
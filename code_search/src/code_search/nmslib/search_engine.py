@@ -1,5 +1,92 @@
+import contextlib
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import nmslib
+import numpy as np
+
+from code_search.nmslib.delta_index import (EMBEDDINGS_SUFFIX, LOOKUP_STORE_SUFFIX, TieredIndex,
+                                            TieredLookup, filter_tombstones)
+from code_search.nmslib.filter_index import FILTER_SUFFIX, FilterIndex, exact_knn
+from code_search.nmslib.lexical_index import (LEXICAL_SUFFIX, LexicalIndex,
+                                              ShardedLexicalIndex, reciprocal_rank_fusion)
+from code_search.nmslib.lookup_store import LookupStore, LookupStoreWriter
+from code_search.nmslib.micro_batcher import MicroBatcher
+from code_search.nmslib.quantized_index import QuantizedIndex, normalize
+from code_search.nmslib.sharded_index import RemoteShard, ShardedIndex
+
+
+class IndexSnapshot:
+  """An immutable pairing of a loaded index with its lookup data.
+
+  Queries hold a snapshot between `acquire` and `release`, and
+  a snapshot which was replaced is closed by `retire` once no
+  query holds it anymore.
+
+  Args:
+    index: A loaded nmslib index.
+    lookup_data: A list representing the data in the same order as in index.
+    version: A string identifying where the index was loaded from.
+    lexical_index: An optional `LexicalIndex` of the same items as index.
+    filter_index: An optional `FilterIndex` of the lookup data.
+    embeddings: An optional 2-D array with the vectors of index, used to
+                search filtered items exactly.
+  """
+
+  def __init__(self, index, lookup_data, version=None, lexical_index=None, filter_index=None,
+               embeddings=None):
+    self.index = index
+    self.lookup_data = lookup_data
+    self.version = version
+    self.lexical_index = lexical_index
+    self.filter_index = filter_index
+    self.embeddings = embeddings
+
+    self._lock = threading.Lock()
+    self._num_users = 0
+    self._retired = False
+
+  def acquire(self):
+    with self._lock:
+      self._num_users += 1
+
+  def release(self):
+    with self._lock:
+      self._num_users -= 1
+      closing = self._retired and not self._num_users
+    if closing:
+      self.close()
+
+  def retire(self):
+    """Close the snapshot as soon as no query holds it."""
+    with self._lock:
+      self._retired = True
+      closing = not self._num_users
+    if closing:
+      self.close()
+
+  def close(self):
+    """Close the lookup data, e.g. the memory map of a `LookupStore`."""
+    if hasattr(self.lookup_data, 'close'):
+      self.lookup_data.close()
+
+
+class QueryResult(list):
+  """A list of result dicts tagged with the index version which produced them.
+
+  `retrieval` is how the results were found: "vector", "lexical",
+  or "hybrid" for the fusion of both. `partial` is whether a
+  filtered search gave up before finding all of its results, see
+  `CodeSearchEngine.filtered_knn`.
+  """
+
+  def __init__(self, results, version=None, retrieval='vector', partial=False):
+    super(QueryResult, self).__init__(results)
+    self.version = version
+    self.retrieval = retrieval
+    self.partial = partial
 
 
 class CodeSearchEngine:
@@ -8,43 +95,694 @@ class CodeSearchEngine:
   This is a utility class which takes an nmslib
   index file and a data file to return data from.
 
+  The index and lookup data can be replaced at runtime with
+  `swap`. Every query reads the current `IndexSnapshot` once,
+  so queries which are in flight during a swap finish against
+  the version they started with.
+
+  The index can also be split into shards by passing a list of
+  index files (or URLs of shard servers) and a `ShardedLookup`
+  with the lookup data of every shard, see `ShardedIndex`.
+
+  With `delta_tier`, items can be added and deleted at runtime
+  without rebuilding the index, see `TieredIndex`. They are
+  searched together with the main index until `compact` folds
+  them into a new one. Swapping in a new index drops them.
+
+  With `hybrid`, the `LexicalIndex` saved next to the index file
+  is loaded as well. A query then runs BM25 over it while the
+  query is embedded and searched in a background thread, and the
+  two result lists are fused by reciprocal rank. If embedding the
+  query fails or takes longer than `embedding_timeout`, the BM25
+  results are served alone, and so is every query for the next
+  `embedding_retry_seconds` without waiting for the embedding.
+  Items added to the delta tier are only found by the vector search.
+
+  With `filtered_search`, queries can be restricted to a repository
+  and a path prefix, with the `FilterIndex` saved next to the index
+  file. Filters matching at most `exact_filter_size` items are
+  searched exactly over the vectors of just those items, when the
+  vectors are saved next to the index. Larger filters, or all filters
+  without saved vectors, search the index for about `2k / selectivity`
+  nearest neighbours, doubling that up to `max_fetch_factor` times
+  until `k` of them match. At most `max_filter_fetch` neighbours are
+  fetched, so a query scores at most `exact_filter_size` vectors or
+  fetches at most `max_filter_fetch` neighbours, whatever its filter.
+  A search which stops at that limit with fewer than `k` results is
+  marked as partial, see `QueryResult`.
+
   Args:
-    index_file: Path string to the nmslib index file.
+    index_file: Path string to the nmslib index file, or a list of paths
+                to index shards and URLs of remote shard servers.
     lookup_data: A list representing the data in the same order as in index.
     embedding_fn: A function which takes a string and returns a high-dimensional
                   embedding.
+    batch_embedding_fn: A function which takes a list of strings and returns
+                        a list of embeddings. Defaults to calling `embedding_fn`
+                        for each string.
+    max_batch_size: Maximum number of concurrent `query` calls coalesced into
+                    a single batch. A value of 1 disables micro-batching.
+    max_batch_wait_ms: Maximum time in milliseconds a `query` call waits for
+                       others to join its batch.
+    num_threads: Number of threads used by nmslib for batch queries.
+    version: A string identifying the version of the index.
+    query_params: An optional dict of nmslib query time parameters,
+                  e.g. `{'efSearch': 100}`.
+    delta_tier: Whether items can be added to and deleted from the index.
+    index_params: An optional dict of nmslib index time parameters used
+                  by `compact`.
+    hybrid: Whether queries are fused with the results of the lexical index.
+    embedding_timeout: Maximum time in seconds to wait for the vector results
+                       of a hybrid query. None waits indefinitely.
+    embedding_retry_seconds: Time in seconds during which hybrid queries are
+                             served lexically after an embedding failure.
+    fusion_depth: Number of results of each list fused by a hybrid query.
+    rrf_k: Constant of reciprocal rank fusion, see `reciprocal_rank_fusion`.
+    filtered_search: Whether queries can be filtered by repository and path.
+    exact_filter_size: Maximum number of items of a filter searched exactly.
+    max_fetch_factor: Maximum ratio of the number of neighbours fetched by
+                      a filtered search to its initial estimate.
+    max_filter_fetch: Maximum number of neighbours fetched by a filtered search.
   """
 
   DICT_LABELS = ['nwo', 'path', 'function_name', 'lineno', 'original_function']
 
-  def __init__(self, index_file, lookup_data, embedding_fn):
-    self.index = CodeSearchEngine.nmslib_init()
-    self.index.loadIndex(index_file)
+  # The labels identifying a function across result lists.
+  KEY_LABELS = ['nwo', 'path', 'function_name', 'lineno']
+
+  # The query time parameters of nmslib HNSW indexes.
+  HNSW_QUERY_PARAMS = ['efSearch']
+
+  def __init__(self, index_file, lookup_data, embedding_fn,
+               batch_embedding_fn=None, max_batch_size=1, max_batch_wait_ms=5,
+               num_threads=0, version=None, query_params=None, delta_tier=False,
+               index_params=None, hybrid=False, embedding_timeout=None,
+               embedding_retry_seconds=10, fusion_depth=50, rrf_k=60, filtered_search=False,
+               exact_filter_size=20000, max_fetch_factor=8, max_filter_fetch=10000):
+    self.query_params = query_params
+    self.delta_tier = delta_tier
+    self.index_params = index_params
+    self.hybrid = hybrid
+    self.embedding_timeout = embedding_timeout
+    self.embedding_retry_seconds = embedding_retry_seconds
+    self.fusion_depth = fusion_depth
+    self.rrf_k = rrf_k
+    self.filtered_search = filtered_search
+    self.exact_filter_size = exact_filter_size
+    self.max_fetch_factor = max_fetch_factor
+    self.max_filter_fetch = max_filter_fetch
+    self._embedding_down_until = 0
+    self._write_lock = threading.Lock()
+    # Guards replacing the snapshot against queries acquiring it.
+    self._snapshot_lock = threading.Lock()
+    # Shards of every version are queried from the same threads.
+    self.shard_executor = None
+    self.snapshot = self.load_snapshot(index_file, lookup_data, version)
 
-    self.lookup_data = lookup_data
     self.embedding_fn = embedding_fn
+    self.batch_embedding_fn = batch_embedding_fn
+    self.num_threads = num_threads
+
+    self.executor = None
+    if hybrid:
+      self.executor = ThreadPoolExecutor(max_workers=max(max_batch_size, 4))
+
+    self.batcher = None
+    if max_batch_size > 1:
+      self.batcher = MicroBatcher(self._query_requests,
+                                  max_batch_size=max_batch_size,
+                                  max_wait_ms=max_batch_wait_ms)
+
+  @property
+  def index(self):
+    return self.snapshot.index
+
+  @property
+  def lookup_data(self):
+    return self.snapshot.lookup_data
+
+  @property
+  def version(self):
+    return self.snapshot.version
+
+  @contextlib.contextmanager
+  def use_snapshot(self):
+    """Hold the active snapshot so that it is not closed while in use."""
+    with self._snapshot_lock:
+      snapshot = self.snapshot
+      snapshot.acquire()
+    try:
+      yield snapshot
+    finally:
+      snapshot.release()
+
+  def replace_snapshot(self, snapshot):
+    """Make a snapshot the active one and retire the previous one.
+
+    This must be called with the write lock held.
+    """
+    with self._snapshot_lock:
+      previous, self.snapshot = self.snapshot, snapshot
+    previous.retire()
+
+  def swap(self, index_file, lookup_data, version=None):
+    """Load a new index and atomically make it the active one.
+
+    The new index is fully loaded before it is swapped in,
+    so queries never observe a partially loaded index. The
+    lookup data of the previous index is closed once the
+    queries still using it are done.
+    """
+    logging.info("Loading index version %s from %s", version, index_file)
+    snapshot = self.load_snapshot(index_file, lookup_data, version)
+    with self._write_lock:
+      self.replace_snapshot(snapshot)
+    logging.info("Swapped to index version %s", version)
+
+  def load_snapshot(self, index_file, lookup_data, version=None):
+    if isinstance(index_file, (list, tuple)):
+      shards = [CodeSearchEngine.load_shard(path, self.query_params, version)
+                for path in index_file]
+      if self.shard_executor is None:
+        self.shard_executor = ThreadPoolExecutor(max_workers=len(shards))
+      index = ShardedIndex(shards, lookup_data.offsets, executor=self.shard_executor)
+    else:
+      index = CodeSearchEngine.load_index(index_file, self.query_params)
+
+    lexical_index = None
+    if self.hybrid:
+      if isinstance(index_file, (list, tuple)):
+        lexical_index = ShardedLexicalIndex(
+          [CodeSearchEngine.load_lexical_index(path) for path in index_file],
+          lookup_data.offsets)
+      else:
+        lexical_index = CodeSearchEngine.load_lexical_index(index_file)
+
+    filter_index = None
+    embeddings = None
+    if self.filtered_search:
+      if isinstance(index_file, (list, tuple)):
+        filter_index = FilterIndex.concat(
+          [CodeSearchEngine.load_filter_index(path, lookup)
+           for path, lookup in zip(index_file, lookup_data.lookups)],
+          lookup_data.offsets)
+      else:
+        filter_index = CodeSearchEngine.load_filter_index(index_file, lookup_data)
+        embeddings = CodeSearchEngine.load_embeddings(index_file, index)
+
+    if self.delta_tier:
+      if isinstance(index_file, (list, tuple)):
+        raise ValueError('The delta tier needs an unsharded index')
+      index = TieredIndex(index, len(lookup_data),
+                          embeddings if embeddings is not None else
+                          CodeSearchEngine.load_embeddings(index_file, index))
+      lookup_data = TieredLookup(lookup_data)
+    return IndexSnapshot(index, lookup_data, version, lexical_index=lexical_index,
+                         filter_index=filter_index, embeddings=embeddings)
+
+  def add(self, embeddings, rows):
+    """Add items to the delta tier of the index.
+
+    Nothing is added unless all the items are valid.
+
+    Args:
+      embeddings: A list of embeddings.
+      rows: A list with the lookup data of each embedding, in the
+            order of `DICT_LABELS`.
+
+    Returns:
+      A list with the id of each item, which stays the same when the
+      index is compacted.
+
+    Raises:
+      ValueError: If the embeddings are not vectors of the dimension of
+                  the index, one for each row.
+    """
+    if not self.delta_tier:
+      raise ValueError('Adding items needs the delta tier')
+    try:
+      embeddings = np.asarray(embeddings, dtype=np.float32)
+    except (TypeError, ValueError):
+      raise ValueError('Embeddings must be lists of numbers of the same length')
+    if embeddings.ndim != 2 or len(embeddings) != len(rows):
+      raise ValueError('Got embeddings of shape {} for {} rows'.format(embeddings.shape,
+                                                                      len(rows)))
+    if any(len(row) != len(self.DICT_LABELS) for row in rows):
+      raise ValueError('Rows must have the {} labels {}'.format(len(self.DICT_LABELS),
+                                                               self.DICT_LABELS))
+
+    with self._write_lock:
+      snapshot = self.snapshot
+      dim = snapshot.index.dim
+      if dim is not None and embeddings.shape[1] != dim:
+        raise ValueError('Got embeddings of dimension {} for an index of dimension {}'.format(
+          embeddings.shape[1], dim))
+
+      # The lookup data goes first so queries never find an item without it.
+      num_items = len(snapshot.lookup_data)
+      snapshot.lookup_data.add(rows)
+      try:
+        ids = snapshot.index.add(embeddings)
+      except Exception:
+        snapshot.lookup_data.truncate(num_items)
+        raise
+      if snapshot.filter_index is not None:
+        snapshot.filter_index.add(rows, num_items)
+      return ids
+
+  def delete(self, ids):
+    """Delete items from the index by the ids returned by `add`.
+
+    Items of the loaded index have their position in it as id.
+    """
+    if not self.delta_tier:
+      raise ValueError('Deleting items needs the delta tier')
+
+    with self._write_lock:
+      self.snapshot.index.delete(ids)
+
+  def compact(self, save_path):
+    """Fold the delta tier and the deleted items into a new main index.
+
+    The remaining items are written to a new index of the same kind
+    as the main index at `save_path`, streaming their vectors and
+    lookup rows to files next to it, so the new main index and its
+    lookup data are memory-mapped like the ones it replaces. Items which are added or deleted
+    while it is built are carried over to the delta tier of the new
+    index before it is swapped in. This changes the positions of the
+    items in the index but not their ids.
+
+    Returns:
+      True if the new index was swapped in, or False if another index
+      was swapped in while compacting.
+    """
+    with self.use_snapshot() as snapshot:
+      index = snapshot.index
+      with self._write_lock:
+        num_items = len(index)
+        tombstones = index.tombstones
+
+      keep = np.setdiff1d(np.arange(num_items), np.array(sorted(tombstones), dtype=np.int64))
+      if not len(keep):  # pylint: disable=len-as-condition
+        raise ValueError('Cannot compact an index without items')
+
+      logging.info("Compacting %d items into %s", len(keep), save_path)
+      index.save_vectors(keep, save_path + EMBEDDINGS_SUFFIX)
+      data = np.load(save_path + EMBEDDINGS_SUFFIX, mmap_mode='r')
+      if isinstance(index.main, QuantizedIndex):
+        QuantizedIndex.create(data, save_path, index.main.quantization)
+      else:
+        CodeSearchEngine.create_index(data, save_path, index_params=self.index_params,
+                                      print_progress=False)
+      main = CodeSearchEngine.load_index(save_path, self.query_params)
+      with LookupStoreWriter(save_path + LOOKUP_STORE_SUFFIX,
+                             len(self.DICT_LABELS)) as lookup_store_writer:
+        for idx in keep:
+          lookup_store_writer.write(snapshot.lookup_data[idx])
+
+      with self._write_lock:
+        if self.snapshot is not snapshot:
+          logging.info("Discarding the compacted index as the index was swapped")
+          return False
+
+        filter_index = None
+        if snapshot.filter_index is not None:
+          filter_index = snapshot.filter_index.subset(keep)
+
+        compacted_index = TieredIndex(main, len(keep),
+                                      CodeSearchEngine.load_embeddings(save_path, main),
+                                      main_ids=index.ids(keep), next_id=index.next_id)
+        compacted_lookup = TieredLookup(LookupStore(save_path + LOOKUP_STORE_SUFFIX))
+        added = num_items - index.main_size
+        if len(index.delta) > added:
+          if filter_index is not None:
+            filter_index.add(snapshot.lookup_data.rows[added:], len(compacted_index))
+          compacted_index.add(index.delta.vectors[added:], ids=index.delta_ids[added:])
+          compacted_lookup.add(snapshot.lookup_data.rows[added:])
+        compacted_index.delete(index.ids(sorted(index.tombstones - tombstones)).tolist())
+
+        compacted_lexical_index = None
+        if snapshot.lexical_index is not None:
+          # The lexical index only has the items of the index it was built with.
+          compacted_lexical_index = snapshot.lexical_index.subset(
+            keep[keep < len(snapshot.lexical_index)])
+
+        self.replace_snapshot(IndexSnapshot(compacted_index, compacted_lookup, snapshot.version,
+                                            lexical_index=compacted_lexical_index,
+                                            filter_index=filter_index))
+
+      logging.info("Swapped to the compacted index of version %s", snapshot.version)
+      return True
+
+  def query(self, query_str, k=2, nwo=None, path_prefix=None):
+    """Return the results of a query string.
+
+    Args:
+      query_str: The query string.
+      k: Number of results to return.
+      nwo: An optional repository the results must be in.
+      path_prefix: An optional directory or file path the results must be in.
+    """
+    if self.hybrid:
+      return self.hybrid_query(query_str, k=k, nwo=nwo, path_prefix=path_prefix)
+    return self.vector_query(query_str, k=k, nwo=nwo, path_prefix=path_prefix)
+
+  def vector_query(self, query_str, k=2, nwo=None, path_prefix=None):
+    """Embed a query string and return its `k` nearest neighbours."""
+    if self.batcher and not (nwo or path_prefix):
+      return self.batcher.submit((query_str, k))
 
-  def query(self, query_str, k=2):
     logging.info("Embedding query: %s", query_str)
     embedding = self.embedding_fn(query_str)
-    logging.info("Calling knn server")
-    idxs, dists = self.index.knnQuery(embedding, k=k)
+    return self.search(embedding, k=k, nwo=nwo, path_prefix=path_prefix)
+
+  def lexical_query(self, query_str, k=2, nwo=None, path_prefix=None):
+    """Return the `k` items with the highest BM25 score for a query string."""
+    with self.use_snapshot() as snapshot:
+      tombstones = snapshot.index.tombstones if self.delta_tier else frozenset()
+      filter_ids = self.filter_ids(snapshot, nwo, path_prefix)
+      ids, scores = snapshot.lexical_index.search(query_str, k=k + len(tombstones),
+                                                  ids=filter_ids)
+      ids, scores = filter_tombstones(ids, scores, tombstones, k)
+      return self.format_result(snapshot, ids, scores, retrieval='lexical')
+
+  def hybrid_query(self, query_str, k=2, nwo=None, path_prefix=None):
+    """Fuse the lexical and vector results of a query string.
+
+    The vector results are only waited for until `embedding_timeout`,
+    see `embedding_available`.
+    """
+    start = time.time()
+    depth = max(k, self.fusion_depth)
+
+    future = None
+    if self.embedding_available():
+      future = self.executor.submit(self.vector_query, query_str, depth, nwo, path_prefix)
+    lexical_result = self.lexical_query(query_str, k=depth, nwo=nwo, path_prefix=path_prefix)
+    if future is None:
+      return QueryResult(lexical_result[:k], lexical_result.version, 'lexical')
+
+    timeout = None
+    if self.embedding_timeout:
+      timeout = max(self.embedding_timeout - (time.time() - start), 0)
+    try:
+      vector_result = future.result(timeout=timeout)
+    except FutureTimeoutError:
+      self.embedding_failed('timed out after {}s'.format(self.embedding_timeout))
+      return QueryResult(lexical_result[:k], lexical_result.version, 'lexical')
+    except Exception as e:  # pylint: disable=broad-except
+      self.embedding_failed(e)
+      return QueryResult(lexical_result[:k], lexical_result.version, 'lexical')
+
+    return self.fuse([vector_result, lexical_result], k)
+
+  def embedding_available(self):
+    """Whether hybrid queries wait for query embeddings, see `embedding_failed`."""
+    return time.time() >= self._embedding_down_until
+
+  def embedding_failed(self, error):
+    """Serve hybrid queries lexically for `embedding_retry_seconds`."""
+    logging.warning("Embedding the query failed, serving lexical results for %ss: %s",
+                    self.embedding_retry_seconds, error)
+    self._embedding_down_until = time.time() + self.embedding_retry_seconds
+
+  def fuse(self, results, k=2):
+    """Fuse lists of results by reciprocal rank, see `reciprocal_rank_fusion`.
+
+    The score of each fused result is its reciprocal rank score.
+    """
+    fused = reciprocal_rank_fusion(
+      results, lambda result: tuple(result[label] for label in self.KEY_LABELS), k,
+      rrf_k=self.rrf_k)
+
+    fused_results = []
+    for result, score in fused:
+      result = dict(result)
+      result['score'] = str(score)
+      fused_results.append(result)
+    return QueryResult(fused_results, results[0].version, 'hybrid',
+                       partial=any(result.partial for result in results))
+
+  def search(self, embedding, k=2, nwo=None, path_prefix=None):
+    """Return the `k` nearest neighbours of an embedding.
+
+    This is the CPU-bound part of `query` and can be used
+    directly by callers which compute embeddings themselves.
+    """
+    with self.use_snapshot() as snapshot:
+      partial = False
+      if nwo or path_prefix:
+        idxs, dists, partial = self.filtered_knn(snapshot, embedding, k,
+                                                 self.filter_ids(snapshot, nwo, path_prefix))
+      else:
+        logging.info("Calling knn server")
+        idxs, dists = snapshot.index.knnQuery(embedding, k=k)
+
+      return self.format_result(snapshot, idxs, dists, partial=partial)
+
+  def filter_ids(self, snapshot, nwo=None, path_prefix=None):
+    """Return the sorted ids of the items matching filters, or None without filters."""
+    if not (nwo or path_prefix):
+      return None
+    if snapshot.filter_index is None:
+      raise ValueError('Filtering queries needs filtered search')
+
+    ids = snapshot.filter_index.ids(nwo=nwo, path_prefix=path_prefix)
+    tombstones = snapshot.index.tombstones if self.delta_tier else frozenset()
+    if tombstones:
+      ids = ids[~np.isin(ids, np.fromiter(tombstones, dtype=np.int64))]
+    return ids
+
+  def filtered_knn(self, snapshot, embedding, k, ids):
+    """Return the `k` nearest neighbours of an embedding among sorted ids.
+
+    See the class docstring for how the search depends on the number of ids.
+
+    Returns:
+      A tuple of the ids and distances of the neighbours, and whether the
+      search stopped at its limit with fewer than `k` of them although
+      more items match.
+    """
+    if not len(ids):  # pylint: disable=len-as-condition
+      return ids, np.zeros(0, dtype=np.float32), False
+
+    if len(ids) <= self.exact_filter_size:
+      vectors = self.filter_vectors(snapshot, ids)
+      if vectors is not None:
+        positions, dists = exact_knn(vectors, embedding, k)
+        return ids[positions], dists, False
+
+    num_items = len(snapshot.lookup_data)
+    fetch_k = min(num_items, self.max_filter_fetch,
+                  int(np.ceil(2. * k * num_items / len(ids))))
+    max_fetch_k = min(num_items, self.max_filter_fetch, fetch_k * self.max_fetch_factor)
+    while True:
+      found_ids, dists = snapshot.index.knnQuery(embedding, k=fetch_k)
+      found_ids = np.asarray(found_ids, dtype=np.int64)
+      matches = np.isin(found_ids, ids)
+      if matches.sum() >= k or fetch_k >= max_fetch_k:
+        break
+      fetch_k = min(max_fetch_k, fetch_k * 2)
+
+    partial = bool(matches.sum() < min(k, len(ids)) and fetch_k < num_items)
+    if partial:
+      logging.info("Found %d of %d results among %d filtered items in the %d nearest "
+                   "neighbours", matches.sum(), k, len(ids), fetch_k)
+    return (found_ids[matches][:k], np.asarray(dists, dtype=np.float32)[matches][:k],
+            partial)
+
+  @staticmethod
+  def filter_vectors(snapshot, ids):
+    """Return the normalized vectors of sorted ids, or None if they are not available."""
+    index = snapshot.index
+    if isinstance(index, TieredIndex):
+      if index.embeddings is None and ids[0] < index.main_size:
+        return None
+      return index.vectors(ids)
+    if snapshot.embeddings is None:
+      return None
+    return normalize(np.asarray(snapshot.embeddings[ids], dtype=np.float32))
+
+  def batch_query(self, query_strs, k=2):
+    """Query the index for a list of strings at once.
+
+    All strings are embedded with a single call to
+    `batch_embedding_fn` and searched with one call to
+    nmslib's `knnQueryBatch`.
+
+    Args:
+      query_strs: A list of query strings.
+      k: Number of results to return for each query.
 
-    result = [dict(zip(self.DICT_LABELS, self.lookup_data[id])) for id in idxs]
+    Returns:
+      A list with a list of result dicts for each query string.
+    """
+    if not query_strs:
+      return []
+
+    logging.info("Embedding %d queries", len(query_strs))
+    embeddings = self.embed_batch(query_strs)
+
+    with self.use_snapshot() as snapshot:
+      logging.info("Calling knn server for %d queries", len(query_strs))
+      neighbours = snapshot.index.knnQueryBatch(embeddings, k=k,
+                                                num_threads=self.num_threads)
+
+      return [self.format_result(snapshot, idxs, dists) for idxs, dists in neighbours]
+
+  def knn(self, embeddings, k=2):
+    """Return the raw nearest neighbours of a list of embeddings.
+
+    This is what shard servers return to the server which
+    merges results across shards, see `RemoteShard`.
+
+    Returns:
+      A tuple of a list of (ids, distances) tuples, one per
+      embedding, and the version of the index.
+    """
+    snapshot = self.snapshot
+    neighbours = snapshot.index.knnQueryBatch(np.asarray(embeddings, dtype=np.float32), k=k,
+                                              num_threads=self.num_threads)
+    return neighbours, snapshot.version
+
+  def embed_batch(self, query_strs):
+    if self.batch_embedding_fn:
+      embeddings = self.batch_embedding_fn(query_strs)
+    else:
+      embeddings = [self.embedding_fn(query_str) for query_str in query_strs]
+    return np.array(embeddings, dtype=np.float32)
+
+  def stats(self):
+    """Return a dict of serving statistics."""
+    snapshot = self.snapshot
+    stats = {'version': snapshot.version, 'num_items': len(snapshot.lookup_data)}
+    if self.delta_tier:
+      stats['delta_items'] = len(snapshot.index.delta)
+      stats['deleted_items'] = len(snapshot.index.tombstones)
+    if hasattr(self.embedding_fn, 'stats'):
+      stats['embedding_cache'] = self.embedding_fn.stats()
+    return stats
+
+  def format_result(self, snapshot, idxs, dists, retrieval='vector', partial=False):
+    result = [dict(zip(self.DICT_LABELS, snapshot.lookup_data[id])) for id in idxs]
     for i, dist in enumerate(dists):
       result[i]['score'] = str(dist)
-    return result
+    return QueryResult(result, snapshot.version, retrieval, partial=partial)
+
+  def _query_requests(self, requests):
+    """Serve a micro-batch of `(query_str, k)` requests.
+
+    The batch is searched with the largest requested `k`
+    and each result is truncated to the `k` of its request.
+    """
+    max_k = max(k for _, k in requests)
+    results = self.batch_query([query_str for query_str, _ in requests], k=max_k)
+    return [QueryResult(result[:k], result.version)
+            for (_, k), result in zip(requests, results)]
 
   @staticmethod
-  def nmslib_init():
+  def nmslib_init(method='hnsw', space='cosinesimil'):
     """Initializes an nmslib index object."""
-    index = nmslib.init(method='hnsw', space='cosinesimil')
+    index = nmslib.init(method=method, space=space)
     return index
 
   @staticmethod
-  def create_index(data, save_path):
-    """Add numpy data to the index and save to path."""
+  def load_index(index_file, query_params=None):
+    """Load an nmslib index, or a `QuantizedIndex`, from a local path.
+
+    Only the query time parameters of the kind of the index are set,
+    as nmslib rejects unknown parameters.
+
+    Args:
+      index_file: Path string to the nmslib index file.
+      query_params: An optional dict of query time parameters of HNSW
+                    or quantized indexes.
+    """
+    if QuantizedIndex.is_quantized(index_file):
+      index = QuantizedIndex.load(index_file)
+      supported_params = QuantizedIndex.QUERY_PARAMS
+    else:
+      index = CodeSearchEngine.nmslib_init()
+      index.loadIndex(index_file)
+      supported_params = CodeSearchEngine.HNSW_QUERY_PARAMS
+
+    query_params = query_params or {}
+    ignored_params = sorted(set(query_params) - set(supported_params))
+    if ignored_params:
+      logging.info("Ignoring the query time parameters %s of another kind of index for %s",
+                   ignored_params, index_file)
+    query_params = {key: value for key, value in query_params.items() if key in supported_params}
+    if query_params:
+      index.setQueryTimeParams(query_params)
+    return index
+
+  @staticmethod
+  def load_embeddings(index_file, index):
+    """Memory-map the vectors of an index, or return None if they were not saved.
+
+    These are the exact vectors of a `QuantizedIndex`, or the vectors
+    saved next to an nmslib index with `--save_embeddings`.
+    """
+    if isinstance(index, QuantizedIndex):
+      return index.exact
+    if os.path.isfile(index_file + EMBEDDINGS_SUFFIX):
+      return np.load(index_file + EMBEDDINGS_SUFFIX, mmap_mode='r')
+    logging.warning("No vectors found for %s, its delta tier cannot be compacted and filtered "
+                    "queries cannot be searched exactly", index_file)
+    return None
+
+  @staticmethod
+  def load_lexical_index(index_file):
+    """Load the `LexicalIndex` saved next to an index file."""
+    if not os.path.isfile(index_file + LEXICAL_SUFFIX):
+      raise ValueError('No lexical index found for {}, it is built by create_search_index '
+                       'with --lexical_index'.format(index_file))
+    return LexicalIndex.load(index_file + LEXICAL_SUFFIX)
+
+  @staticmethod
+  def load_filter_index(index_file, lookup_data):
+    """Load the `FilterIndex` saved next to an index file.
+
+    The filter index of a remote shard is built from its lookup data,
+    as only the lookup data of remote shards is available locally.
+    """
+    if index_file.startswith('http://') or index_file.startswith('https://'):
+      return FilterIndex.build(lookup_data[idx] for idx in range(len(lookup_data)))
+
+    if not os.path.isfile(index_file + FILTER_SUFFIX):
+      raise ValueError('No filter index found for {}, it is built by create_search_index '
+                       'with --filter_index'.format(index_file))
+    filter_index = FilterIndex.load(index_file + FILTER_SUFFIX)
+    if len(filter_index) != len(lookup_data):
+      raise ValueError('The filter index of {} has {} items but the lookup data has {}'.format(
+        index_file, len(filter_index), len(lookup_data)))
+    return filter_index
+
+  @staticmethod
+  def load_shard(path, query_params=None, version=None):
+    """Load an index shard from a local path or connect to a shard server URL.
+
+    A shard server must serve the given version of the index, see `RemoteShard`.
+    """
+    if path.startswith('http://') or path.startswith('https://'):
+      return RemoteShard(path, version=version)
+    return CodeSearchEngine.load_index(path, query_params)
+
+  @staticmethod
+  def create_index(data, save_path, index_params=None, print_progress=True):
+    """Add numpy data to the index and save to path.
+
+    Args:
+      data: A 2-D numpy array with one embedding per row.
+      save_path: Path string to write the index to.
+      index_params: An optional dict of nmslib index time parameters, e.g.
+                    `{'M': 16, 'efConstruction': 200, 'indexThreadQty': 4}`.
+      print_progress: Whether nmslib prints a progress bar.
+    """
+    params = {'post': 2}
+    params.update(index_params or {})
+
     index = CodeSearchEngine.nmslib_init()
     index.addDataPointBatch(data)
-    index.createIndex({'post': 2}, print_progress=True)
+    index.createIndex(params, print_progress=print_progress)
     index.saveIndex(save_path)
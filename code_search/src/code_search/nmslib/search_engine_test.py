@@ -0,0 +1,57 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from code_search.nmslib.lookup_store import LookupStore, LookupStoreWriter
+from code_search.nmslib.search_engine import CodeSearchEngine
+
+
+class TestSwap(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.data = np.random.RandomState(0).randn(20, 8).astype(np.float32)
+    self.index_file = os.path.join(self.tmp_dir, 'code.index')
+    CodeSearchEngine.create_index(self.data, self.index_file, print_progress=False)
+
+    self.engine = CodeSearchEngine(self.index_file, self.lookup_store('v1'), embedding_fn=None,
+                                   version='v1')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def lookup_store(self, version):
+    store_file = os.path.join(self.tmp_dir, version + '.lookup')
+    with LookupStoreWriter(store_file, len(CodeSearchEngine.DICT_LABELS)) as writer:
+      for i in range(len(self.data)):
+        writer.write([version, 'src/mod.py', 'f{}'.format(i), str(i), ''])
+    return LookupStore(store_file)
+
+  def test_swap(self):
+    lookup_data = self.engine.lookup_data
+    self.engine.swap(self.index_file, self.lookup_store('v2'), version='v2')
+
+    self.assertEqual(self.engine.version, 'v2')
+    result = self.engine.search(self.data[3], k=1)
+    self.assertEqual(result.version, 'v2')
+    self.assertEqual(result[0]['nwo'], 'v2')
+    with self.assertRaises(ValueError):
+      lookup_data[0]  # pylint: disable=pointless-statement
+
+  def test_swap_in_use(self):
+    """The previous lookup data is only closed once queries release it."""
+    with self.engine.use_snapshot() as snapshot:
+      self.engine.swap(self.index_file, self.lookup_store('v2'), version='v2')
+      self.assertEqual(self.engine.version, 'v2')
+      self.assertEqual(snapshot.lookup_data[3][0], 'v1')
+
+    with self.assertRaises(ValueError):
+      snapshot.lookup_data[3]  # pylint: disable=pointless-statement
+    self.assertEqual(self.engine.lookup_data[3][0], 'v2')
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -1,8 +1,67 @@
 import logging
 import os
+import six
 from flask import Flask, request, abort, jsonify, make_response, redirect
 
 
+def to_text(value):
+  """Return strings as they are and other values as text."""
+  return value if isinstance(value, six.string_types) else six.text_type(value)
+
+
+def parse_knn_payload(payload):
+  """Return the embeddings and number of results of a `/knn` request.
+
+  Raises:
+    ValueError: If the payload has no embeddings.
+  """
+  embeddings = payload.get('embeddings')
+  if not isinstance(embeddings, list) or not embeddings:
+    raise ValueError("empty embeddings")
+  return embeddings, int(payload.get('n', 2))
+
+
+def parse_add_payload(payload, labels):
+  """Return the embeddings and lookup rows of an `/add` request.
+
+  Args:
+    payload: The JSON object of the request.
+    labels: The lookup fields of an item, see `CodeSearchEngine.DICT_LABELS`.
+
+  Raises:
+    ValueError: If the payload has no embeddings or its items are not objects.
+  """
+  embeddings = payload.get('embeddings')
+  items = payload.get('items')
+  if not isinstance(embeddings, list) or not isinstance(items, list) or not embeddings:
+    raise ValueError("empty embeddings")
+
+  if not all(isinstance(item, dict) for item in items):
+    raise ValueError("items must be objects")
+
+  rows = [[to_text(item.get(label, u'')) for label in labels] for item in items]
+  return embeddings, rows
+
+
+def parse_delete_payload(payload):
+  """Return the ids of a `/delete` request.
+
+  Raises:
+    ValueError: If the payload has no ids or they are not integers.
+  """
+  ids = payload.get('ids')
+  if not isinstance(ids, list) or not ids:
+    raise ValueError("empty ids")
+  return [int(idx) for idx in ids]
+
+
+def knn_response(neighbours, version):
+  """Return the JSON payload of a `/knn` response, see `RemoteShard`."""
+  return {'ids': [ids.tolist() for ids, _ in neighbours],
+          'dists': [dists.tolist() for _, dists in neighbours],
+          'version': version}
+
+
 class CodeSearchServer:
   """Flask server wrapping the Search Engine.
 
@@ -38,6 +97,10 @@ class CodeSearchServer:
     def ping():
       return make_response(jsonify(status=200), 200)
 
+    @self.app.route('/stats')
+    def stats():
+      return make_response(jsonify(self.engine.stats()))
+
     @self.app.route('/query')
     def query():
       query_str = request.args.get('q')
@@ -47,8 +110,59 @@ class CodeSearchServer:
           jsonify(status=400, error="empty query"), 400))
 
       num_results = int(request.args.get('n', 2))
-      result = self.engine.query(query_str, k=num_results)
-      return make_response(jsonify(result=result))
+      try:
+        result = self.engine.query(query_str, k=num_results, nwo=request.args.get('nwo'),
+                                   path_prefix=request.args.get('path'))
+      except ValueError as e:
+        abort(make_response(jsonify(status=400, error=str(e)), 400))
+      return make_response(jsonify(result=result, version=result.version,
+                                   retrieval=result.retrieval, partial=result.partial))
+
+    @self.app.route('/batch_query', methods=['POST'])
+    def batch_query():
+      payload = request.get_json(silent=True) or {}
+      query_strs = payload.get('queries')
+      if not isinstance(query_strs, list) or not query_strs:
+        abort(make_response(
+          jsonify(status=400, error="empty query"), 400))
+
+      if not all(isinstance(query_str, six.string_types) and query_str.strip()
+                 for query_str in query_strs):
+        abort(make_response(
+          jsonify(status=400, error="queries must be non-empty strings"), 400))
+
+      logging.info("Got batch of %d queries", len(query_strs))
+      num_results = int(payload.get('n', 2))
+      result = self.engine.batch_query(query_strs, k=num_results)
+      return make_response(jsonify(result=result, version=result[0].version))
+
+    @self.app.route('/knn', methods=['POST'])
+    def knn():
+      try:
+        embeddings, num_results = parse_knn_payload(request.get_json(silent=True) or {})
+      except ValueError as e:
+        abort(make_response(jsonify(status=400, error=str(e)), 400))
+
+      neighbours, version = self.engine.knn(embeddings, k=num_results)
+      return make_response(jsonify(knn_response(neighbours, version)))
+
+    @self.app.route('/add', methods=['POST'])
+    def add():
+      try:
+        embeddings, rows = parse_add_payload(request.get_json(silent=True) or {},
+                                             self.engine.DICT_LABELS)
+        ids = self.engine.add(embeddings, rows)
+      except ValueError as e:
+        abort(make_response(jsonify(status=400, error=str(e)), 400))
+      return make_response(jsonify(ids=ids, version=self.engine.version))
+
+    @self.app.route('/delete', methods=['POST'])
+    def delete():
+      try:
+        self.engine.delete(parse_delete_payload(request.get_json(silent=True) or {}))
+      except (ValueError, IndexError) as e:
+        abort(make_response(jsonify(status=400, error=str(e)), 400))
+      return make_response(jsonify(status=200, version=self.engine.version))
 
   def run(self):
     self.app.run(host=self.host, port=self.port)
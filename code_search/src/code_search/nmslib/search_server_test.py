@@ -0,0 +1,56 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from code_search.nmslib.search_engine import CodeSearchEngine
+from code_search.nmslib.search_server import CodeSearchServer
+
+
+class TestCodeSearchServer(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.index_file = os.path.join(self.tmp_dir, 'code.index')
+
+    rng = np.random.RandomState(0)
+    self.data = rng.randn(50, 8).astype(np.float32)
+    self.rows = [['owner/repo', 'src/mod.py', 'f{}'.format(i), str(i), ''] for i in range(50)]
+    CodeSearchEngine.create_index(self.data, self.index_file, print_progress=False)
+
+    self.engine = CodeSearchEngine(self.index_file, self.rows, self.embed, max_batch_size=4)
+    self.client = CodeSearchServer(self.engine, self.tmp_dir).app.test_client()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def embed(self, query_str):
+    """Embed `fN` as the vector of item N."""
+    return self.data[int(query_str[1:])]
+
+  def test_query(self):
+    response = self.client.get('/query?q=f3&n=2')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.get_json()['result'][0]['function_name'], 'f3')
+
+    self.assertEqual(self.client.get('/query?q=').status_code, 400)
+
+  def test_batch_query(self):
+    response = self.client.post('/batch_query', json={'queries': ['f3', 'f7'], 'n': 2})
+    self.assertEqual(response.status_code, 200)
+    results = response.get_json()['result']
+    self.assertEqual([result[0]['function_name'] for result in results], ['f3', 'f7'])
+    self.assertEqual([len(result) for result in results], [2, 2])
+
+  def test_batch_query_invalid(self):
+    for payload in [None, {}, {'queries': []}, {'queries': 'f3'}, {'queries': ['f3', '']},
+                    {'queries': ['f3', ' ']}, {'queries': ['f3', 7]},
+                    {'queries': ['f3', ['f7']]}, {'queries': ['f3', None]}]:
+      response = self.client.post('/batch_query', json=payload)
+      self.assertEqual(response.status_code, 400, payload)
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -0,0 +1,168 @@
+import bisect
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+
+def shard_file(path, shard, num_shards):
+  """Return the path of one shard of a sharded index file.
+
+  Args:
+    path: Path string to the unsharded file, e.g. `--index_file`.
+    shard: The number of the shard.
+    num_shards: Total number of shards.
+  """
+  if not path or num_shards <= 1:
+    return path
+  return '{}-{:05d}-of-{:05d}'.format(path, shard, num_shards)
+
+
+def merge_top_k(shard_results, offsets, k):
+  """Merge per-shard nearest neighbours into a global top k.
+
+  Args:
+    shard_results: A list with a tuple of ids and distances for each shard.
+    offsets: A list with the global id of the first item of each shard.
+    k: Number of neighbours to return.
+
+  Returns:
+    A tuple of global ids and distances sorted by increasing distance.
+  """
+  ids = np.concatenate([np.asarray(shard_ids, dtype=np.int64) + offset
+                        for (shard_ids, _), offset in zip(shard_results, offsets)])
+  dists = np.concatenate([np.asarray(shard_dists, dtype=np.float32)
+                          for _, shard_dists in shard_results])
+  order = np.argsort(dists, kind='mergesort')[:k]
+  return ids[order], dists[order]
+
+
+class ShardedLookup:
+  """Concatenate the lookup data of several shards.
+
+  Items are addressed by global id, which is the id within the
+  shard plus the number of items in all the preceding shards.
+
+  Args:
+    lookups: A list with the lookup data of each shard.
+  """
+
+  def __init__(self, lookups):
+    self.lookups = lookups
+    self.offsets = [0]
+    for lookup in lookups:
+      self.offsets.append(self.offsets[-1] + len(lookup))
+
+  def __len__(self):
+    return self.offsets[-1]
+
+  def __getitem__(self, idx):
+    if idx < 0:
+      idx += len(self)
+    if not 0 <= idx < len(self):
+      raise IndexError('lookup index out of range')
+
+    shard = bisect.bisect_right(self.offsets, idx) - 1
+    return self.lookups[shard][idx - self.offsets[shard]]
+
+  def close(self):
+    for lookup in self.lookups:
+      if hasattr(lookup, 'close'):
+        lookup.close()
+
+
+class ShardedIndex:
+  """Scatter queries to several index shards and gather a global top k.
+
+  Each shard is queried for its own top k from a thread pool,
+  which can be shared by the indexes of successive versions.
+  nmslib releases the GIL while searching, so local shards are
+  searched in parallel. The per-shard results are then merged by
+  distance into a global top k.
+
+  This exposes the `knnQuery` and `knnQueryBatch` methods of an
+  nmslib index, so it can be used by `CodeSearchEngine` in place
+  of a single index.
+
+  Args:
+    shards: A list of loaded nmslib indexes or `RemoteShard` instances.
+    offsets: A list with the global id of the first item of each shard,
+             e.g. `ShardedLookup.offsets`.
+    num_threads: Number of threads querying shards. Defaults to one per shard.
+    executor: An optional `ThreadPoolExecutor` querying the shards, instead
+              of one of `num_threads` threads owned by this index.
+  """
+
+  def __init__(self, shards, offsets, num_threads=None, executor=None):
+    self.shards = shards
+    self.offsets = offsets[:len(shards)]
+    self.executor = executor or ThreadPoolExecutor(max_workers=num_threads or len(shards))
+
+  def knnQuery(self, vector, k=10):  # pylint: disable=invalid-name
+    futures = [self.executor.submit(shard.knnQuery, vector, k=k) for shard in self.shards]
+    return merge_top_k([future.result() for future in futures], self.offsets, k)
+
+  def knnQueryBatch(self, vectors, k=10, num_threads=0):  # pylint: disable=invalid-name
+    futures = [self.executor.submit(shard.knnQueryBatch, vectors, k=k, num_threads=num_threads)
+               for shard in self.shards]
+    shard_neighbours = [future.result() for future in futures]
+    return [merge_top_k(query_results, self.offsets, k)
+            for query_results in zip(*shard_neighbours)]
+
+
+class ShardVersionError(Exception):
+  """A shard server serves another version of the index than expected."""
+
+
+class RemoteShard:
+  """An index shard served by another search server.
+
+  The shard server runs `start_search_server` with `--index_shard`
+  and is queried through its `/knn` route, which returns ids
+  local to the shard and the version of its index.
+
+  With a `version`, the ids of another version would point to the
+  wrong lookup rows, so a request answered by another version is
+  retried up to `retries` times, as the shard server may be about
+  to swap in the expected one, and then fails.
+
+  Args:
+    url: Base URL of the shard server.
+    session: An optional `requests.Session` to reuse connections.
+    timeout: Timeout in seconds for each request to the shard server.
+    version: The version of the index the shard server must serve,
+             or None to accept any version.
+    retries: Number of times a request is retried on a version mismatch.
+    retry_seconds: Time in seconds to wait before retrying a request.
+  """
+
+  def __init__(self, url, session=None, timeout=10, version=None, retries=2,
+               retry_seconds=0.5):
+    self.url = url.rstrip('/') + '/knn'
+    self.session = session or requests.Session()
+    self.timeout = timeout
+    self.version = version
+    self.retries = retries
+    self.retry_seconds = retry_seconds
+
+  def knnQuery(self, vector, k=10):  # pylint: disable=invalid-name
+    return self.knnQueryBatch([vector], k=k)[0]
+
+  def knnQueryBatch(self, vectors, k=10,  # pylint: disable=invalid-name,unused-argument
+                    num_threads=0):
+    data = {'embeddings': np.asarray(vectors, dtype=np.float32).tolist(), 'n': k}
+    for attempt in range(self.retries + 1):
+      if attempt:
+        time.sleep(self.retry_seconds)
+      logging.info("Sending %d embeddings to shard %s", len(data['embeddings']), self.url)
+      response = self.session.post(self.url, json=data, timeout=self.timeout)
+      response.raise_for_status()
+      result = response.json()
+      if self.version is None or result.get('version') == self.version:
+        return list(zip(result['ids'], result['dists']))
+      logging.warning("Shard %s serves version %s instead of %s", self.url,
+                      result.get('version'), self.version)
+
+    raise ShardVersionError('Shard {} serves version {} instead of {}'.format(
+      self.url, result.get('version'), self.version))
@@ -0,0 +1,108 @@
+import logging
+import unittest
+import numpy as np
+
+from code_search.nmslib.sharded_index import (RemoteShard, ShardedIndex, ShardedLookup,
+                                              ShardVersionError, merge_top_k, shard_file)
+
+
+class FakeShard(object):
+  """A brute force index over a few vectors, using the L2 distance."""
+
+  def __init__(self, data):
+    self.data = np.asarray(data, dtype=np.float32)
+
+  def knnQuery(self, vector, k=10):  # pylint: disable=invalid-name
+    dists = np.linalg.norm(self.data - vector, axis=1)
+    ids = np.argsort(dists)[:k]
+    return ids, dists[ids]
+
+  def knnQueryBatch(self, vectors, k=10,  # pylint: disable=invalid-name,unused-argument
+                    num_threads=0):
+    return [self.knnQuery(vector, k=k) for vector in vectors]
+
+
+class FakeResponse(object):
+  def __init__(self, result):
+    self.result = result
+
+  def raise_for_status(self):
+    pass
+
+  def json(self):
+    return self.result
+
+
+class FakeSession(object):
+  """Answer `/knn` requests with the given versions in turn."""
+
+  def __init__(self, versions):
+    self.versions = list(versions)
+    self.requests = 0
+
+  def post(self, url, json=None, timeout=None):  # pylint: disable=unused-argument
+    self.requests += 1
+    return FakeResponse({'ids': [[1, 0]], 'dists': [[0.1, 0.2]],
+                         'version': self.versions.pop(0)})
+
+
+class TestShardedIndex(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.RandomState(0)
+    self.data = rng.randn(50, 4).astype(np.float32)
+    self.queries = rng.randn(5, 4).astype(np.float32)
+
+    self.shards = [FakeShard(self.data[:20]), FakeShard(self.data[20:20]),
+                   FakeShard(self.data[20:])]
+    self.lookup = ShardedLookup([list(range(20)), [], list(range(20, 50))])
+
+  def test_shard_file(self):
+    self.assertEqual(shard_file('gs://bucket/code.index', 2, 8),
+                     'gs://bucket/code.index-00002-of-00008')
+    self.assertEqual(shard_file('code.index', 0, 1), 'code.index')
+    self.assertEqual(shard_file('', 2, 8), '')
+
+  def test_sharded_lookup(self):
+    self.assertEqual(len(self.lookup), 50)
+    self.assertEqual(self.lookup.offsets, [0, 20, 20, 50])
+    self.assertEqual([self.lookup[i] for i in range(50)], list(range(50)))
+    self.assertEqual(self.lookup[-1], 49)
+    with self.assertRaises(IndexError):
+      self.lookup[50]  # pylint: disable=pointless-statement
+
+  def test_merge_top_k(self):
+    ids, dists = merge_top_k([([0, 1], [0.5, 0.7]), ([0, 1], [0.1, 0.6])], [0, 10], 3)
+    self.assertEqual(ids.tolist(), [10, 0, 11])
+    np.testing.assert_allclose(dists, [0.1, 0.5, 0.6])
+
+  def test_matches_unsharded_index(self):
+    index = ShardedIndex(self.shards, self.lookup.offsets)
+    unsharded = FakeShard(self.data)
+
+    for query in self.queries:
+      ids, _ = index.knnQuery(query, k=5)
+      self.assertEqual(ids.tolist(), unsharded.knnQuery(query, k=5)[0].tolist())
+
+    for (ids, _), (expected_ids, _) in zip(index.knnQueryBatch(self.queries, k=5),
+                                           unsharded.knnQueryBatch(self.queries, k=5)):
+      self.assertEqual(ids.tolist(), expected_ids.tolist())
+
+  def test_remote_shard_version(self):
+    session = FakeSession(['v1', 'v2'])
+    shard = RemoteShard('http://shard:8008', session=session, version='v2', retry_seconds=0)
+    self.assertEqual(shard.knnQuery([0., 1.], k=2), ([1, 0], [0.1, 0.2]))
+    self.assertEqual(session.requests, 2)
+
+    session = FakeSession(['v1'] * 3)
+    shard = RemoteShard('http://shard:8008', session=session, version='v2', retry_seconds=0)
+    with self.assertRaises(ShardVersionError):
+      shard.knnQuery([0., 1.], k=2)
+    self.assertEqual(session.requests, 3)
+
+    shard = RemoteShard('http://shard:8008', session=FakeSession(['v1']))
+    self.assertEqual(shard.knnQuery([0., 1.], k=2), ([1, 0], [0.1, 0.2]))
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
@@ -0,0 +1,190 @@
+"""Encode queries like `code_search.t2t.query` without TensorFlow.
+
+This loads the subword vocabulary file of a T2T problem and
+encodes strings with the algorithm of T2T's `SubwordTextEncoder`,
+then serializes the `tf.train.Example` in the protobuf wire format
+by hand. The result is byte for byte the one of
+`code_search.t2t.query.encode_queries`, but the search server no
+longer has to import TensorFlow and tensor2tensor to build it.
+"""
+import base64
+import unicodedata
+import six
+
+from code_search.nmslib import file_io
+
+EOS_ID = 1
+
+# Characters used by T2T to escape tokens, see `SubwordTextEncoder`.
+ESCAPE_CHARS = set(u'\\_u;0123456789')
+
+# Maximum number of tokens whose subword ids are memoized by an encoder.
+MAX_CACHE_SIZE = 2 ** 16
+
+
+def native_to_unicode(s):
+  return s if isinstance(s, six.text_type) else s.decode('utf-8')
+
+
+_ALNUM_CACHE = {}
+
+
+def is_alnum(c):
+  """Whether a character is a letter or a number, like T2T's tokenizer."""
+  alnum = _ALNUM_CACHE.get(c)
+  if alnum is None:
+    alnum = _ALNUM_CACHE[c] = unicodedata.category(c)[0] in ('L', 'N')
+  return alnum
+
+
+def tokenize(text):
+  """Split a string into tokens like `tensor2tensor.data_generators.tokenizer`.
+
+  Tokens are maximal runs of alphanumeric or of other characters.
+  Single spaces between two alphanumeric tokens are dropped.
+  """
+  if not text:
+    return []
+  tokens = []
+  token_start = 0
+  alnums = [is_alnum(c) for c in text]
+  for pos in range(1, len(text)):
+    if alnums[pos] != alnums[pos - 1]:
+      token = text[token_start:pos]
+      if token != u' ' or token_start == 0:
+        tokens.append(token)
+      token_start = pos
+  tokens.append(text[token_start:])
+  return tokens
+
+
+class SubwordEncoder:
+  """A TensorFlow free `SubwordTextEncoder` which can only encode.
+
+  Subword ids of tokens are memoized, up to `MAX_CACHE_SIZE` tokens.
+
+  Args:
+    subtoken_strings: The list of subtokens of the vocabulary, by id.
+  """
+
+  def __init__(self, subtoken_strings):
+    self.subtoken_ids = {subtoken: i for i, subtoken in enumerate(subtoken_strings) if subtoken}
+    self.max_subtoken_len = max(len(subtoken) for subtoken in subtoken_strings)
+    self.alphabet = {c for subtoken in subtoken_strings for c in subtoken} | ESCAPE_CHARS
+    self.cache = {}
+
+  def encode(self, s):
+    """Encode a string into a list of subword ids."""
+    ids = []
+    for token in tokenize(native_to_unicode(s)):
+      ids.extend(self.encode_token(token))
+    return ids
+
+  def encode_token(self, token):
+    ids = self.cache.get(token)
+    if ids is None:
+      if len(self.cache) >= MAX_CACHE_SIZE:
+        self.cache.clear()
+      ids = self.cache[token] = [self.subtoken_ids[subtoken]
+                                 for subtoken in self.split_escaped_token(self.escape(token))]
+    return ids
+
+  def escape(self, token):
+    """Escape underscores and characters out of the alphabet, ending with `_`."""
+    token = token.replace(u'\\', u'\\\\').replace(u'_', u'\\u')
+    return u''.join(c if c in self.alphabet and c != u'\n' else u'\\%d;' % ord(c)
+                    for c in token) + u'_'
+
+  def split_escaped_token(self, escaped_token):
+    """Greedily split an escaped token into its longest known subtokens."""
+    subtokens = []
+    start = 0
+    token_len = len(escaped_token)
+    while start < token_len:
+      for end in range(min(token_len, start + self.max_subtoken_len), start, -1):
+        subtoken = escaped_token[start:end]
+        if subtoken in self.subtoken_ids:
+          subtokens.append(subtoken)
+          start = end
+          break
+      else:
+        raise ValueError('Token substring not found in subtoken vocabulary: {}'.format(
+          escaped_token[start:]))
+    return subtokens
+
+  @staticmethod
+  def load(vocab_file):
+    """Load the vocabulary file written by `SubwordTextEncoder.store_to_file`."""
+    subtoken_strings = []
+    with file_io.open_file(vocab_file) as f:
+      for line in f:
+        s = native_to_unicode(line).strip()
+        if (s.startswith(u"'") and s.endswith(u"'")) or (s.startswith(u'"') and s.endswith(u'"')):
+          s = s[1:-1]
+        subtoken_strings.append(s)
+    return SubwordEncoder(subtoken_strings)
+
+
+def encode_varint(value):
+  value &= 0xffffffffffffffff
+  data = bytearray()
+  while value > 0x7f:
+    data.append((value & 0x7f) | 0x80)
+    value >>= 7
+  data.append(value)
+  return data
+
+
+def encode_field(field_number, payload):
+  """Encode a length-delimited protobuf field."""
+  return encode_varint(field_number << 3 | 2) + encode_varint(len(payload)) + payload
+
+
+def serialize_example(features):
+  """Serialize a `tf.train.Example` of int64 features.
+
+  Map entries are sorted by key as in deterministic protobuf
+  serialization, so that the result does not depend on the
+  protobuf implementation.
+
+  Args:
+    features: A dict from feature names to lists of integers.
+
+  Returns:
+    The serialized Example as bytes.
+  """
+  entries = bytearray()
+  for key in sorted(features, key=lambda key: key.encode('utf-8')):
+    values = bytearray()
+    for value in features[key]:
+      values += encode_varint(value)
+    # Int64List holds packed values in field 1 and is field 3 of Feature.
+    int64_list = encode_field(1, values) if values else bytearray()
+    feature = encode_field(3, int64_list)
+    entry = encode_field(1, bytearray(key.encode('utf-8'))) + encode_field(2, feature)
+    entries += encode_field(1, entry)
+  return bytes(encode_field(1, entries))
+
+
+def encode_queries(encoder, embed_code, query_strs, raw=False):
+  """Encode a list of strings like `code_search.t2t.query.encode_queries`.
+
+  Args:
+    encoder: A `SubwordEncoder` of the vocabulary of the T2T problem.
+    embed_code: Bool determines whether to treat the strings as code.
+    query_strs: A list of strings to compute embeddings for.
+    raw: Bool determines whether to return the serialized TF Examples
+      as bytes instead of base64 strings.
+
+  Returns:
+    A list of base64 encoded, or raw, serialized TF Examples.
+  """
+  encoded_queries = []
+  for query_str in query_strs:
+    serialized = serialize_example({
+      'inputs': encoder.encode(query_str) + [EOS_ID],
+      'targets': [0],
+      'embed_code': [1 if embed_code else 0],
+    })
+    encoded_queries.append(serialized if raw else base64.b64encode(serialized).decode('utf-8'))
+  return encoded_queries
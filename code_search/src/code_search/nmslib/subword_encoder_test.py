@@ -0,0 +1,55 @@
+# coding=utf-8
+import base64
+import logging
+import os
+import unittest
+
+from code_search.nmslib.subword_encoder import SubwordEncoder, encode_queries, \
+  serialize_example, tokenize
+
+VOCAB_FILE = os.path.abspath(os.path.join(
+  os.path.dirname(__file__), '..', 't2t', 'test_data',
+  'vocab.kf_github_function_docstring.8192.subwords'))
+
+
+class TestSubwordEncoder(unittest.TestCase):
+  # The expected values were computed with T2T's SubwordTextEncoder and the
+  # deterministic serialization of a tf.train.Example.
+
+  def setUp(self):
+    self.encoder = SubwordEncoder.load(VOCAB_FILE)
+
+  def test_tokenize(self):
+    self.assertEqual(tokenize(u'Write to GCS'), [u'Write', u'to', u'GCS'])
+    self.assertEqual(tokenize(u' a  b(c)'), [u' ', u'a', u'  ', u'b', u'(', u'c', u')'])
+    self.assertEqual(tokenize(u''), [])
+
+  def test_encode(self):
+    self.assertEqual(self.encoder.encode(u'Write to GCS'), [3182, 4, 17, 5607, 160])
+    self.assertEqual(self.encoder.encode('get_user_name(uid)'),
+                     [20, 2, 59, 2, 16, 407, 1061, 2143])
+    # Characters out of the alphabet are escaped by their code point.
+    self.assertEqual(self.encoder.encode(u'naïve 🎉\n'),
+                     [975, 5975, 2578, 2426, 7433, 1014, 634, 5975, 2118, 3509, 3881, 7433,
+                      5975, 1465, 7433, 4])
+    # Memoized tokens are encoded the same.
+    self.assertEqual(self.encoder.encode(u'GCS to Write'), [5607, 160, 17, 3182, 4])
+
+  def test_serialize_example(self):
+    self.assertEqual(serialize_example({'targets': [0], 'embed_code': [1],
+                                        'inputs': [3182, 4, 17, 5607, 160, 1]}),
+                     b'\n@\n\x13\n\nembed_code\x12\x05\x1a\x03\n\x01\x01'
+                     b'\n\x17\n\x06inputs\x12\r\x1a\x0b\n\t\xee\x18\x04\x11\xe7+\xa0\x01\x01'
+                     b'\n\x10\n\x07targets\x12\x05\x1a\x03\n\x01\x00')
+
+  def test_encode_queries(self):
+    expected = ('CkAKEwoKZW1iZWRfY29kZRIFGgMKAQAKFwoGaW5wdXRzEg0aCwoJ7hgEEecroAEBChAKB3Rhcm'
+                'dldHMSBRoDCgEA')
+    self.assertEqual(encode_queries(self.encoder, False, [u'Write to GCS']), [expected])
+    self.assertEqual(encode_queries(self.encoder, False, [u'Write to GCS'], raw=True),
+                     [base64.b64decode(expected)])
+
+
+if __name__ == "__main__":
+  logging.getLogger().setLevel(logging.INFO)
+  unittest.main()
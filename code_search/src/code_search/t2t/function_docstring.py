@@ -1,5 +1,6 @@
 """Github function/text similatrity problems."""
 import csv
+import io
 import logging
 from six import StringIO
 from tensor2tensor.data_generators import generator_utils
@@ -22,7 +23,10 @@ class GithubFunctionDocstring(text_problems.Text2TextProblem):
   and docstring pairs as CSV files. The files are structured
   such that they contain two columns without headers containing
   the docstring tokens and function tokens. The delimiter is
-  ",".
+  ",". Parquet files with `docstring_tokens` and `function_tokens`
+  columns, as written by `preprocess_github_dataset` with
+  `--pairs_format=parquet`, are read instead if present in the
+  data directory.
   """
 
   DATA_PATH_PREFIX = "gs://kubeflow-examples/t2t-code-search/raw_data"
@@ -84,6 +88,30 @@ class GithubFunctionDocstring(text_problems.Text2TextProblem):
         for uri, file_list in self.pair_files_list
     ]
 
+  def get_parquet_files(self, data_dir, _tmp_dir, _dataset_split):
+    return tf.gfile.Glob("{}/func-doc-pairs-*.parquet".format(data_dir))
+
+  def generate_parquet_samples(self, parquet_files):
+    """Yield the pairs of Parquet files, one row group at a time."""
+    # Imported here as pyarrow is only needed for Parquet files.
+    import pyarrow.parquet as pq
+
+    for pairs_file in sorted(parquet_files):
+      tf.logging.debug("Reading {}".format(pairs_file))
+      with tf.gfile.Open(pairs_file, "rb") as parquet_file:
+        reader = pq.ParquetFile(io.BytesIO(parquet_file.read()))
+      for row_group in range(reader.num_row_groups):
+        table = reader.read_row_group(row_group,
+                                      columns=["docstring_tokens", "function_tokens"])
+        for docstring_tokens, function_tokens in zip(
+            table.column("docstring_tokens").to_pylist(),
+            table.column("function_tokens").to_pylist()):
+          yield {
+              "inputs": docstring_tokens,
+              "targets": function_tokens,
+              "embed_code": [0],
+          }
+
   def generate_samples(self, data_dir, tmp_dir, dataset_split):
     """A generator to return data samples.Returns the data generator to return.
 
@@ -98,6 +126,12 @@ class GithubFunctionDocstring(text_problems.Text2TextProblem):
       Each element yielded is of a Python dict of the form
         {"inputs": "STRING", "targets": "STRING", "embed_code": [0]}
     """
+    parquet_files = self.get_parquet_files(data_dir, tmp_dir, dataset_split)
+    if parquet_files:
+      for sample in self.generate_parquet_samples(parquet_files):
+        yield sample
+      return
+
     csv_files = self.get_csv_files(data_dir, tmp_dir, dataset_split)
 
     for pairs_file in csv_files:
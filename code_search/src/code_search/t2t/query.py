@@ -1,8 +1,12 @@
 import base64
 import tensorflow as tf
 from tensor2tensor.data_generators import text_encoder
+from tensor2tensor.data_generators import tokenizer
 from tensor2tensor.utils import registry
 
+# Maximum number of tokens whose subword ids are memoized by `encode_queries`.
+MAX_SUBWORD_CACHE_SIZE = 2 ** 16
+
 
 def get_encoder(problem_name, data_dir):
   """Get encoder from the T2T problem.This might
@@ -45,7 +49,60 @@ def encode_query(encoder, embed_code, query_str):
         value=[embed_code_value])),
   }
   example = tf.train.Example(features=tf.train.Features(feature=features))
-  return base64.b64encode(example.SerializeToString()).decode('utf-8')
+  return base64.b64encode(example.SerializeToString(deterministic=True)).decode('utf-8')
+
+def encode_queries(encoder, embed_code, query_strs, raw=False, cache=None):
+  """Encode a list of strings like `encode_query`.
+
+  A single `tf.train.Example` is filled in and serialized for
+  every string instead of building a new proto object graph
+  for each of them. With a `SubwordTextEncoder`, the subword
+  ids of each token are memoized in `cache` so that repeated
+  tokens are only split into subwords once.
+
+  Args:
+    encoder: Encoder to encode the strings as vectors.
+    embed_code: Bool determines whether to treat the strings as code.
+    query_strs: A list of strings to compute embeddings for.
+    raw: Bool determines whether to return the serialized TF Examples
+      as bytes, e.g. for gRPC requests, instead of base64 strings.
+    cache: An optional dict from tokens to subword ids to share between
+      calls. It is cleared once it holds `MAX_SUBWORD_CACHE_SIZE` tokens.
+
+  Returns:
+    A list of base64 encoded, or raw, serialized TF Examples.
+  """
+  example = tf.train.Example()
+  feature = example.features.feature
+  inputs = feature["inputs"].int64_list.value
+  feature["targets"].int64_list.value.append(0)
+  feature["embed_code"].int64_list.value.append(1 if embed_code else 0)
+
+  memoize = isinstance(encoder, text_encoder.SubwordTextEncoder)
+  if cache is None:
+    cache = {}
+
+  encoded_queries = []
+  for query_str in query_strs:
+    del inputs[:]
+    if memoize:
+      for token in tokenizer.encode(text_encoder.native_to_unicode(query_str)):
+        subtoken_ids = cache.get(token)
+        if subtoken_ids is None:
+          if len(cache) >= MAX_SUBWORD_CACHE_SIZE:
+            cache.clear()
+          # A token is tokenized into itself, so this encodes the token alone.
+          subtoken_ids = cache[token] = encoder.encode(token)
+        inputs.extend(subtoken_ids)
+    else:
+      inputs.extend(encoder.encode(query_str))
+    inputs.append(text_encoder.EOS_ID)
+
+    # Features are serialized in a fixed order, which is also the one of
+    # `code_search.nmslib.subword_encoder`.
+    serialized = example.SerializeToString(deterministic=True)
+    encoded_queries.append(serialized if raw else base64.b64encode(serialized).decode('utf-8'))
+  return encoded_queries
 
 def decode_result(decoder, list_ids):
   return decoder.decode(list_ids)